@@ -2,8 +2,11 @@ from genomic_regions import GenomicRegion, Bedpe
 from collections import defaultdict
 import numpy as np
 from ..tools.general import RareUpdateProgressBar
+from ..tools.load import load
+from ..tools.files import release_inherited_pytables_file
 from ..general import FileGroup
 from skimage.transform import resize
+import multiprocessing as mp
 import warnings
 import tables
 
@@ -182,7 +185,7 @@ class AggregateMatrix(FileGroup):
     @classmethod
     def from_center(cls, matrix, regions, window=200000,
                     rescale=False, scaling_exponent=-0.25,
-                    keep_components=True,
+                    keep_components=True, threads=1,
                     file_name=None, tmpdir=None, region_viewpoint='center',
                     **kwargs):
         """
@@ -221,6 +224,8 @@ class AggregateMatrix(FileGroup):
                                 to generate the aggregate matrix in the
                                 :class:`AggregateMatrix` object, which can be retrieved
                                 using :func:`AggregateMatrix.components`
+        :param threads: Number of worker processes. Regions are distributed
+                        across workers by chromosome
         :param file_name: If provided, stores the aggregate matrix object at this location.
         :param tmpdir: If True will work in temporary directory until the object is closed
         :param region_viewpoint: point on which window is centred. any of "center", "start", "end",
@@ -240,27 +245,9 @@ class AggregateMatrix(FileGroup):
                                        strand=region.strand)
             region_pairs.append((new_region, new_region))
 
-        component_regions = []
-        component_matrices = []
-        counter_matrix = None
-        matrix_sum = None
-        for (r1, r2), m in extract_submatrices(matrix, region_pairs, **kwargs):
-            if counter_matrix is None:
-                shape = m.shape
-                counter_matrix = np.zeros(shape)
-                matrix_sum = np.zeros(shape)
-
-            if hasattr(m, 'mask'):
-                inverted_mask = ~m.mask
-                counter_matrix += inverted_mask.astype('int')
-            else:
-                counter_matrix += np.ones(counter_matrix.shape)
-
-            matrix_sum += m
-
-            component_regions.append((r1, r2))
-            if keep_components:
-                component_matrices.append(m)
+        matrix_sum, counter_matrix, component_regions, component_matrices = \
+            _aggregate(matrix, region_pairs, _center_component,
+                       keep_components=keep_components, threads=threads, **kwargs)
 
         am = matrix_sum / counter_matrix
 
@@ -280,7 +267,7 @@ class AggregateMatrix(FileGroup):
                      interpolation=0,
                      boundary_mode='reflect', keep_mask=True,
                      absolute_extension=0, relative_extension=1.0,
-                     keep_components=True, anti_aliasing=True,
+                     keep_components=True, anti_aliasing=True, threads=1,
                      file_name=None, tmpdir=None,
                      **kwargs):
         """
@@ -328,6 +315,10 @@ class AggregateMatrix(FileGroup):
                                 to generate the aggregate matrix in the
                                 :class:`AggregateMatrix` object, which can be retrieved
                                 using :func:`AggregateMatrix.components`
+        :param anti_aliasing: Apply a Gaussian filter before downsampling submatrices
+        :param threads: Number of worker processes. Regions are distributed
+                        across workers by chromosome. This also parallelises
+                        the interpolation of submatrices
         :param file_name: If provided, stores the aggregate matrix object at this location.
         :param tmpdir: If True will work in temporary directory until the object is closed
         :param kwargs: Keyword argumnts passed to :func:`extract_submatrices`
@@ -338,33 +329,15 @@ class AggregateMatrix(FileGroup):
         kwargs.setdefault('keep_invalid', False)
         kwargs.setdefault('log', True)
 
-        component_regions = []
-        component_matrices = []
         shape = (pixels, pixels)
-        counter_matrix = np.zeros(shape)
-        matrix_sum = np.zeros(shape)
-        for (r1, r2), m in _tad_matrix_iterator(hic, tad_regions,
-                                                absolute_extension=absolute_extension,
-                                                relative_extension=relative_extension,
-                                                **kwargs):
-            if m is not None:
-                ms = resize(m, shape, mode=boundary_mode, anti_aliasing=anti_aliasing,
-                            preserve_range=False, clip=False, order=interpolation)
-
-                if keep_mask and hasattr(ms, 'mask'):
-                    mask = resize(m.mask, shape, mode=boundary_mode, anti_aliasing=anti_aliasing,
-                                  preserve_range=False, clip=False, order=interpolation).astype('bool')
-                    ms = np.ma.masked_where(mask, ms)
-                    inverted_mask = ~mask
-                    counter_matrix += inverted_mask.astype('int')
-                else:
-                    counter_matrix += np.ones(shape)
-
-                matrix_sum += ms
-
-            component_regions.append((r1, r2))
-            if keep_components:
-                component_matrices.append(m)
+        region_pairs = _tad_region_pairs(tad_regions, absolute_extension=absolute_extension,
+                                         relative_extension=relative_extension)
+        component_kwargs = dict(shape=shape, boundary_mode=boundary_mode,
+                                anti_aliasing=anti_aliasing, interpolation=interpolation,
+                                keep_mask=keep_mask)
+        matrix_sum, counter_matrix, component_regions, component_matrices = \
+            _aggregate(hic, region_pairs, _regions_component, component_kwargs=component_kwargs,
+                       shape=shape, keep_components=keep_components, threads=threads, **kwargs)
 
         am = matrix_sum/counter_matrix
 
@@ -380,21 +353,34 @@ class AggregateMatrix(FileGroup):
 
     @classmethod
     def from_center_pairs(cls, hic, pair_regions, window=None, pixels=16,
-                          keep_components=True, file_name=None, tmpdir=None,
+                          keep_components=True, threads=1, file_name=None, tmpdir=None,
                           region_viewpoint='center',
                           **kwargs):
         """
+        Construct an aggregate matrix from pairs of regions, such as loop anchors.
 
-        :param hic:
-        :param pair_regions:
-        :param window:
-        :param pixels:
-        :param keep_components:
-        :param file_name:
-        :param tmpdir:
-        :param region_viewpoint:
-        :param kwargs:
-        :return:
+        For each region pair, the submatrix centred on the bins containing
+        the viewpoints of both regions is extracted, with a fixed number
+        of pixels around the centre.
+
+        :param hic: An object of type :class:`RegionMatrixContainer`, such as a
+                    Hic matrix
+        :param pair_regions: A list of (:class:`GenomicRegion`, :class:`GenomicRegion`)
+                             tuples, or a :class:`~genomic_regions.Bedpe` object
+        :param window: A window size in base pairs. Overrides :code:`pixels`
+        :param pixels: Number of pixels along each dimension of the aggregate matrix
+        :param keep_components: If True (default) will store each submatrix used
+                                to generate the aggregate matrix in the
+                                :class:`AggregateMatrix` object, which can be retrieved
+                                using :func:`AggregateMatrix.components`
+        :param threads: Number of worker processes. Region pairs are distributed
+                        across workers by chromosome
+        :param file_name: If provided, stores the aggregate matrix object at this location.
+        :param tmpdir: If True will work in temporary directory until the object is closed
+        :param region_viewpoint: point on which window is centred. any of "center", "start", "end",
+                                 "five_prime", or "three_prime"
+        :param kwargs: Keyword arguments passed to :func:`extract_submatrices`
+        :return: aggregate matrix
         """
         kwargs.setdefault('oe', True)
         kwargs.setdefault('keep_invalid', False)
@@ -402,31 +388,16 @@ class AggregateMatrix(FileGroup):
 
         if window is not None:
             bin_size = hic.bin_size
-            pixels = np.round(window/bin_size)
+            pixels = int(np.round(window/bin_size))
 
-        component_regions = []
-        component_matrices = []
         shape = (pixels, pixels)
-        counter_matrix = np.zeros(shape)
-        matrix_sum = np.zeros(shape)
-        for (r1, r2), m in _loop_matrix_iterator(hic, pair_regions, pixels=pixels,
-                                                 region_viewpoint=region_viewpoint,
-                                                 **kwargs):
-            try:
-                if hasattr(m, 'mask'):
-                    inverted_mask = ~m.mask
-                    counter_matrix += inverted_mask.astype('int')
-                else:
-                    counter_matrix += np.ones(shape)
-                matrix_sum += m
-            except ValueError:
-                warnings.warn("Regions {} vs {} did not produce a valid matrix for aggregation!"
-                              .format(r1, r2))
-                continue
-
-            component_regions.append((r1, r2))
-            if keep_components:
-                component_matrices.append(m)
+        region_pairs = _loop_region_pairs(hic, pair_regions, pixels=pixels,
+                                          region_viewpoint=region_viewpoint)
+        matrix_sum, counter_matrix, component_regions, component_matrices = \
+            _aggregate(hic, region_pairs, _center_pairs_component,
+                       component_kwargs=dict(shape=shape), shape=shape,
+                       keep_components=keep_components, skip_invalid=True,
+                       threads=threads, **kwargs)
 
         am = matrix_sum/counter_matrix
 
@@ -438,17 +409,79 @@ class AggregateMatrix(FileGroup):
         return aggregate_object
 
 
-def _aggregate_region_bins(hic, region, offset=0):
-    region_slice = hic.region_bins(region)
-    return region_slice.start-offset, region_slice.stop-offset
+def _chromosome_region_bounds(hic, chromosome):
+    """
+    Index of the first region, and start and end coordinates
+    of all regions in a chromosome.
+    """
+    offset = hic.chromosome_bins[chromosome][0]
+    starts, ends = [], []
+    for region in hic.regions(chromosome, lazy=True):
+        starts.append(region.start)
+        ends.append(region.end)
+    return offset, np.array(starts), np.array(ends)
 
 
-def extract_submatrices(matrix, region_pairs, oe=False,
-                        log=True, cache=True, mask_inf=True,
-                        keep_invalid=False, orient_strand=False,
-                        **kwargs):
+def _aggregate_region_bins(region_bounds, region):
+    """
+    Start and end (exclusive) index of the bins overlapping a region.
+
+    :param region_bounds: Output of :func:`_chromosome_region_bounds`
+                          for the region's chromosome
+    """
+    offset, starts, ends = region_bounds
+    start = np.searchsorted(ends, region.start, side='left')
+    end = np.searchsorted(starts, region.end, side='right')
+    return offset + int(start), offset + int(end)
+
+
+def _region_pair_batches(region_pair_bins, max_pixels):
+    """
+    Group region pairs into batches with a bounded bounding box.
+
+    Region pairs are sorted by their row bins, and consecutive
+    pairs are added to a batch as long as the bounding box of all
+    pairs in the batch does not exceed :code:`max_pixels`. A region
+    pair that is larger than :code:`max_pixels` by itself forms its
+    own batch.
+
+    :param region_pair_bins: list of (ix, (row_start, row_end), (col_start, col_end))
+    :param max_pixels: Maximum number of pixels in a batch bounding box
+    :return: iterator over ((row_start, row_end), (col_start, col_end), list of region pair bins)
+    """
+    batch = []
+    rows, cols = None, None
+    for item in sorted(region_pair_bins, key=lambda x: (x[1][0], x[2][0])):
+        _, item_rows, item_cols = item
+        if rows is not None:
+            new_rows = (min(rows[0], item_rows[0]), max(rows[1], item_rows[1]))
+            new_cols = (min(cols[0], item_cols[0]), max(cols[1], item_cols[1]))
+            if (new_rows[1] - new_rows[0]) * (new_cols[1] - new_cols[0]) <= max_pixels:
+                rows, cols = new_rows, new_cols
+                batch.append(item)
+                continue
+            yield rows, cols, batch
+
+        batch = [item]
+        rows, cols = item_rows, item_cols
+
+    if len(batch) > 0:
+        yield rows, cols, batch
+
+
+def _iter_submatrices(matrix, region_pairs, oe=False,
+                      log=True, cache=True, mask_inf=True,
+                      keep_invalid=False, orient_strand=False,
+                      cache_memory=500000000,
+                      **kwargs):
+    """
+    Iterate over sub-matrices for a list of region pairs in the order they are extracted.
+
+    Takes the same arguments as :func:`extract_submatrices`.
+
+    :return: iterator over (index in region_pairs, (region1, region2), sub-matrix) tuples
+    """
     cl = matrix.chromosome_lengths
-    cb = matrix.chromosome_bins
 
     valid_region_pairs = defaultdict(list)
     invalid_region_pairs = list()
@@ -475,74 +508,126 @@ def extract_submatrices(matrix, region_pairs, oe=False,
         logger.debug("Calculating expected values...")
         _, intra_expected, inter_expected = matrix.expected_values()
 
-    order = []
-    matrices = []
-    final_regions = []
+    # float64 value and boolean mask per pixel
+    max_pixels = max(1, int(cache_memory / 9))
+
+    region_bounds = dict()
+    for chromosome1, chromosome2 in valid_region_pairs.keys():
+        for chromosome in (chromosome1, chromosome2):
+            if chromosome not in region_bounds:
+                region_bounds[chromosome] = _chromosome_region_bounds(matrix, chromosome)
+
     with RareUpdateProgressBar(max_value=valid, prefix='Matrices') as pb:
         current_matrix = 0
         for (chromosome1, chromosome2), regions_pairs_by_chromosome in valid_region_pairs.items():
+            pair_regions = dict()
+            region_pair_bins = []
+            for (region_ix, region1, region2) in regions_pairs_by_chromosome:
+                pair_regions[region_ix] = (region1, region2)
+                region_pair_bins.append((region_ix,
+                                         _aggregate_region_bins(region_bounds[chromosome1], region1),
+                                         _aggregate_region_bins(region_bounds[chromosome2], region2)))
+
             if cache:
-                sub_matrix = matrix.matrix((chromosome1, chromosome2), **kwargs)
-                offset1 = cb[chromosome1][0]
-                offset2 = cb[chromosome2][0]
+                batches = _region_pair_batches(region_pair_bins, max_pixels)
             else:
-                sub_matrix = matrix
-                offset1 = 0
-                offset2 = 0
+                batches = ((rows, cols, [(region_ix, rows, cols)])
+                           for region_ix, rows, cols in region_pair_bins)
 
-            for (region_ix, region1, region2) in regions_pairs_by_chromosome:
-                final_regions.append((region1, region2))
-                current_matrix += 1
-                region1_bins = _aggregate_region_bins(matrix, region1, offset1)
-                region2_bins = _aggregate_region_bins(matrix, region2, offset2)
+            chromosome_intra_expected = None
+            if oe and chromosome1 == chromosome2:
+                chromosome_intra_expected = np.asarray(intra_expected[chromosome1])
+
+            for batch_rows, batch_cols, batch in batches:
+                batch_matrix = matrix.matrix((slice(*batch_rows), slice(*batch_cols)), **kwargs)
 
-                if cache:
-                    ms = sub_matrix[region1_bins[0]:region1_bins[1], region2_bins[0]: region2_bins[1]]
+                for region_ix, region1_bins, region2_bins in batch:
+                    current_matrix += 1
+                    region1, region2 = pair_regions[region_ix]
+
+                    ms = batch_matrix[region1_bins[0] - batch_rows[0]:region1_bins[1] - batch_rows[0],
+                                      region2_bins[0] - batch_cols[0]:region2_bins[1] - batch_cols[0]]
                     m = ms.copy()
                     del ms
-                else:
-                    s1 = slice(region1_bins[0], region1_bins[1])
-                    s2 = slice(region2_bins[0], region2_bins[1])
-                    m = matrix.matrix((s1, s2), **kwargs)
-
-                if oe:
-                    e = np.ones(m.shape)
-                    if chromosome1 != chromosome2:
-                        e.fill(inter_expected)
-                    else:
-                        for i, row in enumerate(range(region1_bins[0], region1_bins[1])):
-                            for j, col in enumerate(range(region2_bins[0], region2_bins[1])):
-                                ix = abs(col - row)
-                                e[i, j] = intra_expected[chromosome1][ix]
-
-                    if log:
-                        m = np.log2(m/e)
-                        m[np.isnan(m)] = 0.
-                    else:
-                        m = m/e
-                        m[np.isnan(m)] = 1
-
-                if mask_inf:
-                    m_mask = np.isinf(m)
-                    if not hasattr(m, 'mask'):
-                        m = np.ma.masked_where(m_mask, m)
-                    m.mask += m_mask
-
-                if orient_strand and region1.is_reverse() and region2.is_reverse():
-                    m = np.flip(np.flip(m, 0), 1)
-
-                pb.update(current_matrix)
-                matrices.append(m)
-                order.append(region_ix)
 
-            if cache:
-                del sub_matrix
+                    if oe:
+                        if chromosome1 != chromosome2:
+                            e = np.full(m.shape, inter_expected, dtype=np.float64)
+                        else:
+                            distances = np.abs(np.arange(*region2_bins)[np.newaxis, :] -
+                                               np.arange(*region1_bins)[:, np.newaxis])
+                            e = chromosome_intra_expected[distances]
+
+                        if log:
+                            m = np.log2(m/e)
+                            m[np.isnan(m)] = 0.
+                        else:
+                            m = m/e
+                            m[np.isnan(m)] = 1
+
+                    if mask_inf:
+                        m_mask = np.isinf(m)
+                        if not hasattr(m, 'mask'):
+                            m = np.ma.masked_where(m_mask, m)
+                        m.mask += m_mask
+
+                    if orient_strand and region1.is_reverse() and region2.is_reverse():
+                        m = np.flip(np.flip(m, 0), 1)
+
+                    pb.update(current_matrix)
+                    yield region_ix, (region1, region2), m
+
+                del batch_matrix
 
     if keep_invalid:
         for region_ix, r1, r2 in invalid_region_pairs:
-            matrices.append(None)
-            order.append(region_ix)
-            final_regions.append((r1, r2))
+            yield region_ix, (r1, r2), None
+
+
+def extract_submatrices(matrix, region_pairs, oe=False,
+                        log=True, cache=True, mask_inf=True,
+                        keep_invalid=False, orient_strand=False,
+                        cache_memory=500000000,
+                        **kwargs):
+    """
+    Extract sub-matrices for a list of region pairs.
+
+    If :code:`cache` is True (default), region pairs are grouped by chromosome
+    pair, sorted by position, and extracted in batches: the matrix covering
+    the bounding box of all pairs in a batch is loaded at once and the
+    sub-matrices are sliced from it. The size of each batch matrix is
+    limited by :code:`cache_memory`, so memory usage does not depend
+    on chromosome size.
+
+    :param matrix: :class:`~fanc.matrix.RegionMatrixContainer`
+    :param region_pairs: list of (:class:`~genomic_regions.GenomicRegion`,
+                         :class:`~genomic_regions.GenomicRegion`) tuples
+    :param oe: If True, divide sub-matrices by their expected values
+    :param log: If True (default), log2-transform O/E sub-matrices
+    :param cache: If True (default), extract sub-matrices in batches.
+                  Otherwise extract each sub-matrix separately
+    :param mask_inf: If True (default), mask infinite values
+    :param keep_invalid: If True, return None for region pairs outside
+                         the matrix
+    :param orient_strand: If True, flip sub-matrices where both regions
+                          are on the reverse strand
+    :param cache_memory: Approximate maximum size (in bytes) of the matrix
+                         loaded for a batch of region pairs
+    :param kwargs: Keyword arguments passed to
+                   :func:`~fanc.matrix.RegionMatrixContainer.matrix`
+    :return: iterator over ((region1, region2), sub-matrix) tuples,
+             in the order of region_pairs
+    """
+    order = []
+    final_regions = []
+    matrices = []
+    for region_ix, pair, m in _iter_submatrices(matrix, region_pairs, oe=oe, log=log, cache=cache,
+                                                mask_inf=mask_inf, keep_invalid=keep_invalid,
+                                                orient_strand=orient_strand,
+                                                cache_memory=cache_memory, **kwargs):
+        order.append(region_ix)
+        final_regions.append(pair)
+        matrices.append(m)
 
     final_regions = [final_regions[ix] for ix in np.argsort(order)]
     matrices = [matrices[ix] for ix in np.argsort(order)]
@@ -550,6 +635,218 @@ def extract_submatrices(matrix, region_pairs, oe=False,
     return zip(final_regions, matrices)
 
 
+def _center_component(m):
+    """
+    Sub-matrix and pixel counts added to an aggregate matrix by
+    :func:`AggregateMatrix.from_center`.
+    """
+    if hasattr(m, 'mask'):
+        return m, (~m.mask).astype('int')
+    return m, np.ones(m.shape)
+
+
+def _center_pairs_component(m, shape):
+    """
+    Sub-matrix and pixel counts added to an aggregate matrix by
+    :func:`AggregateMatrix.from_center_pairs`.
+    """
+    if hasattr(m, 'mask'):
+        return m, (~m.mask).astype('int')
+    return m, np.ones(shape)
+
+
+def _regions_component(m, shape, boundary_mode='reflect', anti_aliasing=True,
+                       interpolation=0, keep_mask=True):
+    """
+    Interpolated sub-matrix and pixel counts added to an aggregate matrix by
+    :func:`AggregateMatrix.from_regions`.
+    """
+    if m is None:
+        return None, None
+
+    ms = resize(m, shape, mode=boundary_mode, anti_aliasing=anti_aliasing,
+                preserve_range=False, clip=False, order=interpolation)
+
+    if keep_mask and hasattr(ms, 'mask'):
+        mask = resize(m.mask, shape, mode=boundary_mode, anti_aliasing=anti_aliasing,
+                      preserve_range=False, clip=False, order=interpolation).astype('bool')
+        ms = np.ma.masked_where(mask, ms)
+        return ms, (~mask).astype('int')
+    return ms, np.ones(shape)
+
+
+def _aggregate_submatrices(submatrices, component_function, component_kwargs=None,
+                           shape=None, keep_components=True, skip_invalid=False):
+    """
+    Sum up sub-matrices and their pixel counts.
+
+    Sub-matrices are only kept in memory if :code:`keep_components` is True,
+    otherwise memory usage is constant in the number of sub-matrices.
+
+    :param submatrices: iterator over (index, (region1, region2), sub-matrix) tuples
+    :param component_function: Function returning the matrix and pixel counts
+                               to add to the aggregate for a sub-matrix, or
+                               (None, None) if it should not be added
+    :param component_kwargs: Keyword arguments passed to component_function
+    :param shape: Shape of the aggregate matrix. If None, use the
+                  shape of the first sub-matrix
+    :param keep_components: If True, return all sub-matrices
+    :param skip_invalid: If True, skip sub-matrices that do not match the
+                         aggregate matrix shape with a warning
+    :return: matrix sum, pixel counts, list of indexes, list of region pairs,
+             list of sub-matrices
+    """
+    if component_kwargs is None:
+        component_kwargs = dict()
+
+    matrix_sum, counter_matrix = None, None
+    if shape is not None:
+        matrix_sum, counter_matrix = np.zeros(shape), np.zeros(shape)
+
+    ixs, component_regions, component_matrices = [], [], []
+    for region_ix, (r1, r2), m in submatrices:
+        ms, counts = component_function(m, **component_kwargs)
+        if ms is not None:
+            if matrix_sum is None:
+                matrix_sum, counter_matrix = np.zeros(ms.shape), np.zeros(ms.shape)
+
+            try:
+                counter_matrix += counts
+                matrix_sum += ms
+            except ValueError:
+                if not skip_invalid:
+                    raise
+                warnings.warn("Regions {} vs {} did not produce a valid matrix for aggregation!"
+                              .format(r1, r2))
+                continue
+
+        ixs.append(region_ix)
+        component_regions.append((r1, r2))
+        if keep_components:
+            component_matrices.append(m)
+
+    return matrix_sum, counter_matrix, ixs, component_regions, component_matrices
+
+
+def _aggregate_worker(hic_file, qin, qout, component_function, component_kwargs,
+                      shape, keep_components, skip_invalid, kwargs):
+    hic = None
+    try:
+        # every worker reads from its own file handle
+        release_inherited_pytables_file(hic_file)
+        hic = load(hic_file, mode='r')
+        while True:
+            item = qin.get()
+            if item is None:
+                logger.debug("Received stop signal, worker terminating.")
+                break
+
+            region_ixs, region_pairs = item
+            submatrices = ((region_ixs[ix], pair, m)
+                           for ix, pair, m in _iter_submatrices(hic, region_pairs, **kwargs))
+            matrix_sum, counter_matrix, ixs, component_regions, component_matrices = \
+                _aggregate_submatrices(submatrices, component_function,
+                                       component_kwargs=component_kwargs, shape=shape,
+                                       keep_components=keep_components,
+                                       skip_invalid=skip_invalid)
+            # RegionMatrix objects cannot be sent between processes
+            component_matrices = [m if m is None else
+                                  np.ma.masked_array(np.array(m), mask=np.ma.getmaskarray(m))
+                                  for m in component_matrices]
+            qout.put((matrix_sum, counter_matrix, ixs, component_regions, component_matrices))
+    except Exception as e:
+        qout.put(e)
+    finally:
+        if hic is not None:
+            hic.close()
+
+
+def _aggregate(hic, region_pairs, component_function, component_kwargs=None,
+               shape=None, keep_components=True, skip_invalid=False,
+               threads=1, **kwargs):
+    """
+    Extract and sum up sub-matrices for the aggregate matrix constructors.
+
+    With more than one thread, region pairs are split by chromosome and
+    processed in worker processes, each of which returns the partial sums
+    and pixel counts of its region pairs.
+
+    :return: matrix sum, pixel counts, list of region pairs and list of
+             sub-matrices (empty if keep_components is False), in the
+             order of region_pairs
+    """
+    hic_file = None
+    if threads > 1:
+        try:
+            if hic.file.params['DRIVER'] != 'H5FD_CORE':
+                hic_file = hic.file.filename
+        except AttributeError:
+            pass
+
+        if hic_file is None:
+            logger.warning("Matrix is not stored in a file, "
+                           "aggregating submatrices in a single process")
+
+    if hic_file is None:
+        partials = [_aggregate_submatrices(_iter_submatrices(hic, region_pairs, **kwargs),
+                                           component_function,
+                                           component_kwargs=component_kwargs, shape=shape,
+                                           keep_components=keep_components,
+                                           skip_invalid=skip_invalid)]
+    else:
+        chromosome_region_pairs = defaultdict(lambda: ([], []))
+        for ix, (r1, r2) in enumerate(region_pairs):
+            region_ixs, pairs = chromosome_region_pairs[r1.chromosome if r1 is not None else None]
+            region_ixs.append(ix)
+            pairs.append((r1, r2))
+
+        m = mp.Manager()
+        qin = m.Queue()
+        qout = m.Queue()
+
+        partials = []
+        pool = None
+        try:
+            pool = mp.Pool(threads, _aggregate_worker,
+                           (hic_file, qin, qout, component_function, component_kwargs,
+                            shape, keep_components, skip_invalid, kwargs))
+
+            for item in chromosome_region_pairs.values():
+                qin.put(item)
+
+            for _ in chromosome_region_pairs:
+                out = qout.get(block=True)
+                if isinstance(out, Exception):
+                    raise out
+                partials.append(out)
+        finally:
+            for _ in range(threads):
+                qin.put(None)
+
+            if pool is not None:
+                pool.terminate()
+
+    matrix_sum, counter_matrix = None, None
+    ixs, component_regions, component_matrices = [], [], []
+    for partial_sum, partial_counts, partial_ixs, partial_regions, partial_matrices in partials:
+        if partial_sum is not None:
+            if matrix_sum is None:
+                matrix_sum, counter_matrix = partial_sum, partial_counts
+            else:
+                matrix_sum += partial_sum
+                counter_matrix += partial_counts
+        ixs += partial_ixs
+        component_regions += partial_regions
+        component_matrices += partial_matrices
+
+    order = np.argsort(ixs, kind='stable')
+    component_regions = [component_regions[ix] for ix in order]
+    if keep_components:
+        component_matrices = [component_matrices[ix] for ix in order]
+
+    return matrix_sum, counter_matrix, component_regions, component_matrices
+
+
 def _rescale_oe_matrix(matrix, bin_size, scaling_exponent=-0.25):
     rm = np.zeros(matrix.shape)
     b = bin_size
@@ -605,11 +902,17 @@ def aggregate_boundaries(hic, boundary_regions, window=200000,
     return am
 
 
-def _tad_matrix_iterator(hic, tad_regions, absolute_extension=0, relative_extension=1., **kwargs):
+def _tad_region_pairs(tad_regions, absolute_extension=0, relative_extension=1.):
     region_pairs = []
     for region in tad_regions:
         new_region = region.expand(absolute=absolute_extension, relative=relative_extension)
         region_pairs.append((new_region, new_region))
+    return region_pairs
+
+
+def _tad_matrix_iterator(hic, tad_regions, absolute_extension=0, relative_extension=1., **kwargs):
+    region_pairs = _tad_region_pairs(tad_regions, absolute_extension=absolute_extension,
+                                     relative_extension=relative_extension)
 
     for pair, m in extract_submatrices(hic, region_pairs, **kwargs):
         yield pair, m
@@ -707,8 +1010,7 @@ def _loop_regions_from_bedpe(bedpe):
     return anchors
 
 
-def _loop_matrix_iterator(hic, loop_regions, pixels=16,
-                          region_viewpoint='center', **kwargs):
+def _loop_region_pairs(hic, loop_regions, pixels=16, region_viewpoint='center'):
     left = int(pixels / 2)
     right = left if pixels % 2 == 1 else left - 1
 
@@ -716,19 +1018,29 @@ def _loop_matrix_iterator(hic, loop_regions, pixels=16,
         loop_regions = _loop_regions_from_bedpe(loop_regions)
 
     bin_size = hic.bin_size
+    chromosomes = set(hic.chromosomes())
+    region_bounds = dict()
+
+    def _viewpoint_region(anchor):
+        if anchor.chromosome not in chromosomes:
+            raise IndexError("Chromosome {} not in matrix".format(anchor.chromosome))
+        if anchor.chromosome not in region_bounds:
+            region_bounds[anchor.chromosome] = _chromosome_region_bounds(hic, anchor.chromosome)
+        offset, starts, ends = region_bounds[anchor.chromosome]
+
+        # first region overlapping the viewpoint
+        position = int(getattr(anchor, region_viewpoint))
+        ix = np.searchsorted(ends, position, side='left')
+        if ix >= len(starts) or starts[ix] > position:
+            raise IndexError("No region at {}:{}".format(anchor.chromosome, position))
+        return hic.regions[offset + int(ix)].copy()
+
     region_pairs = []
     invalid = 0
     for (anchor1, anchor2) in loop_regions:
-        a1 = GenomicRegion(chromosome=anchor1.chromosome,
-                           start=getattr(anchor1, region_viewpoint),
-                           end=getattr(anchor1, region_viewpoint))
-        a2 = GenomicRegion(chromosome=anchor2.chromosome,
-                           start=getattr(anchor2, region_viewpoint),
-                           end=getattr(anchor2, region_viewpoint))
-
         try:
-            r1 = list(hic.regions(a1))[0].copy()
-            r2 = list(hic.regions(a2))[0].copy()
+            r1 = _viewpoint_region(anchor1)
+            r2 = _viewpoint_region(anchor2)
             r1.start -= left * bin_size
             r1.end += right * bin_size
             r2.start -= left * bin_size
@@ -741,6 +1053,14 @@ def _loop_matrix_iterator(hic, loop_regions, pixels=16,
     if invalid > 0:
         logger.warning("{} region pairs invalid, most likely due to missing chromosome data".format(invalid))
 
+    return region_pairs
+
+
+def _loop_matrix_iterator(hic, loop_regions, pixels=16,
+                          region_viewpoint='center', **kwargs):
+    region_pairs = _loop_region_pairs(hic, loop_regions, pixels=pixels,
+                                      region_viewpoint=region_viewpoint)
+
     for pair, m in extract_submatrices(hic, region_pairs, **kwargs):
         yield pair, m
 
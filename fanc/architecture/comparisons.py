@@ -33,15 +33,7 @@ def _edge_collection(*hics, region=None, scale=True,
     if filters is None:
         filters = []
 
-    scaling_factors = [1.0] * len(hics)
-    if scale:
-        reference_hic = None
-        for i, hic in enumerate(hics):
-            if i == 0:
-                reference_hic = hic
-            else:
-                s = hic.scaling_factor(reference_hic)
-                scaling_factors[i] = s
+    scaling_factors = _scaling_factors(hics, scale=scale)
 
     total_edges = sum(len(hic.edges) for hic in hics)
 
@@ -80,6 +72,176 @@ def _edge_collection(*hics, region=None, scale=True,
     return edges
 
 
+def _scaling_factors(hics, scale=True):
+    """
+    Factors to scale each matrix to the number of valid pairs in the first one.
+    """
+    scaling_factors = [1.0] * len(hics)
+    if scale:
+        for i in range(1, len(hics)):
+            scaling_factors[i] = hics[i].scaling_factor(hics[0])
+    return scaling_factors
+
+
+def _edge_row_blocks(hics, row_range, col_range, chunk_size, **kwargs):
+    """
+    Split the rows of a matrix section into blocks of at most
+    (roughly) :code:`chunk_size` edges across all matrices.
+
+    Every edge is assigned to its source row, or to its sink row
+    if the source lies before the section (only possible if the columns
+    extend to the left of the rows). The number of edges per row is
+    counted in a first pass over the columnar edge chunks. Matrices
+    without columnar chunk access are not split.
+
+    :param hics: list of matrix objects
+    :param row_range: (start, end) bin indexes of the section rows
+    :param col_range: (start, end) bin indexes of the section columns
+    :param chunk_size: Approximate maximum number of edges per block
+    :param kwargs: Keyword arguments passed to :code:`edges_array`
+    :return: list of (start, end) row index tuples
+    """
+    row_start, row_end = row_range
+    key = (slice(row_start, row_end), slice(*col_range))
+    kwargs.pop('norm', None)
+
+    counts = np.zeros(row_end - row_start, dtype=np.int64)
+    for hic in hics:
+        try:
+            chunks = hic._edges_array_chunks(key, norm=False, fields=[], **kwargs)
+        except AttributeError:
+            return [(row_start, row_end)]
+
+        for columns in chunks:
+            sources, sinks = columns['source'], columns['sink']
+            rows = np.where(sources >= row_start, sources, sinks)
+            rows = rows[np.logical_and(rows >= row_start, rows < row_end)]
+            counts += np.bincount(rows - row_start, minlength=len(counts))
+
+    blocks = []
+    block_start, block_count = row_start, 0
+    for i, count in enumerate(counts):
+        if block_count > 0 and block_count + count > chunk_size:
+            blocks.append((block_start, row_start + i))
+            block_start, block_count = row_start + i, 0
+        block_count += count
+    blocks.append((block_start, row_end))
+    return blocks
+
+
+def _block_edges(hic, row_block, row_range, col_range, **kwargs):
+    """
+    Sorted edge keys (source * n_regions + sink) and weights of all edges
+    assigned to a row block (see :func:`~_edge_row_blocks`).
+    """
+    edges = hic.edges_array((slice(*row_block), slice(*col_range)), as_dict=True, **kwargs)
+    sources, sinks = edges['source'], edges['sink']
+    weights = edges[hic._default_score_field]
+
+    in_block = np.logical_and(sources >= row_block[0], sources < row_block[1])
+    in_block |= np.logical_and(np.logical_and(sinks >= row_block[0], sinks < row_block[1]),
+                               sources < row_range[0])
+    keys = sources[in_block] * len(hic.regions) + sinks[in_block]
+    weights = weights[in_block]
+
+    order = np.argsort(keys, kind='stable')
+    return keys[order], weights[order]
+
+
+def _aligned_edge_chunks(hics, row_range, col_range, default_values=None,
+                         chunk_size=5000000, **kwargs):
+    """
+    Iterate over the edges of a matrix section in several matrices at once.
+
+    Edges are read in blocks of rows, so only about :code:`chunk_size`
+    edges (across all matrices) are held in memory at any time. If the
+    columns extend to the left of the rows, edges with a sink (instead
+    of a source) in the rows are also returned, so that
+    :code:`row_range=(a, b), col_range=(0, n_regions)` returns all edges
+    touching bins a to b - 1, like :code:`hic.edges(region)`.
+
+    :param hics: list of matrix objects with identical regions
+    :param row_range: (start, end) bin indexes of the section rows
+    :param col_range: (start, end) bin indexes of the section columns
+    :param default_values: Weight per matrix for edges missing in that matrix.
+                           Default: 0 for all matrices
+    :param chunk_size: Approximate maximum number of edges per chunk
+    :param kwargs: Keyword arguments passed to :code:`edges_array`
+    :return: iterator over (sources, sinks, weights) tuples, where weights
+             is an (n_edges x n_matrices) array
+    """
+    if default_values is None:
+        default_values = [0] * len(hics)
+
+    n_regions = len(hics[0].regions)
+    for row_block in _edge_row_blocks(hics, row_range, col_range, chunk_size, **kwargs):
+        block_edges = [_block_edges(hic, row_block, row_range, col_range, **kwargs)
+                       for hic in hics]
+
+        keys = block_edges[0][0]
+        for hic_keys, _ in block_edges[1:]:
+            keys = np.union1d(keys, hic_keys)
+
+        weights = np.empty((len(keys), len(hics)), dtype=np.float64)
+        for i, (hic_keys, hic_weights) in enumerate(block_edges):
+            weights[:, i] = default_values[i]
+            weights[np.searchsorted(keys, hic_keys), i] = hic_weights
+
+        yield keys // n_regions, keys % n_regions, weights
+
+
+def _edge_collection_chunks(*hics, region=None, scale=True, filters=None,
+                            chunk_size=5000000, **kwargs):
+    """
+    Iterate over weights from the same edges across different Hi-C matrices
+    in chunks.
+
+    Chunked version of :func:`~_edge_collection`, which only ever holds
+    about :code:`chunk_size` edges in memory.
+
+    :param hics: Hic/matrix objects or list of Hic/Matrix objects
+    :param region: Optional region subset (e.g. a single chromosome)
+    :param scale: True if Hic matrices should be scaled to the
+                  number of valid pairs
+    :param filters: List of :class:`~EdgeCollectionFilter`
+    :param chunk_size: Approximate maximum number of edges per chunk
+    :return: iterator over (sources, sinks, weights) tuples, where weights
+             is an (n_edges x n_matrices) array
+    """
+    if len(hics) == 1:
+        hics = hics[0]
+
+    if filters is None:
+        filters = []
+
+    scaling_factors = np.array(_scaling_factors(hics, scale=scale))
+
+    n_regions = len(hics[0].regions)
+    if region is None:
+        sections = [(bins, (bins[0], n_regions)) for bins in hics[0].chromosome_bins.values()]
+    else:
+        bins = hics[0].region_bins(region)
+        sections = [((bins.start, bins.stop), (0, n_regions))]
+
+    before_filtering, after_filtering = 0, 0
+    with RareUpdateProgressBar(max_value=len(sections), prefix='Edge collection') as pb:
+        for i, (row_range, col_range) in enumerate(sections):
+            for sources, sinks, weights in _aligned_edge_chunks(hics, row_range, col_range,
+                                                                chunk_size=chunk_size, **kwargs):
+                weights *= scaling_factors
+                before_filtering += len(sources)
+
+                for f in filters:
+                    is_valid = f.valid_array(sources, sinks, weights)
+                    sources, sinks, weights = sources[is_valid], sinks[is_valid], weights[is_valid]
+                after_filtering += len(sources)
+
+                yield sources, sinks, weights
+            pb.update(i + 1)
+
+    logger.info("Valid edges: {}/{}".format(after_filtering, before_filtering))
+
+
 class EdgeCollectionFilter(object):
     def __init__(self):
         pass
@@ -88,6 +250,19 @@ class EdgeCollectionFilter(object):
         raise NotImplementedError("Subclasses of EdgeCollectionFilter must implement "
                                   "'valid'!")
 
+    def valid_array(self, sources, sinks, weights):
+        """
+        Vectorised version of :func:`~EdgeCollectionFilter.valid`.
+
+        :param sources: array of source region indexes
+        :param sinks: array of sink region indexes
+        :param weights: (n_edges x n_matrices) array of edge weights
+        :return: boolean array, True for valid edges
+        """
+        return np.array([self.valid(source, sink, edge_weights)
+                         for source, sink, edge_weights in zip(sources, sinks, weights)],
+                        dtype=bool)
+
 
 class ObservedExpectedFilter(EdgeCollectionFilter):
     def __init__(self, hics, fold_change_cutoff=1.0, min_valid_edges=1,
@@ -111,6 +286,11 @@ class ObservedExpectedFilter(EdgeCollectionFilter):
         for region in hics[0].regions:
             self._chromosome_dict[region.ix] = region.chromosome
 
+        self._chromosomes = hics[0].chromosomes()
+        chromosome_ixs = {chromosome: i for i, chromosome in enumerate(self._chromosomes)}
+        self._chromosome_ixs = np.array([chromosome_ixs[self._chromosome_dict[i]]
+                                         for i in range(len(self._chromosome_dict))])
+
     def valid(self, source, sink, weights):
         source_chromosome = self._chromosome_dict[source]
         sink_chromosome = self._chromosome_dict[sink]
@@ -134,6 +314,28 @@ class ObservedExpectedFilter(EdgeCollectionFilter):
             return True
         return False
 
+    def valid_array(self, sources, sinks, weights):
+        source_chromosomes = self._chromosome_ixs[sources]
+        is_intra = source_chromosomes == self._chromosome_ixs[sinks]
+        d = np.abs(sinks - sources)
+
+        count_valid = np.zeros(len(sources), dtype=np.int64)
+        for i in range(weights.shape[1]):
+            e = np.full(len(sources), self._inter_expected[i], dtype=np.float64)
+            if self._oe_per_chromosome:
+                for chromosome_ix, chromosome in enumerate(self._chromosomes):
+                    is_chromosome = np.logical_and(is_intra, source_chromosomes == chromosome_ix)
+                    expected = np.asarray(self._intra_expected_chromosome[i][chromosome])
+                    e[is_chromosome] = expected[d[is_chromosome]]
+            else:
+                e[is_intra] = np.asarray(self._intra_expected[i])[d[is_intra]]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fc = weights[:, i] / e
+            count_valid += np.logical_and(np.isfinite(fc), fc > self._cutoff)
+
+        return count_valid > self._min_valid
+
 
 class NonzeroFilter(EdgeCollectionFilter):
     def __init__(self):
@@ -144,6 +346,9 @@ class NonzeroFilter(EdgeCollectionFilter):
             return False
         return True
 
+    def valid_array(self, sources, sinks, weights):
+        return np.all(weights != 0, axis=1)
+
 
 class AbsoluteWeightFilter(EdgeCollectionFilter):
     def __init__(self, cutoff, min_above_cutoff=1):
@@ -162,6 +367,9 @@ class AbsoluteWeightFilter(EdgeCollectionFilter):
             return False
         return True
 
+    def valid_array(self, sources, sinks, weights):
+        return np.sum(weights >= self.cutoff, axis=1) >= self._min_valid
+
 
 class MinMaxDistanceFilter(EdgeCollectionFilter):
     def __init__(self, hics, min_distance=None, max_distance=None):
@@ -185,6 +393,15 @@ class MinMaxDistanceFilter(EdgeCollectionFilter):
             return False
         return True
 
+    def valid_array(self, sources, sinks, weights):
+        d = np.abs(sinks - sources)
+        is_valid = np.ones(len(sources), dtype=bool)
+        if self.min_distance is not None:
+            is_valid &= d >= self.min_distance
+        if self.max_distance is not None:
+            is_valid &= d <= self.max_distance
+        return is_valid
+
 
 class ComparisonMatrix(RegionMatrixTable):
 
@@ -197,9 +414,9 @@ class ComparisonMatrix(RegionMatrixTable):
         """
         Compare two edge weights.
 
-        :param weight1: float
-        :param weight2: float
-        :return: float
+        :param weight1: float or numpy array
+        :param weight2: float or numpy array
+        :return: float or numpy array
         """
         raise NotImplementedError("Subclasses of ComparisonMatrix must implement "
                                   "'compare'")
@@ -207,66 +424,87 @@ class ComparisonMatrix(RegionMatrixTable):
     @classmethod
     def from_matrices(cls, matrix1, matrix2, file_name=None, tmpdir=None,
                       log_cmp=False, ignore_infinite=True, ignore_zeros=False,
-                      scale=True, **kwargs):
-        kwargs['lazy'] = True
+                      scale=True, chunk_size=5000000, **kwargs):
+        """
+        Compare two matrices edge by edge.
+
+        Edges of both matrices are read in blocks of rows (per chromosome
+        pair), matched by their (source, sink) key, and compared in vectorised
+        form using :func:`~ComparisonMatrix.compare`. Edges missing in one
+        of the matrices get that matrix' default value. Memory usage is
+        bounded by the number of edges per block, not by the matrix size.
+
+        :param matrix1: First matrix, e.g. :class:`~fanc.hic.Hic`
+        :param matrix2: Second matrix, e.g. :class:`~fanc.hic.Hic`
+        :param file_name: Path to output file
+        :param tmpdir: Optional temporary directory to work in
+        :param log_cmp: If True, log2-transform comparison results
+        :param ignore_infinite: If True (default), do not store
+                                infinite or NaN comparison results
+        :param ignore_zeros: If True, do not compare edges where one of
+                             the weights is 0
+        :param scale: If True (default), scale matrix2 weights to the
+                      total number of contacts in matrix1
+        :param chunk_size: Approximate maximum number of edges (across both
+                           matrices) compared at once
+        :param kwargs: Keyword arguments passed to
+                       :func:`~fanc.matrix.RegionPairsContainer.edges_array`,
+                       e.g. :code:`norm`
+        :return: comparison matrix
+        """
+        # edges are always compared as they are stored (optionally normalised),
+        # O/E and log matrix options only affect the scaling factor
+        for key in ('lazy', 'mode', 'log'):
+            kwargs.pop(key, None)
+        oe = kwargs.pop('oe', False)
 
         comparison_matrix = cls(file_name=file_name, mode='w', tmpdir=tmpdir)
         comparison_matrix.add_regions(matrix1.regions, preserve_attributes=False)
 
         sf = 1.0
         if scale:
-            if kwargs.get('oe', False):
+            if oe:
                 logger.warning('Not computing scaling factor due to O/E conversion.')
             else:
                 sf = matrix2.scaling_factor(matrix1)
 
         compare = comparison_matrix.compare
         chromosomes = matrix1.chromosomes()
+        chromosome_bins = matrix1.chromosome_bins
         n_chromosome_pairs = int(np.round(len(chromosomes)**2/2 + len(chromosomes)/2))
         current_chromosome_pair = 0
         with RareUpdateProgressBar(max_value=n_chromosome_pairs, prefix='Compare') as pb:
             for chr_i in range(len(chromosomes)):
                 chromosome1 = chromosomes[chr_i]
+                row_range = chromosome_bins[chromosome1]
                 for chr_j in range(chr_i, len(chromosomes)):
                     chromosome2 = chromosomes[chr_j]
-
-                    edges1 = dict()
-                    for edge in matrix1.edges((chromosome1, chromosome2), **kwargs):
-                        edges1[(edge.source, edge.sink)] = edge.weight
-
-                    edges2 = dict()
-                    for edge in matrix2.edges((chromosome1, chromosome2), **kwargs):
-                        edges2[(edge.source, edge.sink)] = edge.weight * sf
-
-                    for key, w1 in edges1.items():
-                        try:
-                            w2 = edges2[key]
-                        except KeyError:
-                            w2 = matrix2._default_value
-
-                        if ignore_zeros and (w1 == 0 or w2 == 0):
-                            continue
-                        weight = compare(w1, w2)
-                        if log_cmp:
-                            weight = np.log2(weight)
-                        if ignore_infinite and not np.isfinite(weight):
-                            continue
-
-                        comparison_matrix.add_edge_simple(key[0], key[1], weight=weight)
-
-                    for key, w2 in edges2.items():
-                        if key not in edges1:
-                            w1 = matrix1._default_value
-
-                            if ignore_zeros and (w1 == 0 or w2 == 0):
-                                continue
-                            weight = compare(w1, w2)
+                    col_range = chromosome_bins[chromosome2]
+
+                    default_values = [matrix1._default_value, matrix2._default_value]
+                    for sources, sinks, weights in _aligned_edge_chunks((matrix1, matrix2),
+                                                                        row_range, col_range,
+                                                                        default_values=default_values,
+                                                                        chunk_size=chunk_size,
+                                                                        **kwargs):
+                        w1 = weights[:, 0]
+                        w2 = weights[:, 1] * sf
+
+                        keep = np.ones(len(sources), dtype=bool)
+                        if ignore_zeros:
+                            keep = np.logical_and(w1 != 0, w2 != 0)
+
+                        with np.errstate(divide='ignore', invalid='ignore'):
+                            weights = np.asarray(compare(w1[keep], w2[keep]), dtype=np.float64)
                             if log_cmp:
-                                weight = np.log2(weight)
-                            if ignore_infinite and not np.isfinite(weight):
-                                continue
+                                weights = np.log2(weights)
+                        sources, sinks = sources[keep], sinks[keep]
 
-                            comparison_matrix.add_edge_simple(key[0], key[1], weight=weight)
+                        if ignore_infinite:
+                            is_finite = np.isfinite(weights)
+                            sources, sinks, weights = sources[is_finite], sinks[is_finite], weights[is_finite]
+
+                        comparison_matrix.add_edges_simple(sources, sinks, weights=weights)
 
                     current_chromosome_pair += 1
                     pb.update(current_chromosome_pair)
@@ -283,10 +521,8 @@ class FoldChangeMatrix(ComparisonMatrix):
         ComparisonMatrix.__init__(self, *args, **kwargs)
 
     def compare(self, weight1, weight2):
-        try:
-            return weight1 / weight2
-        except ZeroDivisionError:
-            return np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.true_divide(weight1, weight2)
 
 
 class DifferenceMatrix(ComparisonMatrix):
@@ -504,6 +740,52 @@ class EdgeCollectionSelector(object):
         raise NotImplementedError("Subclasses of EdgeCollectionSelector must implement "
                                   "filter_edge_collection!")
 
+    def scores(self, weights):
+        """
+        Selection score of each edge, edges with larger scores are selected first.
+
+        :param weights: (n_edges x n_matrices) array of edge weights
+        :return: array of scores, edges with non-finite scores are never selected
+        """
+        raise NotImplementedError("Subclasses of EdgeCollectionSelector must implement "
+                                  "scores!")
+
+    def filter_edge_chunks(self, edge_chunks, sample_size):
+        """
+        Select the :code:`sample_size` edges with the largest scores from a
+        stream of edge chunks.
+
+        Only the current best edges and a single chunk are kept in memory.
+
+        :param edge_chunks: iterator over (sources, sinks, weights) tuples,
+                            e.g. from :func:`~_edge_collection_chunks`
+        :param sample_size: Maximum number of selected edges
+        :return: (n_selected x n_matrices) array of edge weights, sorted
+                 by decreasing score
+        """
+        selected_scores = None
+        selected_weights = None
+        for _, _, weights in edge_chunks:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scores = self.scores(weights)
+            is_finite = np.isfinite(scores)
+            scores, weights = scores[is_finite], weights[is_finite]
+
+            if selected_scores is not None:
+                scores = np.concatenate([selected_scores, scores])
+                weights = np.concatenate([selected_weights, weights])
+
+            if len(scores) > sample_size:
+                ix = np.argpartition(-scores, sample_size - 1)[:sample_size]
+                scores, weights = scores[ix], weights[ix]
+            selected_scores, selected_weights = scores, weights
+
+        if selected_scores is None:
+            return np.zeros((0, 0))
+
+        order = np.argsort(-selected_scores, kind='stable')
+        return selected_weights[order]
+
 
 class LargestVarianceSelector(EdgeCollectionSelector):
     def __init__(self):
@@ -526,6 +808,9 @@ class LargestVarianceSelector(EdgeCollectionSelector):
             weights = edge_collection[(source, sink)]
             yield source, sink, weights
 
+    def scores(self, weights):
+        return np.nanvar(weights, axis=1)
+
 
 class PassthroughSelector(EdgeCollectionSelector):
     def __init__(self):
@@ -540,6 +825,22 @@ class PassthroughSelector(EdgeCollectionSelector):
                 break
             yield key[0], key[1], weights
 
+    def scores(self, weights):
+        return np.zeros(len(weights))
+
+    def filter_edge_chunks(self, edge_chunks, sample_size):
+        selected_weights = []
+        n_selected = 0
+        for _, _, weights in edge_chunks:
+            selected_weights.append(weights[:sample_size - n_selected])
+            n_selected += len(selected_weights[-1])
+            if n_selected >= sample_size:
+                break
+
+        if len(selected_weights) == 0:
+            return np.zeros((0, 0))
+        return np.concatenate(selected_weights)
+
 
 class LargestFoldChangeSelector(EdgeCollectionSelector):
     def __init__(self):
@@ -565,12 +866,83 @@ class LargestFoldChangeSelector(EdgeCollectionSelector):
             weights = edge_collection[(source, sink)]
             yield source, sink, weights
 
+    def scores(self, weights):
+        return np.nanmax(weights, axis=1) / np.nanmin(weights, axis=1)
+
+
+def _gram_pca(edge_chunks, selector=None, log=False):
+    """
+    PCA of samples over all edges, without holding all edges in memory.
+
+    The (n_samples x n_samples) Gram matrix of the centered sample
+    vectors is accumulated chunk by chunk. Its eigendecomposition yields
+    the sample coordinates, which are passed through a regular PCA so
+    that the result is identical (up to sign) to a PCA on all edges.
+    Note that :code:`components_` of the returned PCA refers to these
+    coordinates, not to individual edges.
+
+    :param edge_chunks: iterator over (sources, sinks, weights) tuples,
+                        e.g. from :func:`~_edge_collection_chunks`
+    :param selector: Optional :class:`~EdgeCollectionSelector`, edges
+                     with non-finite selection scores are ignored
+    :param log: If True, log-transform weights
+    :return: tuple (:class:`~sklearn.decomposition.PCA`, transformed samples)
+    """
+    gram = None
+    for _, _, weights in edge_chunks:
+        if selector is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weights = weights[np.isfinite(selector.scores(weights))]
+        if log:
+            weights = np.log(weights)
+        weights = weights - weights.mean(axis=1)[:, None]
+        chunk_gram = weights.T.dot(weights)
+        gram = chunk_gram if gram is None else gram + chunk_gram
+
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    coordinates = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+    pca = PCA()
+    pca_res = pca.fit_transform(coordinates[:, ::-1])
+    return pca, pca_res
+
 
 def hic_pca(*hics, sample_size=None, region=None, strategy='variance', scale=True, log=False,
             ignore_zeros=False, oe_enrichment=None, min_distance=None, max_distance=None,
             background_ligation=False, min_libraries_above_background=1,
-            **kwargs):
+            out_of_core=False, chunk_size=5000000, **kwargs):
+    """
+    PCA of Hi-C matrices, using their edge weights as features.
 
+    :param hics: Hic/matrix objects
+    :param sample_size: Number of edges to use for the PCA, selected according to
+                        :code:`strategy`. Default: all edges
+    :param region: Optional region subset (e.g. a single chromosome)
+    :param strategy: Edge selection strategy: "variance" (largest variance across
+                     samples first), "fold-change" (largest fold-change across
+                     samples first), or "passthrough"
+    :param scale: If True (default), scale matrices to the number of valid pairs
+                  in the first matrix
+    :param log: If True, log-transform edge weights
+    :param ignore_zeros: If True, ignore edges with a weight of 0 in any sample
+    :param oe_enrichment: Minimum O/E fold-enrichment of an edge
+    :param min_distance: Minimum distance between edge regions in base pairs
+    :param max_distance: Maximum distance between edge regions in base pairs
+    :param background_ligation: If True, ignore edges below the average
+                                inter-chromosomal contact strength
+    :param min_libraries_above_background: Minimum number of samples that have
+                                           to pass the O/E or background filter
+    :param out_of_core: If True, stream edges from all samples in chunks instead
+                        of collecting them in memory first. Edges are selected
+                        on the fly, and if :code:`sample_size` is None, the PCA
+                        is computed from a chunk-wise accumulated Gram matrix of
+                        the samples
+    :param chunk_size: Approximate number of edges read at once with
+                       :code:`out_of_core`
+    :param kwargs: Keyword arguments passed to edge retrieval,
+                   e.g. :code:`inter_chromosomal`
+    :return: tuple (:class:`~sklearn.decomposition.PCA`, transformed samples)
+    """
     strategies = {
         'variance': LargestVarianceSelector(),
         'fold-change': LargestFoldChangeSelector(),
@@ -595,6 +967,23 @@ def hic_pca(*hics, sample_size=None, region=None, strategy='variance', scale=Tru
         filters.append(AbsoluteWeightFilter(cutoff=inter_expected,
                                             min_above_cutoff=min_libraries_above_background))
 
+    if out_of_core:
+        edge_chunks = _edge_collection_chunks(*hics, region=region, scale=scale,
+                                              filters=filters, chunk_size=chunk_size,
+                                              **kwargs)
+        if sample_size is None:
+            pca, pca_res = _gram_pca(edge_chunks, selector=selector, log=log)
+        else:
+            y = selector.filter_edge_chunks(edge_chunks, sample_size)
+            if log:
+                y = np.log(y)
+
+            pca = PCA()
+            pca_res = pca.fit_transform(y.T)
+        logger.info("Variance explained: %s" % str(pca.explained_variance_ratio_))
+
+        return pca, pca_res
+
     edge_collection = _edge_collection(*hics, region=region, scale=scale,
                                        filters=filters, **kwargs)
 
@@ -2,18 +2,97 @@ import tables
 
 import genomic_regions as gr
 from .helpers import vector_enrichment_profile
-from ..matrix import RegionMatrixTable, Edge
+from ..matrix import RegionMatrixTable, Edge, _expected_sums_from_edges
 import numpy as np
+import scipy.sparse.linalg
 from ..tools.general import RareUpdateProgressBar
 from ..config import config
 from ..regions import Genome
 from future.utils import string_types
-from Bio.SeqUtils import GC as calculate_gc_content
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+_GC_BASES = np.frombuffer(b'GCSgcs', dtype=np.uint8)
+
+
+def _correlation_matrix(m, dtype=np.float32):
+    """
+    Pearson correlation between the rows of a matrix.
+
+    Equivalent to :func:`numpy.corrcoef`, but computed in :code:`dtype`
+    to halve the memory footprint for large matrices. Rows with zero
+    variance have NaN correlations.
+
+    :param m: 2D array (masks are ignored)
+    :param dtype: Data type of the computation and output
+    :return: 2D correlation matrix
+    """
+    m = np.array(m, dtype=dtype)
+    m -= m.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m /= np.sqrt(np.einsum('ij,ij->i', m, m))[:, None]
+    corr = np.dot(m, m.T)
+    np.clip(corr, -1, 1, out=corr)
+    return corr
+
+
+def _leading_eigenvector(m, eigenvector=0):
+    """
+    Eigenvector of a symmetric matrix, ordered by decreasing eigenvalue.
+
+    Only the leading :code:`eigenvector + 1` eigenpairs are calculated using
+    :func:`scipy.sparse.linalg.eigsh`, falling back to a full decomposition
+    for matrices that are too small for the iterative solver.
+
+    :param m: Symmetric 2D array, NaN values are treated as 0
+    :param eigenvector: Index of the eigenvector (0 is the leading one)
+    :return: 1D array
+    """
+    m = np.array(m, dtype=np.float64)
+    m[np.isnan(m)] = 0
+    n = m.shape[0]
+    if n == 0:
+        return np.zeros(0)
+
+    if eigenvector + 1 < n - 1:
+        w, v = scipy.sparse.linalg.eigsh(m, k=eigenvector + 1, which='LA')
+    else:
+        w, v = np.linalg.eigh(m)
+    return v[:, np.argsort(w)[::-1][eigenvector]]
+
+
+def _gc_content(sequence, starts, ends):
+    """
+    GC content (in percent) of many regions on the same sequence.
+
+    Counts G, C, and S (case-insensitive) like :func:`Bio.SeqUtils.GC`,
+    using a single cumulative sum over the sequence.
+
+    :param sequence: Sequence string
+    :param starts: 1-based region starts
+    :param ends: 1-based, inclusive region ends
+    :return: 1D float array, 0 for empty regions
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii', 'replace')
+    is_gc = np.isin(np.frombuffer(bytes(sequence), dtype=np.uint8), _GC_BASES)
+    cumulative_gc = np.concatenate([[0], np.cumsum(is_gc, dtype=np.int64)])
+
+    length = len(is_gc)
+    starts = np.clip(np.asarray(starts, dtype=np.int64) - 1, 0, length)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, length)
+    ends = np.maximum(starts, ends)
+    sizes = ends - starts
+
+    gc = np.zeros(len(starts))
+    non_empty = sizes > 0
+    gc[non_empty] = (cumulative_gc[ends[non_empty]] -
+                     cumulative_gc[starts[non_empty]]) * 100. / sizes[non_empty]
+    return gc
+
+
 class ABCompartmentMatrix(RegionMatrixTable):
     """
     Class representing O/E correlation matrix used to derive AB compartments.
@@ -75,13 +154,48 @@ class ABCompartmentMatrix(RegionMatrixTable):
 
     @classmethod
     def from_hic(cls, hic, file_name=None, tmpdir=None,
-                 per_chromosome=True, oe_per_chromosome=None):
+                 per_chromosome=True, oe_per_chromosome=None,
+                 dense=True):
+        """
+        Calculate the O/E correlation matrix from a Hic object.
+
+        :param hic: :class:`~fanc.hic.Hic` or other matrix object
+        :param file_name: Path to output file
+        :param tmpdir: Optional temporary directory to work in
+        :param per_chromosome: If True (default), only calculate intra-chromosomal
+                               correlations. Otherwise use the whole-genome matrix
+        :param oe_per_chromosome: Use chromosome-specific expected values for
+                                  the O/E matrix. Defaults to :code:`per_chromosome`
+        :param dense: If True (default), store correlations as dense float32
+                      arrays (one per chromosome) instead of one edge per
+                      region pair. This is much faster to write and read,
+                      and is what :func:`~ABCompartmentMatrix.eigenvector`
+                      operates on directly
+        :return: :class:`~ABCompartmentMatrix`
+        """
         ab_matrix = cls(file_name=file_name, mode='w', tmpdir=tmpdir)
         ab_matrix.add_regions(hic.regions, preserve_attributes=False)
         ab_matrix.meta.per_chromosome = per_chromosome
         ab_matrix.meta.oe_per_chromosome = oe_per_chromosome
 
-        if per_chromosome:
+        if dense:
+            if oe_per_chromosome is None:
+                oe_per_chromosome = per_chromosome
+
+            if per_chromosome:
+                keys = [(chromosome, chromosome) for chromosome in hic.chromosomes()]
+            else:
+                keys = [None]
+
+            with RareUpdateProgressBar(max_value=len(keys), silent=config.hide_progressbars,
+                                       prefix="AB") as pb:
+                for i, key in enumerate(keys):
+                    m = hic.matrix(key, oe=True, oe_per_chromosome=oe_per_chromosome)
+                    if len(m.row_regions) > 0:
+                        start = m.row_regions[0].ix
+                        ab_matrix._add_correlation_block(start, _correlation_matrix(m))
+                    pb.update(i)
+        elif per_chromosome:
             if oe_per_chromosome is None:
                 oe_per_chromosome = True
             chromosomes = hic.chromosomes()
@@ -154,26 +268,13 @@ class ABCompartmentMatrix(RegionMatrixTable):
         else:
             ev = np.zeros(len(self.regions))
             if per_chromosome:
-                for chromosome_sub in self.chromosomes():
-                    m = self.matrix((chromosome_sub, chromosome_sub))
-                    m[np.isnan(m)] = 0
-                    w, v = np.linalg.eig(m)
-                    # v might end up being masked
-                    if hasattr(v, 'mask'):
-                        v.mask = False
-                    ab_vector = v[:, eigenvector]
-                    for i, region in enumerate(m.row_regions):
-                        ev[region.ix] = ab_vector[i]
+                bins = list(self.chromosome_bins.values())
             else:
-                m = self.matrix()
-                m[np.isnan(m)] = 0
-                w, v = np.linalg.eig(m)
-                # v might end up being masked
-                if hasattr(v, 'mask'):
-                    v.mask = False
-                ab_vector = v[:, eigenvector]
-                for i, region in enumerate(m.row_regions):
-                    ev[region.ix] = ab_vector[i]
+                bins = [(0, len(self.regions))]
+
+            for start, end in bins:
+                ev[start:end] = _leading_eigenvector(self._correlation_matrix(start, end),
+                                                     eigenvector=eigenvector)
 
             if genome is not None:
                 logger.info("Using GC content to orient eigenvector...")
@@ -182,16 +283,7 @@ class ABCompartmentMatrix(RegionMatrixTable):
                     genome = Genome.from_string(genome, mode='r')
                     close_genome = True
 
-                gc_content = [np.nan] * len(self.regions)
-                for chromosome_sub in self.chromosomes():
-                    if chromosome_sub in exclude_chromosomes:
-                        continue
-                    logger.info("{}".format(chromosome_sub))
-                    chromosome_sequence = genome[chromosome_sub].sequence
-                    for region in self.regions(chromosome_sub):
-                        s = chromosome_sequence[region.start - 1:region.end]
-                        gc_content[region.ix] = calculate_gc_content(s)
-                gc_content = np.array(gc_content)
+                gc_content = self._gc_content(genome, exclude_chromosomes=exclude_chromosomes)
 
                 if close_genome:
                     genome.close()
@@ -228,6 +320,259 @@ class ABCompartmentMatrix(RegionMatrixTable):
         regions = list(self.regions(sub_region))
         return ev[regions[0].ix:regions[-1].ix + 1]
 
+    def _correlation_blocks(self):
+        """
+        Dense correlation blocks stored in this object.
+
+        :return: list of (start, end, :class:`~tables.CArray`) tuples,
+                 sorted by start region index
+        """
+        try:
+            group = self.file.get_node('/', 'correlation')
+        except tables.NoSuchNodeError:
+            return []
+
+        blocks = []
+        for node in group:
+            blocks.append((int(node.attrs['start']), int(node.attrs['end']), node))
+        return sorted(blocks, key=lambda x: x[0])
+
+    def _add_correlation_block(self, start, corr):
+        """
+        Store a square correlation matrix covering the regions
+        starting at index :code:`start`.
+        """
+        try:
+            group = self.file.get_node('/', 'correlation')
+        except tables.NoSuchNodeError:
+            group = self.file.create_group('/', 'correlation')
+
+        end = start + corr.shape[0]
+        block = self.file.create_carray(group, 'block_{}_{}'.format(start, end),
+                                        atom=tables.Float32Atom(), shape=corr.shape)
+        block[:] = corr
+        block.attrs['start'] = start
+        block.attrs['end'] = end
+        block.flush()
+
+    def _correlation_matrix(self, start, end):
+        """
+        Correlation matrix for the regions with indexes start to end (exclusive).
+
+        Uses the dense correlation blocks if they cover the whole range,
+        :func:`~ABCompartmentMatrix.matrix` otherwise. Entries of invalid
+        regions are 0.
+        """
+        for block_start, block_end, block in self._correlation_blocks():
+            if block_start <= start and end <= block_end:
+                m = block[start - block_start:end - block_start,
+                          start - block_start:end - block_start]
+                valid = self._region_array('valid', True)[start:end].astype(bool)
+                m[~valid, :] = 0
+                m[:, ~valid] = 0
+                return m
+
+        regions = list(self.regions[start:end])
+        m = self.matrix((regions, regions), mask=False)
+        return np.array(m)
+
+    def _dense_edge_arrays(self, row_bounds=None, col_bounds=None):
+        """
+        Edges with a non-NaN correlation from the dense correlation blocks.
+
+        :param row_bounds: tuple of first and last (inclusive) row region index.
+                           Defaults to all regions
+        :param col_bounds: tuple of first and last (inclusive) column region index.
+                           Defaults to all regions
+        :return: iterator over (sources, sinks, weights) arrays, one per block,
+                 with source <= sink
+        """
+        if row_bounds is None:
+            row_bounds = (0, len(self.regions) - 1)
+        if col_bounds is None:
+            col_bounds = (0, len(self.regions) - 1)
+
+        # edges in the selected rectangle and its mirror image,
+        # which can contain edges with source <= sink not in the rectangle
+        rectangles = [(row_bounds, col_bounds)]
+        if row_bounds != col_bounds:
+            rectangles.append((col_bounds, row_bounds))
+
+        for block_start, block_end, block in self._correlation_blocks():
+            for r, ((r_start, r_end), (c_start, c_end)) in enumerate(rectangles):
+                r_start, r_end = max(r_start, block_start), min(r_end, block_end - 1)
+                c_start, c_end = max(c_start, block_start), min(c_end, block_end - 1)
+                if r_start > r_end or c_start > c_end:
+                    continue
+
+                values = block[r_start - block_start:r_end - block_start + 1,
+                               c_start - block_start:c_end - block_start + 1]
+                block_sources = np.arange(r_start, r_end + 1)[:, None]
+                block_sinks = np.arange(c_start, c_end + 1)[None, :]
+
+                keep = np.logical_and(block_sources <= block_sinks, ~np.isnan(values))
+                if r > 0:
+                    # already covered by the first rectangle
+                    keep &= ~np.logical_and.reduce([row_bounds[0] <= block_sources,
+                                                    block_sources <= row_bounds[1],
+                                                    col_bounds[0] <= block_sinks,
+                                                    block_sinks <= col_bounds[1]])
+
+                ixs_i, ixs_j = np.nonzero(keep)
+                yield (ixs_i.astype(np.int64) + r_start, ixs_j.astype(np.int64) + c_start,
+                       values[ixs_i, ixs_j])
+
+    def edges_array(self, key=None, norm=True, fields=None, as_dict=False, **kwargs):
+        """
+        Get edges as numpy arrays instead of :class:`~Edge` objects.
+
+        For matrices with dense correlation storage (see
+        :func:`~ABCompartmentMatrix.from_hic`), edges are extracted from
+        the stored blocks. Only edges with a non-NaN correlation are returned.
+        All other arguments are as in :func:`~fanc.matrix.RegionPairsTable.edges_array`.
+        """
+        blocks = self._correlation_blocks()
+        if len(blocks) == 0:
+            return RegionMatrixTable.edges_array(self, key=key, norm=norm, fields=fields,
+                                                 as_dict=as_dict, **kwargs)
+
+        kwargs.pop('lazy', None)
+        intra_chromosomal = kwargs.pop('intra_chromosomal', True)
+        inter_chromosomal = kwargs.pop('inter_chromosomal', True)
+        check_valid = kwargs.pop('check_valid', True)
+        valid_field = kwargs.pop('valid_field', 'valid')
+        weight_field = kwargs.pop('weight_field', 'weight')
+        for ignored in ('bias_field', 'excluded_filters', '_chunk_size'):
+            kwargs.pop(ignored, None)
+        if len(kwargs) > 0:
+            raise TypeError("edges_array() got unexpected keyword argument(s): "
+                            "{}".format(", ".join(sorted(kwargs.keys()))))
+
+        fields = self._edges_array_fields(fields)
+        for field in fields:
+            if field not in ('source', 'sink', weight_field):
+                raise ValueError("Dense correlation matrices only store the "
+                                 "'{}' field, not '{}'".format(weight_field, field))
+
+        if key is None:
+            row_bounds = col_bounds = (0, len(self.regions) - 1)
+        else:
+            row_regions, col_regions = self._key_to_regions(key, lazy=True)
+            if isinstance(row_regions, gr.GenomicRegion):
+                row_regions = [row_regions]
+            if isinstance(col_regions, gr.GenomicRegion):
+                col_regions = [col_regions]
+            row_bounds = self._min_max_region_ix(row_regions)
+            col_bounds = self._min_max_region_ix(col_regions)
+
+        valid = None
+        if check_valid:
+            valid = self._region_array(valid_field, True).astype(bool)
+
+        chromosome_ixs = None
+        if not intra_chromosomal or not inter_chromosomal:
+            chromosome_ixs = self._region_chromosome_ix_array()
+
+        sources, sinks, weights = [], [], []
+        for block_sources, block_sinks, block_weights in self._dense_edge_arrays(row_bounds, col_bounds):
+            sources.append(block_sources)
+            sinks.append(block_sinks)
+            weights.append(block_weights)
+
+        columns = {
+            'source': np.concatenate(sources) if sources else np.zeros(0, dtype=np.int64),
+            'sink': np.concatenate(sinks) if sinks else np.zeros(0, dtype=np.int64),
+        }
+        columns[weight_field] = np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32)
+
+        keep = np.ones(len(columns['source']), dtype=bool)
+        if valid is not None:
+            keep &= valid[columns['source']] & valid[columns['sink']]
+        if chromosome_ixs is not None:
+            is_intra_chromosomal = chromosome_ixs[columns['source']] == chromosome_ixs[columns['sink']]
+            if not intra_chromosomal:
+                keep &= ~is_intra_chromosomal
+            if not inter_chromosomal:
+                keep &= is_intra_chromosomal
+        columns = {field: values[keep] for field, values in columns.items()}
+
+        return self._edges_array_output(columns, fields, as_dict=as_dict)
+
+    def _dense_edges(self, row_bounds=None, col_bounds=None):
+        regions = list(self.regions(lazy=False))
+        weight_field = self._default_score_field
+        for sources, sinks, weights in self._dense_edge_arrays(row_bounds, col_bounds):
+            for source, sink, weight in zip(sources.tolist(), sinks.tolist(), weights.tolist()):
+                yield Edge(regions[source], regions[sink], **{weight_field: weight})
+
+    def _edges_subset(self, key=None, row_regions=None, col_regions=None, *args, **kwargs):
+        if len(self._correlation_blocks()) == 0:
+            for edge in RegionMatrixTable._edges_subset(self, key, row_regions, col_regions,
+                                                        *args, **kwargs):
+                yield edge
+            return
+
+        for edge in self._dense_edges(self._min_max_region_ix(row_regions),
+                                      self._min_max_region_ix(col_regions)):
+            yield edge
+
+    def _edges_iter(self, *args, **kwargs):
+        if len(self._correlation_blocks()) == 0:
+            for edge in RegionMatrixTable._edges_iter(self, *args, **kwargs):
+                yield edge
+            return
+
+        for edge in self._dense_edges():
+            yield edge
+
+    def _edges_length(self):
+        if len(self._correlation_blocks()) == 0:
+            return RegionMatrixTable._edges_length(self)
+        return sum(len(sources) for sources, _, _ in self._dense_edge_arrays())
+
+    def _expected_partials(self, norm=True):
+        """
+        Edge weight sums required for expected values, by correlation block.
+
+        For matrices with dense correlation storage, sums are calculated
+        from the stored blocks. They are not cached, as there are no
+        edge tables to track changes of.
+        """
+        blocks = self._correlation_blocks()
+        if len(blocks) == 0:
+            return RegionMatrixTable._expected_partials(self, norm=norm)
+
+        bias = self._region_array('bias', 1.0).astype(np.float64) if norm else None
+        chromosome_ixs = self._region_chromosome_ix_array()
+        chromosome_starts = np.array([self.chromosome_bins[chromosome][0]
+                                      for chromosome in self.chromosomes()], dtype=np.int64)
+
+        partials = dict()
+        for block_start, block_end, _ in blocks:
+            bounds = (block_start, block_end - 1)
+            partials[(block_start, block_end)] = (None, _expected_sums_from_edges(
+                self._dense_edge_arrays(bounds, bounds), chromosome_ixs, chromosome_starts, bias=bias))
+        return partials
+
+    def _gc_content(self, genome, exclude_chromosomes=()):
+        """
+        GC content of all regions in this object.
+
+        :param genome: :class:`~fanc.regions.Genome`
+        :param exclude_chromosomes: Chromosomes to skip, their regions are NaN
+        :return: 1D float array
+        """
+        gc_content = np.full(len(self.regions), np.nan)
+        for chromosome, (start, end) in self.chromosome_bins.items():
+            if chromosome in exclude_chromosomes:
+                continue
+            logger.info("{}".format(chromosome))
+            regions = self.regions[start:end]
+            gc_content[start:end] = _gc_content(genome[chromosome].sequence,
+                                                [region.start for region in regions],
+                                                [region.end for region in regions])
+        return gc_content
+
     def domains(self, *args, **kwargs):
         ev = self.eigenvector(*args, **kwargs)
 
@@ -285,15 +630,7 @@ class ABCompartmentMatrix(RegionMatrixTable):
                     genome = Genome.from_string(genome)
 
                 logger.info("Calculating GC content...")
-                gc_content = [np.nan] * len(self.regions)
-                for chromosome in self.chromosomes():
-                    logger.info("{}".format(chromosome))
-                    chromosome_sequence = genome[chromosome].sequence
-                    for region in self.regions(chromosome):
-                        s = chromosome_sequence[region.start - 1:region.end]
-                        gc_content[region.ix] = calculate_gc_content(s)
-                gc_content = np.array(gc_content)
-                ev = gc_content
+                ev = self._gc_content(genome)
             else:
                 ev = self.eigenvector(exclude_chromosomes=exclude_chromosomes, *args, **kwargs)
 
@@ -3,8 +3,10 @@ from .maxima_callers import MaximaCallerDelta
 from .helpers import RegionScoreMatrix
 from ..regions import RegionsTable
 from ..tools.matrix import apply_sliding_func, trim_stats
-from ..tools.files import write_bed, write_bigwig, write_gff
+from ..tools.files import write_bed, write_bigwig, write_gff, release_inherited_pytables_file
 from ..tools.matrix import nangmean
+from ..tools.load import load
+import multiprocessing as mp
 import numpy as np
 import tables
 import itertools
@@ -15,6 +17,188 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _band_summed_area_table(sources, sinks, weights, n, max_distance):
+    """
+    Summed-area table of an upper triangular band matrix.
+
+    Only entries with :code:`0 <= sink - source <= max_distance` are
+    considered. Sums are stored along anti-diagonals, so memory scales
+    with the number of bins times the band width rather than the
+    squared number of bins.
+
+    :param sources: array of source (row) indices
+    :param sinks: array of sink (column) indices
+    :param weights: array of weights
+    :param n: number of bins
+    :param max_distance: maximum distance from the diagonal in bins
+    :return: tuple of cumulative full row sums and cumulative
+             anti-diagonal sums, use with :func:`~_band_box_sums`
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    distances = np.asarray(sinks, dtype=np.int64) - sources
+    in_band = np.logical_and(distances >= 0, distances <= max_distance)
+    width = max_distance + 1
+
+    band = np.bincount(sources[in_band] * width + distances[in_band],
+                       weights=np.asarray(weights, dtype=np.float64)[in_band],
+                       minlength=n * width).reshape(n, width)
+    row_sums = np.cumsum(band, axis=1)
+    full_row_sums = np.cumsum(row_sums[:, -1])
+
+    # anti_diagonals[c, d] = row_sums[c - d, d]
+    rows = np.arange(n)[:, None] - np.arange(width)[None, :]
+    anti_diagonals = np.where(rows >= 0, row_sums[np.maximum(rows, 0), np.arange(width)[None, :]], 0)
+    anti_diagonal_sums = np.cumsum(anti_diagonals[:, ::-1], axis=1)[:, ::-1]
+    return full_row_sums, anti_diagonal_sums
+
+
+def _band_corner_sums(sat, rows, cols):
+    """
+    Sum of all band matrix entries with row <= rows and column <= cols.
+    """
+    full_row_sums, anti_diagonal_sums = sat
+    n, width = anti_diagonal_sums.shape
+    max_distance = width - 1
+
+    cols = np.minimum(cols, n - 1)
+    rows = np.minimum(rows, cols)
+    valid = rows >= 0
+    rows, cols = np.maximum(rows, 0), np.maximum(cols, 0)
+    distances = cols - rows
+
+    sums = full_row_sums[rows]
+    partial = distances <= max_distance
+    partial_cols, partial_distances = cols[partial], distances[partial]
+    preceding = partial_cols - max_distance - 1
+    sums[partial] = np.where(preceding >= 0, full_row_sums[np.maximum(preceding, 0)], 0) + \
+        anti_diagonal_sums[partial_cols, partial_distances]
+    sums[~valid] = 0
+    return sums
+
+
+def _band_box_sums(sat, row_start, row_end, col_start, col_end):
+    """
+    Sums of band matrix entries in boxes (inclusive bounds).
+
+    :param sat: summed-area table from :func:`~_band_summed_area_table`
+    :return: array of box sums
+    """
+    return (_band_corner_sums(sat, row_end, col_end) - _band_corner_sums(sat, row_start - 1, col_end) -
+            _band_corner_sums(sat, row_end, col_start - 1) + _band_corner_sums(sat, row_start - 1, col_start - 1))
+
+
+def _count_in_ranges(mask, starts, ends):
+    """
+    Count True entries of a boolean array in ranges (inclusive bounds).
+    """
+    counts = np.concatenate([[0], np.cumsum(mask)])
+    starts = np.clip(starts, 0, len(mask))
+    ends = np.clip(ends + 1, 0, len(mask))
+    return np.maximum(counts[ends] - counts[starts], 0)
+
+
+def _imputed_insulation_values(unmappable, expected, n, bin_window_size, window_offset):
+    """
+    Sum of imputed expected values in the insulation square of each bin.
+
+    Expected values are imputed for all region pairs involving an
+    unmappable bin that fall into any insulation square.
+
+    :param unmappable: indices of unmappable bins
+    :param expected: list of expected values by distance
+    :param n: number of bins
+    :param bin_window_size: insulation window size in bins
+    :param window_offset: offset of the insulation square from the diagonal
+    :return: array of imputed sums
+    """
+    if len(unmappable) == 0:
+        return np.zeros(n)
+
+    # largest distance between source and sink in any insulation square
+    max_distance = 2 * window_offset + 2 * bin_window_size - 2
+    left = unmappable[:, None] - np.arange(1, max_distance + 1)[None, :]
+    right = unmappable[:, None] + np.arange(0, max_distance + 1)[None, :]
+    sources = np.concatenate([left[left >= 0], np.broadcast_to(unmappable[:, None], right.shape)[right < n]])
+    sinks = np.concatenate([np.broadcast_to(unmappable[:, None], left.shape)[left >= 0], right[right < n]])
+    pairs = np.unique(sources * n + sinks)
+    sources, sinks = pairs // n, pairs % n
+    weights = np.asarray(expected)[sinks - sources]
+
+    # add each weight to every insulation square that contains it
+    i = sources + window_offset
+    j = sinks - window_offset
+    starts = np.clip(np.maximum(i, j - bin_window_size + 1), 0, n)
+    stops = np.clip(np.minimum(j + 1, i + bin_window_size), 0, n)
+    contained = starts < stops
+    starts, stops, weights = starts[contained], stops[contained], weights[contained]
+
+    values = np.cumsum(np.bincount(starts, weights=weights, minlength=n + 1) -
+                       np.bincount(stops, weights=weights, minlength=n + 1))[:n]
+    counts = np.cumsum(np.bincount(starts, minlength=n + 1) - np.bincount(stops, minlength=n + 1))[:n]
+    values[counts == 0] = 0
+    return values
+
+
+def _directionality_sums(hic, chromosome, bin_window_sizes, weight_field, **kwargs):
+    """
+    Upstream and downstream contact sums of each bin in a chromosome.
+
+    Contacts are summed up by distance to the diagonal first, so the sums
+    for all window sizes are prefix sums over the same band matrix.
+
+    :return: tuple of arrays with upstream (left) and downstream (right)
+             sums, with one row per window size
+    """
+    start, stop = hic.chromosome_bins[chromosome]
+    n = stop - start
+    max_distance = max(bin_window_sizes)
+
+    edges = hic.edges_array((chromosome, chromosome), fields=[weight_field], as_dict=True, **kwargs)
+    sources = edges['source'] - start
+    sinks = edges['sink'] - start
+    weights = edges[weight_field]
+    distances = sinks - sources
+
+    # distance of each bin to the nearest chromosome end
+    ix = np.arange(n)
+    boundary_dist = np.minimum(ix, n - 1 - ix)
+
+    width = max_distance + 1
+    in_band = np.logical_and(distances > 0, distances <= max_distance)
+    left = np.logical_and(in_band, boundary_dist[np.clip(sinks, 0, n - 1)] >= distances)
+    right = np.logical_and(in_band, boundary_dist[np.clip(sources, 0, n - 1)] >= distances)
+
+    left_band = np.bincount(sinks[left] * width + distances[left], weights=weights[left],
+                            minlength=n * width).reshape(n, width)
+    right_band = np.bincount(sources[right] * width + distances[right], weights=weights[right],
+                             minlength=n * width).reshape(n, width)
+    left_sums = np.cumsum(left_band, axis=1)[:, bin_window_sizes].T
+    right_sums = np.cumsum(right_band, axis=1)[:, bin_window_sizes].T
+    return left_sums, right_sums
+
+
+def _directionality_sums_worker(hic_file, qin, qout, bin_window_sizes, weight_field, kwargs):
+    hic = None
+    try:
+        # every worker reads from its own file handle
+        release_inherited_pytables_file(hic_file)
+        hic = load(hic_file, mode='r')
+        while True:
+            chromosome = qin.get()
+            if chromosome is None:
+                logger.debug("Received stop signal, worker terminating.")
+                break
+
+            left_sums, right_sums = _directionality_sums(hic, chromosome, bin_window_sizes,
+                                                         weight_field, **kwargs)
+            qout.put((chromosome, left_sums, right_sums))
+    except Exception as e:
+        qout.put(e)
+    finally:
+        if hic is not None:
+            hic.close()
+
+
 class RegionScoreTable(RegionsTable):
 
     _classid = 'REGIONSCORETABLE'
@@ -187,101 +371,62 @@ class InsulationScores(RegionScoreParameterTable):
         else:
             intra_expected, intra_expected_chromosome = None, None
 
+        # largest distance between source and sink in any insulation square
+        max_distance = 2 * window_offset + 2 * max(bin_window_sizes) - 1
+        weight_field = hic._default_score_field
+
         ii_list = [[] for _ in bin_window_sizes]
         chromosomes = hic.chromosomes()
         for chr_ix, chromosome in enumerate(chromosomes):
             logger.info("{} ({}/{})".format(chromosome, chr_ix + 1, len(chromosomes)))
             chromosome_start, chromosome_stop = chromosome_bins[chromosome]
-            values_by_chromosome = [[0 for _ in range(chromosome_start, chromosome_stop)] for _ in bin_window_sizes]
-
-            # add each edge weight to every insulation window that contains it
-            for edge in hic.edges((chromosome, chromosome), lazy=True):
-                i = edge.source - chromosome_start + window_offset
-                j = edge.sink - chromosome_start - window_offset
-
-                for w_ix, bin_window_size in enumerate(bin_window_sizes):
-                    start = max(i, j - bin_window_size + 1)
-                    stop = min(j + 1, i + bin_window_size)
-                    for ii_bin in range(start, stop):
-                        weight = getattr(edge, hic._default_score_field)
-                        values_by_chromosome[w_ix][ii_bin] += weight
-
-            # add imputed values, if requested
-            if impute_missing:
-                expected = intra_expected_chromosome[chromosome]
-
-                covered = set()
-                for ix in range(chromosome_start, chromosome_stop):
-                    if not mappable[ix]:
-                        for w_ix, bin_window_size in enumerate(bin_window_sizes):
-                            sink = ix
-                            for source in range(max(chromosome_start, ix - bin_window_size - window_offset - 2), ix):
-                                if (source, sink) in covered:
-                                    continue
-                                covered.add((source, sink))
-                                weight = expected[sink - source]
-                                i = source - chromosome_start + window_offset
-                                j = sink - chromosome_start - window_offset
-
-                                start = max(i, j - bin_window_size + 1)
-                                stop = min(j + 1, i + bin_window_size)
-                                for ii_bin in range(start, stop):
-                                    values_by_chromosome[w_ix][ii_bin] += weight
-
-                            source = ix
-                            for sink in range(ix, min(chromosome_stop, ix + window_offset + bin_window_size + 2)):
-                                if (source, sink) in covered:
-                                    continue
-                                covered.add((source, sink))
-                                weight = expected[sink - source]
-                                i = source - chromosome_start + window_offset
-                                j = sink - chromosome_start - window_offset
-
-                                start = max(i, j - bin_window_size + 1)
-                                stop = min(j + 1, i + bin_window_size)
-                                for ii_bin in range(start, stop):
-                                    values_by_chromosome[w_ix][ii_bin] += weight
-
-                for k in range(len(values_by_chromosome)):
-                    for w_ix, bin_window_size in enumerate(bin_window_sizes):
-                        if (k - window_offset < bin_window_size - 1
-                                or k + window_offset > len(values_by_chromosome) - bin_window_size):
-                            values_by_chromosome[w_ix][k] = np.nan
-                        else:
-                            values_by_chromosome[w_ix][k] /= bin_window_size ** 2
-            # count unmappable bins in every window
-            else:
-                unmappable_horizontal = [[0 for _ in range(chromosome_start, chromosome_stop)] for _ in bin_window_sizes]
-                unmappable_vertical = [[0 for _ in range(chromosome_start, chromosome_stop)] for _ in bin_window_sizes]
-
-                for ix in range(chromosome_start, chromosome_stop):
-                    if not mappable[ix]:
-                        for w_ix, bin_window_size in enumerate(bin_window_sizes):
-                            # horizontal
-                            start_bin = ix - chromosome_start + window_offset
-                            for ii_bin in range(start_bin, start_bin + bin_window_size):
-                                if 0 <= ii_bin < len(unmappable_horizontal[w_ix]):
-                                    unmappable_horizontal[w_ix][ii_bin] += 1
-                            # vertical
-                            start_bin = ix - chromosome_start - window_offset
-                            for ii_bin in range(start_bin - bin_window_size + 1, start_bin + 1):
-                                if 0 <= ii_bin < len(unmappable_vertical[w_ix]):
-                                    unmappable_vertical[w_ix][ii_bin] += 1
-
-                for w_ix, bin_window_size in enumerate(bin_window_sizes):
-                    for k in range(len(values_by_chromosome[w_ix])):
-                        na_vertical = unmappable_vertical[w_ix][k] * bin_window_size
-                        na_horizontal = unmappable_horizontal[w_ix][k] * bin_window_size
-                        na_overlap = unmappable_horizontal[w_ix][k] * unmappable_vertical[w_ix][k]
+            n = chromosome_stop - chromosome_start
+            k = np.arange(n)
+
+            edges = hic.edges_array((chromosome, chromosome), fields=[weight_field], as_dict=True)
+            sources = edges['source'] - chromosome_start
+            sinks = edges['sink'] - chromosome_start
+            weights = edges[weight_field]
+            sat = _band_summed_area_table(sources, sinks, weights, n, max_distance)
+            count_sat = _band_summed_area_table(sources, sinks, np.ones(len(sources)), n, max_distance)
+            unmappable = ~np.asarray(mappable[chromosome_start:chromosome_stop], dtype=bool)
+
+            values_by_chromosome = []
+            for bin_window_size in bin_window_sizes:
+                # insulation square of bin k: rows i_start-i_end, columns j_start-j_end
+                i_start, i_end = k - window_offset - bin_window_size + 1, k - window_offset
+                j_start, j_end = k + window_offset, k + window_offset + bin_window_size - 1
+                values = _band_box_sums(sat, i_start, i_end, j_start, j_end)
+                values[_band_box_sums(count_sat, i_start, i_end, j_start, j_end) == 0] = 0
+
+                out_of_bounds = np.logical_or(k - window_offset < bin_window_size - 1,
+                                              k + window_offset > n - bin_window_size)
+
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", category=RuntimeWarning)
+
+                    # add imputed values, if requested
+                    if impute_missing:
+                        values += _imputed_insulation_values(np.where(unmappable)[0],
+                                                             intra_expected_chromosome[chromosome],
+                                                             n, bin_window_size, window_offset)
+                        values = values / bin_window_size ** 2
+                        values[out_of_bounds] = np.nan
+                    # count unmappable bins in every window
+                    else:
+                        unmappable_horizontal = _count_in_ranges(unmappable, i_start, i_end)
+                        unmappable_vertical = _count_in_ranges(unmappable, j_start, j_end)
+
+                        na_vertical = unmappable_vertical * bin_window_size
+                        na_horizontal = unmappable_horizontal * bin_window_size
+                        na_overlap = unmappable_horizontal * unmappable_vertical
                         na_total = na_vertical + na_horizontal - na_overlap
 
                         # take into account nan values when adding zeros
-                        if ((na_total > (bin_window_size ** 2 * na_threshold))
-                                or k - window_offset < bin_window_size - 1
-                                or k + window_offset > len(values_by_chromosome[w_ix]) - bin_window_size):
-                            values_by_chromosome[w_ix][k] = np.nan
-                        else:
-                            values_by_chromosome[w_ix][k] /= (bin_window_size ** 2 - na_total)
+                        values = values / (bin_window_size ** 2 - na_total)
+                        values[np.logical_or(na_total > (bin_window_size ** 2 * na_threshold),
+                                             out_of_bounds)] = np.nan
+                values_by_chromosome.append(values)
 
             for w_ix, bin_window_size in enumerate(bin_window_sizes):
                 ii_by_chromosome = values_by_chromosome[w_ix]
@@ -354,8 +499,23 @@ class DirectionalityIndexes(RegionScoreParameterTable):
 
     @classmethod
     def from_hic(cls, hic, window_sizes, weight_field=None,
-                 file_name=None, tmpdir=None, **kwargs):
-        kwargs['lazy'] = True
+                 file_name=None, tmpdir=None, threads=1, **kwargs):
+        """
+        Calculate directionality indexes from a Hi-C matrix.
+
+        :param hic: :class:`~fanc.matrix.RegionMatrixContainer`
+        :param window_sizes: Window size or list of window sizes in base pairs
+        :param weight_field: Edge field used as contact weight. Defaults
+                             to the default score field of the matrix
+        :param file_name: Path to output file
+        :param tmpdir: Work in temporary directory
+        :param threads: Number of chromosomes processed in parallel. Only
+                        has an effect for matrices stored in a file.
+        :param kwargs: Keyword arguments passed to
+                       :func:`~fanc.matrix.RegionPairsContainer.edges_array`
+        """
+        kwargs.pop('lazy', None)
+        kwargs.pop('inter_chromosomal', None)
 
         if isinstance(window_sizes, int):
             window_sizes = [window_sizes]
@@ -371,68 +531,79 @@ class DirectionalityIndexes(RegionScoreParameterTable):
         weight_field = hic._default_score_field if weight_field is None else weight_field
 
         n_bins = len(hic.regions)
+        chromosome_bins = hic.chromosome_bins
+        chromosomes = hic.chromosomes()
 
-        # find the distances of each region to the chromosome ends in bins
-        boundary_dist = np.zeros(n_bins, dtype=int)
-        last_chromosome = None
-        last_chromosome_index = 0
-        for i, region in enumerate(hic.regions(lazy=True)):
-            chromosome = region.chromosome
-            if last_chromosome is not None and chromosome != last_chromosome:
-                chromosome_length = i - last_chromosome_index
-                for j in range(chromosome_length):
-                    boundary_dist[last_chromosome_index + j] = min(j, i - last_chromosome_index - 1 - j)
-                last_chromosome_index = i
-            last_chromosome = chromosome
-        chromosome_length = n_bins - last_chromosome_index
-        for j in range(chromosome_length):
-            boundary_dist[last_chromosome_index + j] = min(j, n_bins - last_chromosome_index - 1 - j)
-
-        left_sums = [np.zeros(n_bins) for _ in window_sizes]
-        right_sums = [np.zeros(n_bins) for _ in window_sizes]
-        kwargs['inter_chromosomal'] = False
-        kwargs['lazy'] = True
-        for edge in hic.edges(**kwargs):
-            source = edge.source
-            sink = edge.sink
-            weight = getattr(edge, weight_field)
-            if source == sink:
-                continue
-
-            for w_ix, bin_window_size in enumerate(bin_window_sizes):
-                if sink - source <= bin_window_size:
-                    if boundary_dist[sink] >= sink - source:
-                        left_sums[w_ix][sink] += weight
-                    if boundary_dist[source] >= sink - source:
-                        right_sums[w_ix][source] += weight
-
-        mappability = hic.mappable()
+        left_sums = np.zeros((len(window_sizes), n_bins))
+        right_sums = np.zeros((len(window_sizes), n_bins))
+
+        hic_file = None
+        if threads > 1:
+            try:
+                if hic.file.params['DRIVER'] != 'H5FD_CORE':
+                    hic_file = hic.file.filename
+            except AttributeError:
+                pass
+
+            if hic_file is None:
+                logger.warning("Matrix is not stored in a file, "
+                               "calculating directionality indexes in a single process")
+
+        if hic_file is None:
+            for chromosome in chromosomes:
+                start, stop = chromosome_bins[chromosome]
+                left_sums[:, start:stop], right_sums[:, start:stop] = \
+                    _directionality_sums(hic, chromosome, bin_window_sizes, weight_field, **kwargs)
+        else:
+            m = mp.Manager()
+            qin = m.Queue()
+            qout = m.Queue()
+
+            pool = None
+            try:
+                pool = mp.Pool(threads, _directionality_sums_worker,
+                               (hic_file, qin, qout, bin_window_sizes, weight_field, kwargs))
+
+                for chromosome in chromosomes:
+                    qin.put(chromosome)
+
+                for _ in chromosomes:
+                    out = qout.get(block=True)
+                    if isinstance(out, Exception):
+                        raise out
+                    chromosome, chromosome_left_sums, chromosome_right_sums = out
+                    start, stop = chromosome_bins[chromosome]
+                    left_sums[:, start:stop] = chromosome_left_sums
+                    right_sums[:, start:stop] = chromosome_right_sums
+            finally:
+                for _ in range(threads):
+                    qin.put(None)
+
+                if pool is not None:
+                    pool.terminate()
+
+        mappability = np.concatenate([[0], np.cumsum(hic.mappable())])
+        ix = np.arange(n_bins)
 
         directionality_index = [np.zeros(n_bins) for _ in window_sizes]
         for w_ix, bin_window_size in enumerate(bin_window_sizes):
-            corr, uncorr = 0, 0
-            for i in range(n_bins):
-                lm = np.sum(mappability[max(0, i - bin_window_size):i])
-                rm = np.sum(mappability[i:i + bin_window_size])
-                if lm / bin_window_size < 0.5 or rm / bin_window_size < 0.5:
-                    directionality_index[w_ix][i] = np.nan
-                    continue
-
-                Au = left_sums[w_ix][i]
-                Bu = right_sums[w_ix][i]
+            lm = mappability[ix] - mappability[np.maximum(0, ix - bin_window_size)]
+            rm = mappability[np.minimum(n_bins, ix + bin_window_size)] - mappability[ix]
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+
+                Au = left_sums[w_ix]
+                Bu = right_sums[w_ix]
                 # correct for mappability
                 A = Au + Au / lm * (bin_window_size - lm)
                 B = Bu + Bu / rm * (bin_window_size - rm)
 
-                if Au != A:
-                    corr += 1
-                else:
-                    uncorr += 1
-
                 E = (A + B) / 2
-                if E != 0 and B - A != 0:
-                    directionality_index[w_ix][i] = ((B - A) / abs(B - A)) * ((((A - E) ** 2) / E) +
-                                                                              (((B - E) ** 2) / E))
+                di = np.sign(B - A) * ((((A - E) ** 2) / E) + (((B - E) ** 2) / E))
+                di[np.logical_or(E == 0, B - A == 0)] = 0
+                di[np.logical_or(lm / bin_window_size < 0.5, rm / bin_window_size < 0.5)] = np.nan
+            directionality_index[w_ix] = di
 
         for w_ix, window_size in enumerate(window_sizes):
             directionality_indexes.scores(window_size, directionality_index[w_ix])
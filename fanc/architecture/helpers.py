@@ -1,27 +1,79 @@
 import numpy as np
-from bisect import bisect_left
 from collections import defaultdict
 import intervaltree
 from genomic_regions import GenomicRegion
 from future.utils import string_types
 
 
+def _class_pair_sums(sources_class, sinks_class, weights, n_classes):
+    """
+    Sum weights for every combination of source and sink class.
+
+    :return: (n_classes x n_classes) array
+    """
+    sums = np.bincount(sources_class * n_classes + sinks_class, weights=weights,
+                       minlength=n_classes * n_classes)
+    return sums.reshape((n_classes, n_classes))
+
+
+def _short_range_pair_counts(classes, min_distance, n_classes):
+    """
+    Count ordered pairs of classified bins closer than :code:`min_distance`
+    bins, by class combination. Unclassified bins have a class of -1.
+
+    :return: (n_classes x n_classes) array
+    """
+    counts = np.zeros((n_classes, n_classes))
+    for offset in range(-min_distance + 1, min_distance):
+        if offset >= 0:
+            a, b = classes[:len(classes) - offset], classes[offset:]
+        else:
+            a, b = classes[-offset:], classes[:len(classes) + offset]
+        both = np.logical_and(a >= 0, b >= 0)
+        counts += _class_pair_sums(a[both], b[both], None, n_classes)
+    return counts
+
+
 def vector_enrichment_profile(matrix, vector, mappable=None, per_chromosome=True,
                               percentiles=(20.0, 40.0, 60.0, 80.0, 100.0),
                               symmetric_at=None, exclude_chromosomes=(),
                               intra_chromosomal=True, inter_chromosomal=False):
+    """
+    Average O/E values of region pairs, grouped by percentile classes of a vector.
+
+    Regions are assigned to classes using percentile cutoffs of the vector
+    (e.g. the AB compartment eigenvector), and O/E values of all mappable
+    region pairs are averaged for every combination of classes. Region pairs
+    without a contact have an O/E value of 1. Sums are accumulated with
+    :func:`numpy.bincount` over the sparse matrix entries, so the O/E matrix
+    is never assembled in dense form.
+
+    :param matrix: :class:`~fanc.matrix.RegionMatrixContainer`
+    :param vector: Vector with one value per region in matrix
+    :param mappable: Boolean vector of mappable regions. Defaults to :code:`matrix.mappable()`
+    :param per_chromosome: If True (default), use all region pairs of every
+                           (pair of) chromosome(s). Otherwise use the upper
+                           triangle of the whole-genome matrix
+    :param percentiles: Percentile cutoffs of vector values used for the classes
+    :param symmetric_at: Calculate percentiles separately for values
+                         below/equal and above this value
+    :param exclude_chromosomes: Chromosomes to ignore
+    :param intra_chromosomal: If True (default), include intra-chromosomal
+                              region pairs. If an integer, only include
+                              intra-chromosomal pairs at least this far apart (in bp)
+    :param inter_chromosomal: If True, include inter-chromosomal region pairs
+    :return: log2 enrichment matrix, class cutoffs (in reverse order)
+    """
+    vector = np.asarray(vector, dtype=np.float64)
+    chromosome_bins = matrix.chromosome_bins
+    chromosomes = [chromosome for chromosome in matrix.chromosomes()
+                   if chromosome not in exclude_chromosomes]
+
     if len(exclude_chromosomes) > 0:
-        chromosome_bins = matrix.chromosome_bins
-        exclude_vector = []
-        for chromosome in matrix.chromosomes():
-            if chromosome not in exclude_chromosomes:
-                b = chromosome_bins[chromosome]
-                for v in vector[b[0]:b[1]]:
-                    exclude_vector.append(v)
-                # exclude_vector += vector[b[0]:b[1]]
+        exclude_vector = np.concatenate([vector[chromosome_bins[chromosome][0]:chromosome_bins[chromosome][1]]
+                                         for chromosome in chromosomes])
     else:
         exclude_vector = vector
-    exclude_vector = np.array(exclude_vector)
 
     if symmetric_at is not None:
         lv = exclude_vector[exclude_vector <= symmetric_at]
@@ -33,85 +85,75 @@ def vector_enrichment_profile(matrix, vector, mappable=None, per_chromosome=True
         bin_cutoffs = np.nanpercentile(exclude_vector, percentiles)
 
     if isinstance(intra_chromosomal, bool):
-        if intra_chromosomal:
-            intra_chromosomal = 0
-        else:
-            intra_chromosomal = -1
-
-    bins = []
-    for value in vector:
-        bins.append(bisect_left(bin_cutoffs, value))
+        min_distance = 0
+    else:
+        min_distance = int(np.ceil(intra_chromosomal / matrix.bin_size)) if intra_chromosomal > 0 else 0
+        intra_chromosomal = True
 
+    # classes in reverse order of cutoffs; values beyond the last cutoff
+    # (or NaN) end up in the last class
     s = len(bin_cutoffs)
-    m = np.zeros((s, s))
-    c = np.zeros((s, s))
+    classes = (s - 1 - np.digitize(vector, bin_cutoffs, right=True)) % s
 
-    bin_size = matrix.bin_size
     if mappable is None:
         mappable = matrix.mappable()
+    mappable = np.asarray(mappable, dtype=bool)
+    classes[~mappable] = -1
 
-    if per_chromosome:
-        chromosomes = matrix.chromosomes()
-        for chr1_ix in range(len(chromosomes)):
-            chromosome1 = chromosomes[chr1_ix]
-            if chromosome1 in exclude_chromosomes:
-                continue
-
-            for chr2_ix in range(chr1_ix, len(chromosomes)):
-                chromosome2 = chromosomes[chr2_ix]
-                if chromosome2 in exclude_chromosomes:
-                    continue
-
-                is_intra_chromosomal = chromosome1 == chromosome2
-
-                if not inter_chromosomal and not is_intra_chromosomal:
-                    continue
-
-                oem = matrix.matrix((chromosome1, chromosome2),
-                                    oe=True, oe_per_chromosome=True)
-                for i, row_region in enumerate(oem.row_regions):
-                    if not mappable[row_region.ix]:
-                        continue
-                    i_bin = s - bins[row_region.ix] - 1
-                    for j, col_region in enumerate(oem.col_regions):
-                        if not mappable[col_region.ix]:
-                            continue
-
-                        if is_intra_chromosomal and abs(j - i) * bin_size < intra_chromosomal:
-                            continue
-
-                        j_bin = s - bins[col_region.ix] - 1
-                        value = oem[i, j]
-
-                        m[i_bin, j_bin] += value
-                        c[i_bin, j_bin] += 1
-                        m[j_bin, i_bin] += value
-                        c[j_bin, i_bin] += 1
-    else:
-        oem = matrix.matrix(oe=True)
-        for i in range(oem.shape):
-            if not mappable[i]:
-                continue
-            i_bin = s - bins[i] - 1
-            for j in range(i, oem.shape):
-                if not mappable[j]:
-                    continue
-
-                is_intra_chromosomal = oem.row_regions[i].chromosome == oem.col_regions[j].chromosome
-
-                if is_intra_chromosomal:
-                    if abs(j - i) * bin_size < intra_chromosomal:
-                        continue
-                elif not inter_chromosomal:
-                    continue
-
-                j_bin = s - bins[j] - 1
-                value = oem[i, j]
-
-                m[i_bin, j_bin] += value
-                c[i_bin, j_bin] += 1
-                m[j_bin, i_bin] += value
-                c[j_bin, i_bin] += 1
+    m = np.zeros((s, s))
+    c = np.zeros((s, s))
+
+    def _oe_sums(key, upper_only=False):
+        # sums of (O/E - 1) over region pairs with an entry. Pairs without
+        # entry have an O/E of 1, and are accounted for by the pair counts
+        row_regions, col_regions, (i, j, weights) = matrix._regions_and_matrix_arrays(key, oe=True,
+                                                                                      oe_per_chromosome=True)
+        in_bounds = np.logical_and(i < len(row_regions), j < len(col_regions))
+        sources = i[in_bounds] + row_regions[0].ix
+        sinks = j[in_bounds] + col_regions[0].ix
+        weights = weights[in_bounds]
+
+        keep = np.logical_and(classes[sources] >= 0, classes[sinks] >= 0)
+        if upper_only:
+            keep &= sources <= sinks
+        if min_distance > 0 and row_regions[0].chromosome == col_regions[0].chromosome:
+            keep &= np.abs(sources - sinks) >= min_distance
+        sources, sinks = sources[keep], sinks[keep]
+        return _class_pair_sums(classes[sources], classes[sinks], weights[keep] - 1, s)
+
+    def _class_counts(chromosome):
+        start, end = chromosome_bins[chromosome]
+        chromosome_classes = classes[start:end]
+        return chromosome_classes, np.bincount(chromosome_classes[chromosome_classes >= 0], minlength=s)
+
+    for chr1_ix, chromosome1 in enumerate(chromosomes):
+        classes1, counts1 = _class_counts(chromosome1)
+
+        if intra_chromosomal:
+            # all ordered region pairs of the chromosome
+            pair_counts = np.outer(counts1, counts1) - _short_range_pair_counts(classes1, min_distance, s)
+            if per_chromosome:
+                values = pair_counts + _oe_sums((chromosome1, chromosome1))
+                m += values + values.T
+                c += pair_counts + pair_counts.T
+            else:
+                # upper triangle only, so diagonal pairs are counted twice
+                # and all other pairs once when adding the transpose
+                if min_distance == 0:
+                    pair_counts += np.diag(counts1)
+                oe_sums = _oe_sums((chromosome1, chromosome1), upper_only=True)
+                m += pair_counts + oe_sums + oe_sums.T
+                c += pair_counts
+
+        if not inter_chromosomal:
+            continue
+
+        for chromosome2 in chromosomes[chr1_ix + 1:]:
+            classes2, counts2 = _class_counts(chromosome2)
+            pair_counts = np.outer(counts1, counts2)
+            values = pair_counts + _oe_sums((chromosome1, chromosome2))
+            m += values + values.T
+            c += pair_counts + pair_counts.T
 
     m /= c
     # m[c == 0] = 0
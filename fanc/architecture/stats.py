@@ -1,26 +1,157 @@
-def cis_trans_ratio(hic, normalise=False):
+import logging
+
+import numpy as np
+import pandas as pd
+
+from ..tools.general import RareUpdateProgressBar
+
+logger = logging.getLogger(__name__)
+
+
+def _cis_trans_edge_chunks(hic):
+    """
+    Iterate over all (unnormalised) edges of a Hic object in chunks.
+
+    For partitioned edge tables, partitions that lie entirely within a single
+    chromosome each are labelled with their chromosome indexes, so that
+    inter-chromosomal partitions can be summed up without looking at
+    individual edges.
+
+    :return: iterator over (sources, sinks, weights, chromosome_pair) tuples,
+             where chromosome_pair is a tuple of chromosome indexes, or None
+             if the chunk can contain edges from several chromosome pairs
+    """
+    try:
+        edge_tables = list(hic._iter_edge_tables())
+        partition_breaks = list(hic._partition_breaks)
+    except (AttributeError, TypeError):
+        edges = hic.edges_array(norm=False, as_dict=True)
+        yield edges['source'], edges['sink'], edges[hic._default_score_field], None
+        return
+
+    chromosome_ixs = hic._region_chromosome_ix_array()
+    partition_starts = [0] + partition_breaks
+    partition_ends = partition_breaks + [len(chromosome_ixs)]
+    partition_chromosomes = []
+    for start, end in zip(partition_starts, partition_ends):
+        if end > start and chromosome_ixs[start] == chromosome_ixs[end - 1]:
+            partition_chromosomes.append(chromosome_ixs[start])
+        else:
+            partition_chromosomes.append(None)
+
+    weight_field = hic._default_score_field
+    with RareUpdateProgressBar(max_value=len(edge_tables), prefix='Cis/trans') as pb:
+        for i, ((source_partition, sink_partition), edge_table) in enumerate(edge_tables):
+            chromosome_pair = None
+            if (partition_chromosomes[source_partition] is not None
+                    and partition_chromosomes[sink_partition] is not None):
+                chromosome_pair = (partition_chromosomes[source_partition],
+                                   partition_chromosomes[sink_partition])
+
+            for rows in hic._edge_table_arrays(edge_table):
+                yield rows['source'], rows['sink'], rows[weight_field], chromosome_pair
+            pb.update(i + 1)
+
+
+def cis_trans_statistics(hic, distance_breaks=(20000, 100000, 1000000, 10000000)):
+    """
+    Calculate cis and trans contacts for a Hic object, genome-wide, per
+    chromosome, and by distance, in a single pass over all edges.
+
+    Edges in partitions connecting two different chromosomes are only
+    summed up, the chromosome of each individual edge is only looked up for
+    partitions containing intra-chromosomal edges.
+
+    :param hic: :class:`~fanc.Hic` object
+    :param distance_breaks: Genomic distances (in base pairs) separating the
+                            distance strata of cis contacts
+    :return: tuple (cis, trans, chromosome table, distance table). The
+             chromosome table (:class:`~pandas.DataFrame`) lists cis and
+             trans contacts and the cis/trans ratio for each chromosome
+             (trans contacts count towards both chromosomes). The
+             distance table lists cis contacts by distance stratum,
+             and their fraction of all contacts
+    """
+    chromosomes = hic.chromosomes()
+    try:
+        starts = hic._region_array('start').astype(np.int64)
+    except AttributeError:
+        starts = np.array([region.start for region in hic.regions(lazy=True)], dtype=np.int64)
+    chromosome_ixs = np.zeros(len(starts), dtype=np.int64)
+    for i, chromosome in enumerate(chromosomes):
+        start, end = hic.chromosome_bins[chromosome]
+        chromosome_ixs[start:end] = i
+
+    distance_breaks = np.array(distance_breaks, dtype=np.int64)
+    chromosome_cis = np.zeros(len(chromosomes))
+    chromosome_trans = np.zeros(len(chromosomes))
+    distance_cis = np.zeros(len(distance_breaks) + 1)
+    for sources, sinks, weights, chromosome_pair in _cis_trans_edge_chunks(hic):
+        if chromosome_pair is not None and chromosome_pair[0] != chromosome_pair[1]:
+            total = np.sum(weights)
+            chromosome_trans[chromosome_pair[0]] += total
+            chromosome_trans[chromosome_pair[1]] += total
+            continue
+
+        source_chromosomes = chromosome_ixs[sources]
+        sink_chromosomes = chromosome_ixs[sinks]
+        is_cis = source_chromosomes == sink_chromosomes
+
+        cis_weights = weights[is_cis]
+        chromosome_cis += np.bincount(source_chromosomes[is_cis], weights=cis_weights,
+                                      minlength=len(chromosomes))
+        distances = np.abs(starts[sinks[is_cis]] - starts[sources[is_cis]])
+        distance_cis += np.bincount(np.digitize(distances, distance_breaks), weights=cis_weights,
+                                    minlength=len(distance_cis))
+
+        is_trans = ~is_cis
+        trans_weights = weights[is_trans]
+        chromosome_trans += np.bincount(source_chromosomes[is_trans], weights=trans_weights,
+                                        minlength=len(chromosomes))
+        chromosome_trans += np.bincount(sink_chromosomes[is_trans], weights=trans_weights,
+                                        minlength=len(chromosomes))
+
+    cis = np.sum(chromosome_cis)
+    # every trans contact was counted for both of its chromosomes
+    trans = np.sum(chromosome_trans) / 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chromosome_table = pd.DataFrame({
+            'chromosome': chromosomes,
+            'cis': chromosome_cis,
+            'trans': chromosome_trans,
+            'ratio': chromosome_cis / (chromosome_cis + chromosome_trans),
+        })
+        distance_table = pd.DataFrame({
+            'min_distance': np.concatenate([[0], distance_breaks]),
+            'max_distance': np.concatenate([distance_breaks, [np.inf]]),
+            'cis': distance_cis,
+            'fraction': distance_cis / (cis + trans),
+        })
+
+    return cis, trans, chromosome_table, distance_table
+
+
+def cis_trans_ratio(hic, normalise=False, details=False):
     """
     Calculate the cis/trans ratio for a Hic object.
 
     :param hic: :class:`~fanc.Hic` object
     :param normalise: If True, will normalise ratio to the possible number of cis/trans contacts
                       in this genome. Makes ratio comparable across different genomes
-    :return: tuple (ratio, cis, trans, factor)
+    :param details: If True, also return the chromosome and distance tables
+                    from :func:`~cis_trans_statistics`
+    :return: tuple (ratio, cis, trans, factor), or, with details,
+             tuple (ratio, cis, trans, factor, chromosome table, distance table)
     """
-    cis = 0
-    trans = 0
-    regions_dict = hic.regions_dict
-    for edge in hic.edges(lazy=True, norm=False):
-        if regions_dict[edge.source].chromosome == regions_dict[edge.sink].chromosome:
-            cis += edge.weight
-        else:
-            trans += edge.weight
-    if not normalise:
-        return cis / (cis + trans), cis, trans, 1.0
-
-    intra_total, chromosome_intra_total, inter_total = hic.possible_contacts()
-
-    f = intra_total / inter_total
+    cis, trans, chromosome_table, distance_table = cis_trans_statistics(hic)
 
-    return cis / (cis + trans * f), cis, trans, f
+    f = 1.0
+    if normalise:
+        intra_total, chromosome_intra_total, inter_total = hic.possible_contacts()
+        f = np.sum(intra_total) / inter_total
 
+    r = cis / (cis + trans * f)
+    if details:
+        return r, cis, trans, f, chromosome_table, distance_table
+    return r, cis, trans, f
@@ -2097,6 +2097,15 @@ def pca_parser():
         help='''Ignore pixels with no contacts in any sample.'''
     )
 
+    parser.add_argument(
+        '--out-of-core', dest='out_of_core',
+        action='store_true',
+        default=False,
+        help='''Stream contacts from all samples in chunks instead of
+                loading them into memory first. Use this for many or
+                high-resolution samples.'''
+    )
+
     parser.add_argument(
         '-S', '--no-scaling', dest='scaling',
         action='store_false',
@@ -2148,6 +2157,7 @@ def pca(argv, **kwargs):
     markers = args.markers
     eigenvectors = args.eigenvectors
     scale = args.scaling
+    out_of_core = args.out_of_core
     force = args.force_overwrite
     tmp = args.tmp
 
@@ -2195,7 +2205,7 @@ def pca(argv, **kwargs):
                                         min_distance=min_distance, max_distance=max_distance,
                                         min_libraries_above_background=1,
                                         inter_chromosomal=inter_chromosomal,
-                                        scale=scale)
+                                        scale=scale, out_of_core=out_of_core)
             variance = pca_info.explained_variance_ratio_
 
             with open(output_file, 'w') as o:
@@ -3167,6 +3177,13 @@ def directionality_parser():
              'for this region.'
     )
 
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        type=int,
+        default=1,
+        help='Number of chromosomes processed in parallel'
+    )
+
     parser.add_argument(
         '-tmp', '--work-in-tmp', dest='tmp',
         action='store_true',
@@ -3190,6 +3207,7 @@ def directionality(argv, **kwargs):
     output_format = args.output_format
     sub_region = args.region
     window_sizes = args.window_sizes
+    threads = args.threads
     tmp = args.tmp
 
     if output_format.lower() not in ['directionality_index', 'bed', 'gff', 'bigwig', 'bw']:
@@ -3198,7 +3216,8 @@ def directionality(argv, **kwargs):
     _domain_scores(parser, input_file, output_file, output_format,
                    'directionality_index', DirectionalityIndexes,
                    sub_region=sub_region, tmp=tmp,
-                   tmpdir=tmp, window_sizes=window_sizes)
+                   tmpdir=tmp, window_sizes=window_sizes,
+                   threads=threads)
 
 
 def insulation_parser():
@@ -4159,6 +4178,14 @@ def aggregate_parser():
         help='Maximum saturation value in image'
     )
 
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        type=int,
+        default=1,
+        help='Number of worker processes used to extract '
+             'and aggregate submatrices. Default: 1'
+    )
+
     parser.add_argument(
         '-tmp', '--work-in-tmp', dest='tmp',
         action='store_true',
@@ -4170,10 +4197,18 @@ def aggregate_parser():
         '-C', '--no-cache', dest='cache',
         action='store_false',
         default=True,
-        help='Do not cache chromosome matrices. '
-             'Slower, but saves a lot of memory. '
-             'Use this if you are having trouble '
-             'with memory usage.'
+        help='Do not extract sub-matrices in batches. '
+             'Much slower, use only if you are having '
+             'trouble with memory usage even with a '
+             'small --cache-memory.'
+    )
+
+    parser.add_argument(
+        '--cache-memory', dest='cache_memory',
+        default='500M',
+        help='Approximate memory (in bytes) used for the matrix '
+             'of each batch of sub-matrices. Accepts abbreviated '
+             'numbers, e.g. 2G. Default: 500M'
     )
 
     parser.add_argument(
@@ -4229,6 +4264,8 @@ def aggregate(argv, **kwargs):
     vmin = args.vmin
     vmax = args.vmax
     cache = args.cache
+    cache_memory = args.cache_memory
+    threads = args.threads
     keep_submatrices = args.keep_submatrices
     region_viewpoint = args.region_viewpoint
     orient_strand = args.orient_strand
@@ -4288,6 +4325,7 @@ def aggregate(argv, **kwargs):
 
     if window is not None:
         window = str_to_int(window)
+    cache_memory = str_to_int(cache_memory)
 
     aggregate_matrix = None
     regions = None
@@ -4316,6 +4354,8 @@ def aggregate(argv, **kwargs):
                                                                          oe=oe, log=log,
                                                                          orient_strand=orient_strand,
                                                                          cache=cache,
+                                                                         cache_memory=cache_memory,
+                                                                         threads=threads,
                                                                          region_viewpoint=region_viewpoint)
                     if labels is None:
                         left = int(pixels / 2)
@@ -4332,6 +4372,8 @@ def aggregate(argv, **kwargs):
                                                                        oe=oe, log=log,
                                                                        orient_strand=orient_strand,
                                                                        cache=cache,
+                                                                       cache_memory=cache_memory,
+                                                                       threads=threads,
                                                                        region_viewpoint=region_viewpoint)
 
                         if labels is None:
@@ -4354,7 +4396,9 @@ def aggregate(argv, **kwargs):
                                                                         tmpdir=tmp,
                                                                         oe=oe, log=log,
                                                                         orient_strand=orient_strand,
-                                                                        cache=cache)
+                                                                        cache=cache,
+                                                                        cache_memory=cache_memory,
+                                                                        threads=threads)
             else:
                 aggregate_matrix = matrix
 
@@ -4610,6 +4654,14 @@ def cis_trans_parser():
         help='''Normalise ratio to the prior ratio of possible cis / trans contacts.'''
     )
     parser.set_defaults(normalise=False)
+
+    parser.add_argument(
+        '-d', '--details', dest='details',
+        action='store_true',
+        default=False,
+        help='''Also print cis and trans contacts per chromosome,
+                and the fraction of cis contacts by distance.'''
+    )
     return parser
 
 
@@ -4620,6 +4672,7 @@ def cis_trans(argv, **kwargs):
     hic_files = [os.path.expanduser(f) for f in args.hic]
     output_file = os.path.expanduser(args.output) if args.output is not None else None
     normalise = args.normalise
+    details = args.details
 
     import fanc
     from fanc.architecture.stats import cis_trans_ratio
@@ -4631,7 +4684,7 @@ def cis_trans(argv, **kwargs):
     for hic_file in hic_files:
         hic = fanc.load(hic_file, mode='r')
 
-        r, cis, trans, f = cis_trans_ratio(hic, normalise)
+        r, cis, trans, f, chromosome_stats, distance_stats = cis_trans_ratio(hic, normalise, details=True)
 
         if output_file:
             with open(output_file, 'a') as o:
@@ -4641,6 +4694,16 @@ def cis_trans(argv, **kwargs):
         print("\ttrans: {}".format(trans))
         print("\tratio: {:.3f}".format(r))
         print("\tfactor: {:.3f}".format(f))
+
+        if details:
+            print("\tchromosomes:")
+            for row in chromosome_stats.itertuples():
+                print("\t\t{}\tcis: {}\ttrans: {}\tratio: {:.3f}".format(row.chromosome, row.cis,
+                                                                       row.trans, row.ratio))
+            print("\tcis fraction by distance:")
+            for row in distance_stats.itertuples():
+                print("\t\t{:.0f}-{:.0f}\tcis: {}\tfraction: {:.3f}".format(row.min_distance, row.max_distance,
+                                                                    row.cis, row.fraction))
         hic.close()
 
 
@@ -17,7 +17,7 @@ import tempfile
 import gzip
 import shutil
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -256,8 +256,77 @@ class LazyJuicerEdge(Edge):
         return ['weight']
 
 
+_block_dtype_v6 = np.dtype([('x', '<i4'), ('y', '<i4'), ('weight', '<f4')])
+_block_row_dtype_short = np.dtype([('x', '<i2'), ('weight', '<i2')])
+_block_row_dtype_float = np.dtype([('x', '<i2'), ('weight', '<f4')])
+
+
+def _decode_block(block, version):
+    """
+    Decode the records in a decompressed Juicer matrix block.
+
+    :param block: decompressed block bytes
+    :param version: Juicer file version
+    :return: tuple of numpy arrays (x, y, weight)
+    """
+    n_records = struct.unpack('<i', block[0:4])[0]
+    if version < 7:
+        records = np.frombuffer(block, dtype=_block_dtype_v6, count=n_records, offset=4)
+        return (records['x'].astype(np.int64), records['y'].astype(np.int64),
+                records['weight'].astype(np.float64))
+
+    x_offset, y_offset = struct.unpack('<ii', block[4:12])
+    use_short = not struct.unpack('<b', block[12:13])[0] == 0
+    block_type = struct.unpack('<b', block[13:14])[0]
+
+    if block_type == 1:
+        row_dtype = _block_row_dtype_float if use_short else _block_row_dtype_short
+        row_count = struct.unpack('<h', block[14:16])[0]
+        offset = 16
+        xs, ys, weights = [], [], []
+        for _ in range(row_count):
+            y_raw, col_count = struct.unpack('<hh', block[offset:offset + 4])
+            offset += 4
+            records = np.frombuffer(block, dtype=row_dtype, count=col_count, offset=offset)
+            offset += col_count * row_dtype.itemsize
+            xs.append(records['x'])
+            ys.append(np.full(col_count, y_raw, dtype=np.int64))
+            weights.append(records['weight'])
+
+        if len(xs) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        x = np.concatenate(xs).astype(np.int64) + x_offset
+        y = np.concatenate(ys) + y_offset
+        weight = np.concatenate(weights).astype(np.float64)
+        return x, y, weight
+    elif block_type == 2:
+        n_points, w = struct.unpack('<ih', block[14:20])
+        if use_short:
+            weight = np.frombuffer(block, dtype='<f4', count=n_points, offset=20)
+            valid = ~np.isnan(weight)
+        else:
+            weight = np.frombuffer(block, dtype='<i2', count=n_points, offset=20)
+            valid = weight != -32768
+        ixs = np.arange(n_points, dtype=np.int64)[valid]
+        row = ixs // w
+        col = ixs - row * w
+        return col + x_offset, row + y_offset, weight[valid].astype(np.float64)
+
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+
 class JuicerHic(RegionMatrixContainer):
-    def __init__(self, hic_file, resolution=None, norm='KR'):
+    def __init__(self, hic_file, resolution=None, norm='KR', block_cache_size=500):
+        """
+        Read-only access to Juicer .hic files.
+
+        :param hic_file: Path to Juicer .hic file. Resolution can be appended
+                         in the form <path>@<resolution>
+        :param resolution: Matrix resolution in base pairs
+        :param norm: Normalisation vector name, e.g. 'KR', 'VC', or 'NONE'
+        :param block_cache_size: Maximum number of decoded matrix blocks kept
+                                 in memory for repeated queries
+        """
         RegionMatrixContainer.__init__(self)
         if '@' in hic_file:
             hic_file, at_resolution = hic_file.split("@")
@@ -266,6 +335,12 @@ class JuicerHic(RegionMatrixContainer):
                                  "{} and {}".format(at_resolution, resolution))
             resolution = int(at_resolution)
         self._hic_file = hic_file
+        self._header_cache = None
+        self._footer_cache = None
+        self._normalisation_vector_position_cache = None
+        self._block_index_cache = dict()
+        self._block_cache = OrderedDict()
+        self._block_cache_size = block_cache_size
 
         bp_resolutions, _ = self.resolutions()
         if resolution is None:
@@ -288,16 +363,59 @@ class JuicerHic(RegionMatrixContainer):
     def __exit__(self, exc_type, exc_val, exc_tb):
         return True
 
+    def _header(self):
+        """
+        Parse (once) and return the header of the .hic file.
+        """
+        if self._header_cache is not None:
+            return self._header_cache
+
+        with open(self._hic_file, 'rb') as req:
+            req.read(4)  # skip magic
+            version = struct.unpack('<i', req.read(4))[0]
+            master_index = struct.unpack('<q', req.read(8))[0]
+            _read_cstr(req)  # skip genome
+
+            attributes = {}
+            n_attributes = struct.unpack('<i', req.read(4))[0]
+            for _ in range(0, n_attributes):
+                key = _read_cstr(req)
+                value = _read_cstr(req)
+                attributes[key] = value
+
+            chromosome_lengths = []
+            n_chromosomes = struct.unpack('<i', req.read(4))[0]
+            for _ in range(0, n_chromosomes):
+                name = _read_cstr(req)
+                length = struct.unpack('<i', req.read(4))[0]
+                chromosome_lengths.append((name, length))
+
+            resolutions = []
+            n_resolutions = struct.unpack('<i', req.read(4))[0]
+            for _ in range(0, n_resolutions):
+                resolutions.append(struct.unpack('<i', req.read(4))[0])
+
+            fragment_resolutions = []
+            n_fragment_resolutions = struct.unpack('<i', req.read(4))[0]
+            for _ in range(0, n_fragment_resolutions):
+                fragment_resolutions.append(struct.unpack('<i', req.read(4))[0])
+
+        self._header_cache = {
+            'version': version,
+            'master_index': master_index,
+            'attributes': attributes,
+            'chromosome_lengths': chromosome_lengths,
+            'resolutions': resolutions,
+            'fragment_resolutions': fragment_resolutions,
+        }
+        return self._header_cache
+
     @property
     def version(self):
-        with open(self._hic_file, 'rb') as req:
-            req.read(4)  # jump to version location
-            return struct.unpack('<i', req.read(4))[0]
+        return self._header()['version']
 
     def _master_index(self):
-        with open(self._hic_file, 'rb') as req:
-            req.read(8)  # jump to master index location
-            return struct.unpack('<q', req.read(8))[0]
+        return self._header()['master_index']
 
     @staticmethod
     def _skip_to_attributes(req):
@@ -348,42 +466,17 @@ class JuicerHic(RegionMatrixContainer):
 
     @property
     def juicer_attributes(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_attributes(req)
-            attributes = {}
-            n_attributes = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_attributes):
-                key = _read_cstr(req)
-                value = _read_cstr(req)
-                attributes[key] = value
-        return attributes
+        return dict(self._header()['attributes'])
 
     @property
     def chromosome_lengths(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_chromosome_lengths(req)
-
-            chromosome_lengths = {}
-            n_chromosomes = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_chromosomes):
-                name = _read_cstr(req)
-                length = struct.unpack('<i', req.read(4))[0]
-                chromosome_lengths[name] = length
-
+        chromosome_lengths = {}
+        for name, length in self._header()['chromosome_lengths']:
+            chromosome_lengths[name] = length
         return chromosome_lengths
 
     def _all_chromosomes(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_chromosome_lengths(req)
-
-            chromosomes = []
-            n_chromosomes = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_chromosomes):
-                name = _read_cstr(req)
-                req.read(4)
-                chromosomes.append(name)
-
-        return chromosomes
+        return [name for name, _ in self._header()['chromosome_lengths']]
 
     def chromosomes(self):
         chromosomes = []
@@ -394,22 +487,8 @@ class JuicerHic(RegionMatrixContainer):
         return chromosomes
 
     def resolutions(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_resolutions(req)
-
-            resolutions = []
-            n_resolutions = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_resolutions):
-                resolution = struct.unpack('<i', req.read(4))[0]
-                resolutions.append(resolution)
-
-            fragment_resolutions = []
-            n_fragment_resolutions = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_fragment_resolutions):
-                resolution = struct.unpack('<i', req.read(4))[0]
-                fragment_resolutions.append(resolution)
-
-            return resolutions, fragment_resolutions
+        header = self._header()
+        return list(header['resolutions']), list(header['fragment_resolutions'])
 
     @staticmethod
     def _skip_to_footer(req):
@@ -442,12 +521,10 @@ class JuicerHic(RegionMatrixContainer):
             req.read(4)
 
             n_values = struct.unpack('<i', req.read(4))[0]
-            for j in range(n_values):
-                req.read(8)
+            req.seek(8 * n_values, 1)
 
             n_scaling_factors = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_scaling_factors):
-                req.read(12)
+            req.seek(12 * n_scaling_factors, 1)
 
     @staticmethod
     def _skip_to_normalisation_vectors(req):
@@ -462,17 +539,17 @@ class JuicerHic(RegionMatrixContainer):
             req.read(4)
 
             n_values = struct.unpack('<i', req.read(4))[0]
-            for j in range(n_values):
-                req.read(8)
+            req.seek(8 * n_values, 1)
 
             n_scaling_factors = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_scaling_factors):
-                req.read(12)
+            req.seek(12 * n_scaling_factors, 1)
 
     def _matrix_positions(self):
         """
         Copyright (c) 2016 Aiden Lab
         """
+        if self._footer_cache is not None:
+            return self._footer_cache
 
         with open(self._hic_file, 'rb') as req:
             JuicerHic._skip_to_footer(req)
@@ -484,7 +561,38 @@ class JuicerHic(RegionMatrixContainer):
                 file_position = struct.unpack('<q', req.read(8))[0]
                 req.read(4)  # skip size in bytes
                 chromosome_pair_positions[key] = file_position
-            return chromosome_pair_positions
+
+        self._footer_cache = chromosome_pair_positions
+        return chromosome_pair_positions
+
+    def _normalisation_vector_positions(self):
+        """
+        Parse (once) the file positions of all normalisation vectors,
+        keyed by (normalisation, chromosome index, unit, resolution).
+        """
+        if self._normalisation_vector_position_cache is not None:
+            return self._normalisation_vector_position_cache
+
+        with open(self._hic_file, 'rb') as req:
+            JuicerHic._skip_to_normalisation_vectors(req)
+
+            positions = {}
+            n_entries = struct.unpack('<i', req.read(4))[0]
+            for _ in range(n_entries):
+                entry_normalisation = _read_cstr(req)
+                entry_chromosome_index = struct.unpack('<i', req.read(4))[0]
+                entry_unit = _read_cstr(req)
+                entry_resolution = struct.unpack('<i', req.read(4))[0]
+                file_position = struct.unpack('<q', req.read(8))[0]
+                req.read(4)  # skip size in bytes
+
+                key = (entry_normalisation, entry_chromosome_index, entry_unit, entry_resolution)
+                # first matching entry takes precedence
+                if key not in positions:
+                    positions[key] = file_position
+
+        self._normalisation_vector_position_cache = positions
+        return positions
 
     @staticmethod
     def _expected_value_vectors_from_pos(req, normalisation=None, unit='BP'):
@@ -502,12 +610,8 @@ class JuicerHic(RegionMatrixContainer):
 
             bin_size = struct.unpack('<i', req.read(4))[0]
 
-            ev = []
             n_values = struct.unpack('<i', req.read(4))[0]
-
-            for j in range(n_values):
-                v = struct.unpack('<d', req.read(8))[0]
-                ev.append(v)
+            ev = np.frombuffer(req.read(8 * n_values), dtype='<f8').tolist()
 
             if entry_unit == unit and (normalisation is None or entry_normalisation == normalisation):
                 expected_values[bin_size] = ev
@@ -587,30 +691,14 @@ class JuicerHic(RegionMatrixContainer):
         chromosomes = self.chromosomes()
         chromosome_index = chromosomes.index(chromosome) + 1
 
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_normalisation_vectors(req)
-
-            n_entries = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_entries):
-                entry_normalisation = _read_cstr(req)
-                entry_chromosome_index = struct.unpack('<i', req.read(4))[0]
-                entry_unit = _read_cstr(req)
-                entry_resolution = struct.unpack('<i', req.read(4))[0]
-                file_position = struct.unpack('<q', req.read(8))[0]
-                req.read(4)  # skip size in bytes
+        key = (normalisation, chromosome_index, unit, resolution)
+        file_position = self._normalisation_vector_positions().get(key, None)
+        if file_position is not None:
+            with open(self._hic_file, 'rb') as req:
+                req.seek(file_position)
+                n_values = struct.unpack('<i', req.read(4))[0]
+                return np.frombuffer(req.read(8 * n_values), dtype='<f8').tolist()
 
-                if (entry_chromosome_index == chromosome_index and
-                        entry_normalisation == normalisation and
-                        entry_resolution == resolution and
-                        entry_unit == unit):
-                    req.seek(file_position)
-                    vector = []
-                    n_values = struct.unpack('<i', req.read(4))[0]
-                    for _ in range(n_values):
-                        v = struct.unpack('<d', req.read(8))[0]
-                        vector.append(v)
-
-                    return vector
         raise ValueError("Cannot find normalisation vector that matches "
                          "chromosome: {}, normalisation: {}, "
                          "resolution: {}, unit: {}".format(chromosome, normalisation, resolution, unit))
@@ -734,84 +822,40 @@ class JuicerHic(RegionMatrixContainer):
         return length
 
     def _read_block(self, req, file_position, block_size_in_bytes):
-        req.seek(file_position)
-        block_compressed = req.read(block_size_in_bytes)
-        block = zlib.decompress(block_compressed)
-
-        n_records = struct.unpack('<i', block[0:4])[0]
-        if self.version < 7:
-            for i in range(n_records):
-                x = struct.unpack('<i', block[(12 * i + 4):(12 * i + 8)])[0]
-                y = struct.unpack('<i', block[(12 * i + 8):(12 * i + 12)])[0]
-                weight = struct.unpack('<f', block[(12 * i + 12):(12 * i + 16)])[0]
-                yield x, y, weight
-        else:
-            x_offset = struct.unpack('<i', block[4:8])[0]
-            y_offset = struct.unpack('<i', block[8:12])[0]
-            use_short = not struct.unpack('<b', block[12:13])[0] == 0
-            block_type = struct.unpack('<b', block[13:14])[0]
-            index = 0
-
-            if block_type == 1:
-                row_count = struct.unpack('<h', block[14:16])[0]
-                temp = 16
-                for i in range(row_count):
-                    y_raw = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                    temp += 2
-                    y = y_raw + y_offset
-                    col_count = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                    temp += 2
-                    for j in range(col_count):
-                        x_raw = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                        temp += 2
-                        x = x_offset + x_raw
-                        if not use_short:
-                            weight = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                            temp += 2
-                        else:
-                            weight = struct.unpack('<f', block[temp:(temp + 4)])[0]
-                            temp += 4
-                        yield x, y, weight
-
-                        index += 1
-            elif block_type == 2:
-                temp = 14
-                n_points = struct.unpack('<i', block[temp:(temp + 4)])[0]
-                temp += 4
-                w = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                temp += 2
-                for i in range(n_points):
-                    row = int(i / w)
-                    col = i - row * w
-                    x = int(x_offset + col)
-                    y = int(y_offset + row)
-                    if not use_short:
-                        weight = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                        temp += 2
-                        if weight != -32768:
-                            yield x, y, weight
-                            index += 1
-                    else:
-                        weight = struct.unpack('<f', block[temp:(temp + 4)])[0]
-                        temp += 4
-                        if weight != 0x7fc00000:
-                            yield x, y, weight
-                            index = index + 1
-
-    def _read_matrix(self, region1, region2):
-        region1 = self._convert_region(region1)
-        region2 = self._convert_region(region2)
+        """
+        Read and decode a matrix block.
 
-        chromosomes = self._all_chromosomes()
-        chromosome1_ix = chromosomes.index(region1.chromosome)
-        chromosome2_ix = chromosomes.index(region2.chromosome)
+        Decoded blocks are kept in an LRU cache keyed by their file
+        position, so that repeated queries do not have to read and
+        decompress the same blocks again.
 
-        if chromosome1_ix > chromosome2_ix:
-            region1, region2 = region2, region1
-            chromosome1_ix, chromosome2_ix = chromosome2_ix, chromosome1_ix
+        :return: tuple of numpy arrays (x, y, weight)
+        """
+        try:
+            records = self._block_cache.pop(file_position)
+        except KeyError:
+            req.seek(file_position)
+            block_compressed = req.read(block_size_in_bytes)
+            block = zlib.decompress(block_compressed)
+            records = _decode_block(block, self.version)
+
+        if self._block_cache_size > 0:
+            self._block_cache[file_position] = records
+            while len(self._block_cache) > self._block_cache_size:
+                self._block_cache.popitem(last=False)
+        return records
+
+    def _block_index(self, chromosome1_ix, chromosome2_ix):
+        """
+        Parse (once) the block index of a chromosome pair matrix
+        at the current resolution.
 
-        region1_chromosome_offset = self._chromosome_ix_offset(region1.chromosome)
-        region2_chromosome_offset = self._chromosome_ix_offset(region2.chromosome)
+        :return: tuple (block bin count, block column count,
+                 dict block number: (file position, size in bytes))
+        """
+        key = (chromosome1_ix, chromosome2_ix, self._unit, self._resolution)
+        if key in self._block_index_cache:
+            return self._block_index_cache[key]
 
         matrix_file_position = self._matrix_positions()[(str(chromosome1_ix), str(chromosome2_ix))]
 
@@ -833,56 +877,81 @@ class JuicerHic(RegionMatrixContainer):
                     block_column_count = struct.unpack('<i', req.read(4))[0]
 
                     n_blocks = struct.unpack('<i', req.read(4))[0]
-                    for b in range(n_blocks):
-                        block_number = struct.unpack('<i', req.read(4))[0]
-                        file_position = struct.unpack('<q', req.read(8))[0]
-                        block_size_in_bytes = struct.unpack('<i', req.read(4))[0]
+                    index = np.frombuffer(req.read(16 * n_blocks),
+                                          dtype=[('block_number', '<i4'), ('file_position', '<i8'),
+                                                 ('size', '<i4')])
+                    for block_number, file_position, block_size_in_bytes in index.tolist():
                         block_map[block_number] = (file_position, block_size_in_bytes)
                 else:
                     req.read(8)
 
                     n_blocks = struct.unpack('<i', req.read(4))[0]
-                    for b in range(n_blocks):
-                        req.read(16)
+                    req.seek(16 * n_blocks, 1)
+
+        if block_bin_count is None or block_column_count is None:
+            raise ValueError("Matrix data for {} {} not found!".format(self._resolution, self._unit))
+
+        self._block_index_cache[key] = block_bin_count, block_column_count, block_map
+        return self._block_index_cache[key]
+
+    def _read_matrix(self, region1, region2):
+        region1 = self._convert_region(region1)
+        region2 = self._convert_region(region2)
 
-            if block_bin_count is None or block_column_count is None:
-                raise ValueError("Matrix data for {} {} not found!".format(self._resolution, self._unit))
+        chromosomes = self._all_chromosomes()
+        chromosome1_ix = chromosomes.index(region1.chromosome)
+        chromosome2_ix = chromosomes.index(region2.chromosome)
+
+        if chromosome1_ix > chromosome2_ix:
+            region1, region2 = region2, region1
+            chromosome1_ix, chromosome2_ix = chromosome2_ix, chromosome1_ix
+
+        region1_chromosome_offset = self._chromosome_ix_offset(region1.chromosome)
+        region2_chromosome_offset = self._chromosome_ix_offset(region2.chromosome)
+
+        block_bin_count, block_column_count, block_map = self._block_index(chromosome1_ix, chromosome2_ix)
+
+        region1_bins = int(region1.start / self._resolution), int(region1.end / self._resolution) + 1
+        region2_bins = int(region2.start / self._resolution), int(region2.end / self._resolution) + 1
 
-            region1_bins = int(region1.start / self._resolution), int(region1.end / self._resolution) + 1
-            region2_bins = int(region2.start / self._resolution), int(region2.end / self._resolution) + 1
+        col1, col2 = int(region1_bins[0] / block_bin_count), int(region1_bins[1] / block_bin_count)
+        row1, row2 = int(region2_bins[0] / block_bin_count), int(region2_bins[1] / block_bin_count)
 
-            col1, col2 = int(region1_bins[0] / block_bin_count), int(region1_bins[1] / block_bin_count)
-            row1, row2 = int(region2_bins[0] / block_bin_count), int(region2_bins[1] / block_bin_count)
+        blocks = set()
+        for r in range(row1, row2 + 1):
+            for c in range(col1, col2 + 1):
+                block_number = r * block_column_count + c
+                blocks.add(block_number)
 
-            blocks = set()
-            for r in range(row1, row2 + 1):
-                for c in range(col1, col2 + 1):
+        if region1.chromosome == region2.chromosome:
+            for r in range(col1, col2 + 1):
+                for c in range(row1, row2 + 1):
                     block_number = r * block_column_count + c
                     blocks.add(block_number)
 
-            if region1.chromosome == region2.chromosome:
-                for r in range(col1, col2 + 1):
-                    for c in range(row1, row2 + 1):
-                        block_number = r * block_column_count + c
-                        blocks.add(block_number)
-
+        with open(self._hic_file, 'rb') as req:
             for block_number in blocks:
                 try:
                     file_position, block_size_in_bytes = block_map[block_number]
-
-                    for x, y, weight in self._read_block(req, file_position, block_size_in_bytes):
-                        if x < y:
-                            if region1_bins[0] <= x < region1_bins[1] - 1 and region2_bins[0] <= y < region2_bins[1] - 1:
-                                yield x + region1_chromosome_offset, y + region2_chromosome_offset, weight
-                            elif region1.chromosome == region2.chromosome:
-                                if region1_bins[0] <= y < region1_bins[1] - 1 and region2_bins[0] <= x < region2_bins[1] - 1:
-                                    yield x + region1_chromosome_offset, y + region2_chromosome_offset, weight
-                        else:
-                            if region1_bins[0] <= x < region1_bins[1] - 1 and region2_bins[0] <= y < region2_bins[1] - 1:
-                                yield y + region2_chromosome_offset, x + region1_chromosome_offset, weight
-
                 except KeyError:
                     logger.debug("Could not find block {}".format(block_number))
+                    continue
+
+                x, y, weight = self._read_block(req, file_position, block_size_in_bytes)
+
+                x_in_region1 = np.logical_and(region1_bins[0] <= x, x < region1_bins[1] - 1)
+                y_in_region2 = np.logical_and(region2_bins[0] <= y, y < region2_bins[1] - 1)
+                valid = np.logical_and(x_in_region1, y_in_region2)
+                upper = x < y
+                if region1.chromosome == region2.chromosome:
+                    y_in_region1 = np.logical_and(region1_bins[0] <= y, y < region1_bins[1] - 1)
+                    x_in_region2 = np.logical_and(region2_bins[0] <= x, x < region2_bins[1] - 1)
+                    valid |= np.logical_and(upper, np.logical_and(y_in_region1, x_in_region2))
+
+                source = np.where(upper, x + region1_chromosome_offset, y + region2_chromosome_offset)
+                sink = np.where(upper, y + region2_chromosome_offset, x + region1_chromosome_offset)
+                for row in zip(source[valid].tolist(), sink[valid].tolist(), weight[valid].tolist()):
+                    yield row
 
     def _edges_subset(self, key=None, row_regions=None, col_regions=None,
                       lazy=False, *args, **kwargs):
@@ -61,6 +61,7 @@ pad_with_label: .2
 pad_with_ticks: .1
 pad_next_title: .2
 pad_with_tick_legend: .1
+plot_buffer_size: 1G
 
 #
 # EMAIL
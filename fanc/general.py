@@ -884,15 +884,36 @@ class MaskedTable(t.Table):
     def _has_mask(self, row, mask):
         return mask in self._row_masks(row)
 
-    def _filter(self, mask_filters):
+    def _filter(self, mask_filters, _chunk_size=1000000):
         mask_filter_ixs = [2 ** mask_filter.mask_ix for mask_filter in mask_filters]
         n_rows = self._original_len()
         masks = self.col(self._mask_field)
 
-        for i, row in enumerate(self._iter_visible_and_masked()):
-            for j, mask_filter in enumerate(mask_filters):
-                if not mask_filter.valid(row):
-                    masks[i] = masks[i] | mask_filter_ixs[j]
+        chunk_filters = []
+        row_filters = []
+        for mask_filter, mask_filter_ix in zip(mask_filters, mask_filter_ixs):
+            if mask_filter.has_valid_chunk():
+                chunk_filters.append((mask_filter, mask_filter_ix))
+            else:
+                row_filters.append((mask_filter, mask_filter_ix))
+
+        for start in range(0, n_rows, _chunk_size):
+            stop = min(start + _chunk_size, n_rows)
+            chunk_masks = masks[start:stop]
+
+            if len(chunk_filters) > 0:
+                rows = self.read(start=start, stop=stop)
+                arrays = {name: rows[name] for name in rows.dtype.names}
+                for mask_filter, mask_filter_ix in chunk_filters:
+                    valid = np.asarray(mask_filter.valid_chunk(arrays), dtype=bool)
+                    chunk_masks[~valid] |= mask_filter_ix
+
+            if len(row_filters) > 0:
+                for i, row in enumerate(t.Table.iterrows(self, start, stop)):
+                    for mask_filter, mask_filter_ix in row_filters:
+                        if not mask_filter.valid(row):
+                            chunk_masks[i] |= mask_filter_ix
+
         mask_ixs, masked_length, stats = self._mask_ixs_and_stats_from_masks(masks)
 
         try:
@@ -1016,3 +1037,26 @@ class MaskFilter(with_metaclass(ABCMeta, object)):
             bool: True if row is valid, False otherwise
         """
         pass
+
+    def valid_chunk(self, arrays):
+        """
+        Test the validity of a chunk of rows in vectorised form.
+
+        Filters can optionally implement this method, which is then
+        used by :class:`~MaskedTable` instead of calling
+        :func:`~MaskFilter.valid` on every row.
+
+        Args:
+            arrays (dict): Dictionary of numpy arrays, one per
+                           table column
+
+        Returns:
+            numpy.ndarray: boolean array, True for valid rows
+        """
+        raise NotImplementedError("Filter does not implement valid_chunk")
+
+    def has_valid_chunk(self):
+        """
+        Check if this filter implements :func:`~MaskFilter.valid_chunk`.
+        """
+        return type(self).valid_chunk is not MaskFilter.valid_chunk
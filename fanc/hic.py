@@ -5,16 +5,17 @@ from abc import abstractmethod, ABCMeta
 from future.utils import with_metaclass, string_types, viewitems
 from .tools.load import load
 from .tools.general import distribute_integer, RareUpdateProgressBar
-from .tools.matrix import restore_sparse_rows, remove_sparse_rows
+from .tools.matrix import restore_sparse_rows, remove_sparse_rows, \
+    restore_sparse_rows_sparse, remove_sparse_rows_sparse
 from .general import MaskFilter, MaskedTableView
 from collections import defaultdict
 import multiprocessing as mp
 import threading
 import queue
 import numpy as np
+import scipy.sparse
 import warnings
 import logging
-import msgpack
 import copy
 
 logger = logging.getLogger(__name__)
@@ -109,12 +110,120 @@ def _get_overlap_map(old_regions, new_regions):
     return old_to_new
 
 
-def _bin_hic_partition_worker(hic_file, qin, qout,
-                              overlap_map, _edges_by_overlap_method,
-                              access_lock):
+def _get_overlap_bounds(overlap_map, n_regions):
+    """
+    Convert an overlap map into arrays of the first and last overlapping
+    new region for each old region (-1 if there is no overlap).
+    """
+    first_bins = np.full(n_regions, -1, dtype=np.int64)
+    last_bins = np.full(n_regions, -1, dtype=np.int64)
+    for i, new_regions in overlap_map.items():
+        if len(new_regions) > 0:
+            first_bins[i] = new_regions[0][0]
+            last_bins[i] = new_regions[-1][0]
+    return first_bins, last_bins
+
+
+def _bin_edges_rao(sources, sinks, weights, first_bins, last_bins):
+    """
+    Vectorised equivalent of :func:`~_edge_overlap_split_rao`.
+
+    Maps edges to the bins defined by the first and last overlapping new
+    region of each old region, distributes integer weights across the
+    resulting bin pairs, and sums up weights per bin pair.
 
+    :return: tuple of new source, sink, and weight arrays
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    sinks = np.asarray(sinks, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    first_sources, last_sources = first_bins[sources], last_bins[sources]
+    first_sinks, last_sinks = first_bins[sinks], last_bins[sinks]
+    valid = np.logical_and(first_sources >= 0, first_sinks >= 0)
+
+    a = np.stack([first_sources, first_sources, last_sources, last_sources], axis=1)[valid]
+    b = np.stack([first_sinks, last_sinks, first_sinks, last_sinks], axis=1)[valid]
+    weights = weights[valid]
+    new_sources, new_sinks = np.minimum(a, b), np.maximum(a, b)
+
+    n_bins = max(int(np.max(last_bins)) + 1, 1)
+    pairs = new_sources * n_bins + new_sinks
+
+    # only count each bin pair once per original edge
+    is_unique = np.ones(pairs.shape, dtype=bool)
+    for k in range(1, 4):
+        for l in range(k):
+            is_unique[:, k] = np.logical_and(is_unique[:, k], pairs[:, k] != pairs[:, l])
+    n_pairs = is_unique.sum(axis=1)
+    rank = np.cumsum(is_unique, axis=1) - 1
+
+    # distribute integer weights like distribute_integer, with the
+    # remainder going to randomly selected bin pairs
+    base = np.floor(weights / n_pairs)
+    remaining = weights - base * n_pairs
+    is_integer = remaining == np.round(remaining)
+    shift = (np.random.random(len(weights)) * n_pairs).astype(np.int64)
+    extra = ((rank + shift[:, np.newaxis]) % n_pairs[:, np.newaxis]) < remaining[:, np.newaxis]
+    new_weights = np.where(is_integer[:, np.newaxis],
+                           base[:, np.newaxis] + extra,
+                           (weights / n_pairs)[:, np.newaxis])
+
+    selected = np.logical_and(is_unique, new_weights != 0)
+    pairs, new_weights = pairs[selected], new_weights[selected]
+
+    unique_pairs, inverse = np.unique(pairs, return_inverse=True)
+    binned_weights = np.bincount(inverse.ravel(), weights=new_weights, minlength=len(unique_pairs))
+    return unique_pairs // n_bins, unique_pairs % n_bins, binned_weights
+
+
+def _bin_edges_by_overlap_method(sources, sinks, weights, overlap_map, _edges_by_overlap_method):
+    """
+    Bin edges using a custom overlap method, one edge at a time.
+
+    :return: tuple of new source, sink, and weight arrays
+    """
+    edges = defaultdict(int)
+    for old_source, old_sink, old_weight in zip(sources.tolist(), sinks.tolist(), weights.tolist()):
+        try:
+            for new_source, new_sink, new_weight in _edges_by_overlap_method(
+                    [old_source, old_sink, old_weight], overlap_map):
+                if new_weight != 0:
+                    edges[(new_source, new_sink)] += new_weight
+        except KeyError:
+            warnings.warn("Cannot map edge {}-{}".format(old_source, old_sink))
+
+    new_sources = np.array([source for source, _ in edges.keys()], dtype=np.int64)
+    new_sinks = np.array([sink for _, sink in edges.keys()], dtype=np.int64)
+    new_weights = np.array(list(edges.values()), dtype=np.float64)
+    return new_sources, new_sinks, new_weights
+
+
+def _bin_hic_partition(hic, chromosome1, chromosome2, overlap_bounds,
+                       overlap_map=None, _edges_by_overlap_method=_edge_overlap_split_rao):
+    """
+    Bin the edges of a chromosome pair.
+
+    :return: tuple of new source, sink, and weight arrays
+    """
+    score_field = hic._default_score_field if hic._default_score_field is not None else 'weight'
+    edges = hic.edges_array((chromosome1, chromosome2), norm=False,
+                            fields=[score_field], as_dict=True)
+    sources, sinks, weights = edges['source'], edges['sink'], edges[score_field]
+
+    if _edges_by_overlap_method is _edge_overlap_split_rao:
+        first_bins, last_bins = overlap_bounds
+        return _bin_edges_rao(sources, sinks, weights, first_bins, last_bins)
+    return _bin_edges_by_overlap_method(sources, sinks, weights, overlap_map,
+                                        _edges_by_overlap_method)
+
+
+def _bin_hic_partition_worker(hic_file, qin, qout, overlap_bounds,
+                              overlap_map, _edges_by_overlap_method):
+    hic = None
     try:
-        overlap_map = msgpack.loads(overlap_map)
+        # every worker reads from its own file handle
+        hic = load(hic_file, mode='r')
         while True:
             worker_input = qin.get()
             if worker_input is None:
@@ -124,35 +233,14 @@ def _bin_hic_partition_worker(hic_file, qin, qout,
             chromosome1, chromosome2 = worker_input
             logger.debug("Received {}-{}".format(chromosome1, chromosome2))
 
-            with access_lock:
-                hic = None
-                try:
-                    hic = load(hic_file)
-                    _weight_field = hic._default_score_field
-                    all_edges = []
-                    for edge in hic.edges_dict((chromosome1, chromosome2), lazy=True):
-                        try:
-                            all_edges.append([edge['source'], edge['sink'], edge[_weight_field]])
-                        except KeyError:
-                            all_edges.append([edge['source'], edge['sink'], edge['weight']])
-
-                finally:
-                    if hic is not None:
-                        hic.close()
-
-            edges = defaultdict(int)
-            for old_source, old_sink, old_weight in all_edges:
-                try:
-                    for new_source, new_sink, new_weight in _edges_by_overlap_method(
-                            [old_source, old_sink, old_weight], overlap_map):
-                        if new_weight != 0:
-                            edges[(new_source, new_sink)] += new_weight
-                except KeyError:
-                    warnings.warn("key".format(old_source, old_sink))
-
-            qout.put(msgpack.dumps(edges))
+            qout.put(_bin_hic_partition(hic, chromosome1, chromosome2, overlap_bounds,
+                                        overlap_map=overlap_map,
+                                        _edges_by_overlap_method=_edges_by_overlap_method))
     except Exception as e:
         qout.put(e)
+    finally:
+        if hic is not None:
+            hic.close()
 
 
 class Hic(RegionMatrixTable):
@@ -213,55 +301,48 @@ class Hic(RegionMatrixTable):
 
             # create region "overlap map"
             overlap_map = _get_overlap_map(hic.regions(lazy=False), self.regions(lazy=False))
+            overlap_bounds = _get_overlap_bounds(overlap_map, len(hic.regions))
+            if _edges_by_overlap_method is _edge_overlap_split_rao:
+                # vectorised binning only needs the overlap bounds
+                overlap_map = None
 
-            file_name = hic.file.filename
-            m = mp.Manager()
-            access_lock = m.Lock()
-            qout = m.Queue()
-            qin = m.Queue()
+            if chromosomes is None:
+                chromosomes = hic.chromosomes()
 
             if not isinstance(hic, RegionMatrixTable):
-                edge_counter = 0
-                with RareUpdateProgressBar(max_value=len(hic.edges), silent=config.hide_progressbars,
+                n_chunks = int(len(chromosomes) * (len(chromosomes) + 1) / 2)
+                with RareUpdateProgressBar(max_value=n_chunks, silent=config.hide_progressbars,
                                            prefix="Binning") as pb:
-                    if chromosomes is None:
-                        chromosomes = hic.chromosomes()
+                    chunk_counter = 0
                     for i in range(len(chromosomes)):
                         for j in range(i, len(chromosomes)):
                             logger.debug("Chromosomes: {}-{}".format(chromosomes[i], chromosomes[j]))
-                            edges = defaultdict(int)
-                            for edge in hic.edges_dict((chromosomes[i], chromosomes[j]), lazy=True, norm=False):
-                                old_source, old_sink = edge['source'], edge['sink']
-                                try:
-                                    old_weight = edge[hic._default_score_field]
-                                except KeyError:
-                                    old_weight = edge['weight']
-
-                                for new_source, new_sink, new_weight in _edges_by_overlap_method(
-                                        [old_source, old_sink, old_weight], overlap_map):
-                                    if new_weight != 0:
-                                        edges[(new_source, new_sink)] += new_weight
-
-                                edge_counter += 1
-                                pb.update(edge_counter)
-                            logger.debug("Adding edges {}/{} ({})".format(i, j, len(edges)))
-                            for (source, sink), weight in edges.items():
-                                self.add_edge_simple(source, sink, weight=weight)
+                            sources, sinks, weights = _bin_hic_partition(
+                                hic, chromosomes[i], chromosomes[j], overlap_bounds,
+                                overlap_map=overlap_map,
+                                _edges_by_overlap_method=_edges_by_overlap_method
+                            )
+                            logger.debug("Adding edges {}/{} ({})".format(i, j, len(sources)))
+                            self.add_edges_simple(sources, sinks, weights)
+                            chunk_counter += 1
+                            pb.update(chunk_counter)
             else:
+                file_name = hic.file.filename
+                m = mp.Manager()
+                qout = m.Queue()
+                qin = m.Queue()
+
                 pool = None
                 try:
                     logger.info("Launching processes")
                     pool = mp.Pool(threads, _bin_hic_partition_worker,
                                    (file_name,
                                     qin, qout,
-                                    msgpack.dumps(overlap_map),
-                                    _edges_by_overlap_method,
-                                    access_lock))
+                                    overlap_bounds,
+                                    overlap_map,
+                                    _edges_by_overlap_method))
 
                     logger.info("Submitting partitions")
-                    if chromosomes is None:
-                        chromosomes = hic.chromosomes()
-
                     if len(chromosomes) > 100:
                         warnings.warn("Number of chromosomes ({}) is very large. Consider limiting "
                                       "the processed chromosomes using the 'chromosomes' argument or "
@@ -280,9 +361,8 @@ class Hic(RegionMatrixTable):
                             out = qout.get(block=True)
                             if isinstance(out, Exception):
                                 raise out
-                            edges = msgpack.loads(out, use_list=False)
-                            for (source, sink), weight in edges.items():
-                                self.add_edge_simple(source, sink, weight=weight)
+                            sources, sinks, weights = out
+                            self.add_edges_simple(sources, sinks, weights)
                             pb.update(i)
                 finally:
                     for i in range(threads):
@@ -575,6 +655,9 @@ class DiagonalFilter(HicEdgeFilter):
             return False
         return True
 
+    def valid_chunk(self, arrays):
+        return np.abs(arrays['source'] - arrays['sink']) > self.distance
+
 
 class LowCoverageFilter(HicEdgeFilter):
     """
@@ -625,6 +708,7 @@ class LowCoverageFilter(HicEdgeFilter):
         for i, contacts in enumerate(self._marginals):
             if contacts < cutoff:
                 self._regions_to_mask.add(i)
+        self._region_is_masked = np.asarray(self._marginals) < cutoff
         logger.info("Selected a total of {} ({:.1%}) regions to be masked".format(
             len(self._regions_to_mask), len(self._regions_to_mask)/len(hic_object.regions)))
 
@@ -643,6 +727,10 @@ class LowCoverageFilter(HicEdgeFilter):
             return False
         return True
 
+    def valid_chunk(self, arrays):
+        return np.logical_not(np.logical_or(self._region_is_masked[arrays['source']],
+                                            self._region_is_masked[arrays['sink']]))
+
 
 def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
                   inter_chromosomal=True, intra_chromosomal=True):
@@ -650,39 +738,15 @@ def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
 
     if not whole_matrix:
         bias_vectors = []
+        chromosome_bins = hic.chromosome_bins
         for chromosome in hic.chromosomes():
-            region_converter = dict()
-            bias_vector = []
-            for i, region in enumerate(hic.regions(chromosome)):
-                region_converter[region.ix] = i
-                bias_vector.append(1)
-            bias_vector = np.array(bias_vector, dtype='float64')
-
-            marginal_error = tolerance + 1
-            current_iteration = 0
-
-            edges = [[e['source'], e['sink'], e['weight']]
-                     for e in hic.edges_dict((chromosome, chromosome), lazy=True, norm=False)]
-
-            while (marginal_error > tolerance and
-                   current_iteration <= max_iterations):
-                m = np.zeros(len(bias_vector), dtype='float64')
-                for i in range(len(edges)):
-                    source = region_converter[edges[i][0]]
-                    sink = region_converter[edges[i][1]]
-                    m[source] += edges[i][2]
-                    if source != sink:
-                        m[sink] += edges[i][2]
-
-                bias_vector *= m
-                marginal_error = _marginal_error(m)
-                for i in range(len(edges)):
-                    source = region_converter[edges[i][0]]
-                    sink = region_converter[edges[i][1]]
-                    edges[i][2] = 0 if m[sink] == 0 else edges[i][2] / np.sqrt(m[source]) / np.sqrt(m[sink])
-
-                current_iteration += 1
-                logger.debug("Iteration: %d, error: %lf" % (current_iteration, marginal_error))
+            start, end = chromosome_bins[chromosome]
+            edges = hic.edges_array((chromosome, chromosome), norm=False,
+                                    fields=['weight'], as_dict=True)
+
+            bias_vector = _ice_bias_vector(edges['source'] - start, edges['sink'] - start,
+                                           edges['weight'], end - start,
+                                           tolerance=tolerance, max_iterations=max_iterations)
             bias_vectors.append(bias_vector)
         logger.info("Done.")
         logger.info("Adding bias vector...")
@@ -690,37 +754,55 @@ def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
 
         logger.info("Done.")
     else:
-        bias_vector = np.ones(len(hic.regions), float)
-        marginal_error = tolerance + 1
-        current_iteration = 0
         logger.info("Collecting edges")
-        edges = [[e.source, e.sink, e.weight] for e in hic.edges(norm=False,
-                                                                 intra_chromosomal=intra_chromosomal,
-                                                                 inter_chromosomal=inter_chromosomal)]
+        edges = hic.edges_array(norm=False, fields=['weight'], as_dict=True,
+                                intra_chromosomal=intra_chromosomal,
+                                inter_chromosomal=inter_chromosomal)
         logger.info("Starting iterations")
-        while (marginal_error > tolerance and
-               current_iteration <= max_iterations):
+        bias_vector = _ice_bias_vector(edges['source'], edges['sink'], edges['weight'],
+                                       len(hic.regions), tolerance=tolerance,
+                                       max_iterations=max_iterations)
 
-            m = np.zeros(len(bias_vector), dtype='float64')
-            for i in range(len(edges)):
-                source = edges[i][0]
-                sink = edges[i][1]
-                m[source] += edges[i][2]
-                if source != sink:
-                    m[sink] += edges[i][2]
+    hic.region_data('bias', bias_vector)
+    return bias_vector
 
-            bias_vector *= m
-            marginal_error = _marginal_error(m)
 
-            for i in range(len(edges)):
-                source = edges[i][0]
-                sink = edges[i][1]
-                edges[i][2] = 0 if m[sink] == 0 else edges[i][2]/np.sqrt(m[source])/np.sqrt(m[sink])
+def _ice_bias_vector(sources, sinks, weights, n_regions, tolerance=1e-2, max_iterations=500):
+    """
+    Iteratively correct a sparse, upper-triangular matrix in COO form.
+
+    :param sources: numpy array of row indices
+    :param sinks: numpy array of column indices
+    :param weights: numpy array of (uncorrected) matrix entries
+    :param n_regions: number of rows/columns in the matrix
+    :param tolerance: marginal error (see :func:`~_marginal_error`) at which
+                      to stop iterating
+    :param max_iterations: maximum number of iterations
+    :return: numpy array of biases
+    """
+    weights = np.array(weights, dtype='float64')
+    off_diagonal = sources != sinks
+    off_diagonal_sinks = sinks[off_diagonal]
 
-            current_iteration += 1
-            logger.debug("Iteration: %d, error: %lf" % (current_iteration, marginal_error))
+    bias_vector = np.ones(n_regions, dtype='float64')
+    marginal_error = tolerance + 1
+    current_iteration = 0
+    while (marginal_error > tolerance and
+           current_iteration <= max_iterations):
+        m = np.bincount(sources, weights=weights, minlength=n_regions)
+        m += np.bincount(off_diagonal_sinks, weights=weights[off_diagonal], minlength=n_regions)
+
+        bias_vector *= m
+        marginal_error = _marginal_error(m)
+
+        m_sqrt = np.sqrt(m)
+        m_sqrt[m_sqrt == 0] = np.inf
+        weights /= m_sqrt[sources]
+        weights /= m_sqrt[sinks]
+
+        current_iteration += 1
+        logger.debug("Iteration: %d, error: %lf" % (current_iteration, marginal_error))
 
-    hic.region_data('bias', bias_vector)
     return bias_vector
 
 
@@ -731,34 +813,35 @@ def _marginal_error(marginals, percentile=99.9):
 
 
 def kr_balancing(hic, whole_matrix=True, intra_chromosomal=True, inter_chromosomal=True,
-                 restore_coverage=False):
+                 restore_coverage=False, high_precision=False):
 
     if not whole_matrix:
         bias_vectors = []
         for chromosome in hic.chromosomes():
-            m = hic.matrix((chromosome, chromosome), norm=False)
-            m_corrected, bias_vector_chromosome = correct_matrix(m, restore_coverage=restore_coverage)
+            m = hic.matrix((chromosome, chromosome), norm=False, sparse=True)
+            m_corrected, bias_vector_chromosome = correct_matrix(m, restore_coverage=restore_coverage,
+                                                                 high_precision=high_precision)
             bias_vectors.append(bias_vector_chromosome)
         bias_vector = np.concatenate(bias_vectors)
     else:
         logger.debug("Fetching whole genome matrix")
-        m = hic.matrix(norm=False)
-        cb = hic.chromosome_bins
-        if not intra_chromosomal:
-            for chromosome, bins in cb.items():
-                m[bins[0]:bins[1], bins[0]:bins[1]] = 0
-        if not inter_chromosomal:
-            for chromosome, bins in cb:
-                m[0:bins[0], bins[0]:bins[1]] = 0
-                m[bins[1]:, bins[0]:bins[1]] = 0
-
-        m_corrected, bias_vector = correct_matrix(m, restore_coverage=restore_coverage)
+        m = hic.matrix(norm=False, sparse=True,
+                       intra_chromosomal=intra_chromosomal,
+                       inter_chromosomal=inter_chromosomal)
+
+        m_corrected, bias_vector = correct_matrix(m, restore_coverage=restore_coverage,
+                                                  high_precision=high_precision)
 
     hic.region_data('bias', bias_vector)
     return bias_vector
 
 
-def correct_matrix(m, max_attempts=50, restore_coverage=False):
+def correct_matrix(m, max_attempts=50, restore_coverage=False, high_precision=False):
+    if scipy.sparse.issparse(m):
+        return _correct_sparse_matrix(m, max_attempts=max_attempts,
+                                      restore_coverage=restore_coverage,
+                                      high_precision=high_precision)
+
     # remove zero-sum rows
     removed_rows = []
     m_nonzero, ixs = remove_sparse_rows(m, cutoff=0)
@@ -771,7 +854,7 @@ def correct_matrix(m, max_attempts=50, restore_coverage=False):
         has_errors = False
 
         try:
-            x = get_bias_vector(m_nonzero)
+            x = get_bias_vector(m_nonzero, high_precision=high_precision)
         except ValueError as e:
             logger.debug("Matrix balancing failed (this can happen!), \
                           removing sparsest rows to try again. Error: \
@@ -800,6 +883,57 @@ def correct_matrix(m, max_attempts=50, restore_coverage=False):
     return m_nonzero, x
 
 
+def _correct_sparse_matrix(m, max_attempts=50, restore_coverage=False, high_precision=False):
+    """
+    KR-correct a symmetric :mod:`scipy.sparse` matrix.
+
+    Works like :func:`~correct_matrix`, but never converts the matrix
+    to a dense array, so memory scales with the number of non-zero entries.
+
+    :return: corrected CSR matrix, bias vector
+    """
+    # remove zero-sum rows
+    removed_rows = []
+    m_nonzero, ixs = remove_sparse_rows_sparse(m, cutoff=0)
+    removed_rows.append(ixs)
+
+    has_errors = True
+    iterations = 0
+    x = None
+    while has_errors:
+        has_errors = False
+
+        try:
+            x = get_bias_vector(m_nonzero, high_precision=high_precision)
+        except ValueError as e:
+            logger.debug("Matrix balancing failed (this can happen!), \
+                          removing sparsest rows to try again. Error: \
+                          %s" % str(e))
+            m_nonzero, ixs = remove_sparse_rows_sparse(m_nonzero)
+            removed_rows.append(ixs)
+            has_errors = True
+
+        iterations += 1
+        if iterations > max_attempts:
+            raise RuntimeError("Exceeded maximum attempts (%d)" % max_attempts)
+
+    x = np.asarray(x, dtype=np.float64)
+    if restore_coverage:
+        x = x*np.sqrt(m_nonzero.sum()/m_nonzero.shape[0])
+
+    logger.debug("Applying bias vector")
+    bias = scipy.sparse.diags(x)
+    m_nonzero = bias.dot(m_nonzero).dot(bias).tocsr()
+
+    logger.debug("Restoring {} sets ({} total) sparse rows.".format(
+        len(removed_rows), sum(len(x) for x in removed_rows)))
+    # restore zero rows
+    m_nonzero = restore_sparse_rows_sparse(m_nonzero, removed_rows)
+    x = restore_sparse_rows_sparse(x, removed_rows)
+
+    return m_nonzero, x
+
+
 def get_bias_vector(A, x0=None, tol=1e-06, delta=0.1, Delta=3, fl=0, high_precision=False, outer_limit=300):
     logger.debug("Starting matrix balancing")
 
@@ -809,7 +943,14 @@ def get_bias_vector(A, x0=None, tol=1e-06, delta=0.1, Delta=3, fl=0, high_precis
         try:
             # basic variables
             # n=size_(A,1)
-            if not isinstance(A, np.ndarray):
+            if scipy.sparse.issparse(A):
+                A = A.tocsr()
+                try:
+                    if high_precision:
+                        A = A.astype(np.float128)
+                except AttributeError:
+                    pass
+            elif not isinstance(A, np.ndarray):
                 try:
                     if high_precision:
                         A = np.array(A, dtype=np.float128)
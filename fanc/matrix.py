@@ -7,11 +7,13 @@
 import logging
 import os
 import warnings
+import zlib
 from bisect import bisect_right
 from collections import defaultdict
 
 import intervaltree
 import numpy as np
+import scipy.sparse
 import tables
 from future.utils import string_types
 
@@ -268,6 +270,62 @@ def as_edge(edge):
                      "/ contact!".format(edge, type(edge)))
 
 
+def _sparse_sums(ixs, weights):
+    """
+    Sum up weights with identical indices.
+
+    :return: sorted unique indices, sum of weights for each index
+    """
+    unique_ixs, inverse = np.unique(ixs, return_inverse=True)
+    return unique_ixs, np.bincount(inverse, weights=weights, minlength=len(unique_ixs))
+
+
+def _expected_sums_from_edges(edge_chunks, chromosome_ixs, chromosome_starts, bias=None):
+    """
+    Sum up edge weights for expected value calculations.
+
+    Intra-chromosomal sums are indexed by the first bin of the
+    chromosome plus the distance between source and sink, so the
+    sums of all chromosomes fit into one vector with one entry
+    per region.
+
+    :param edge_chunks: iterator over (sources, sinks, weights) arrays
+    :param chromosome_ixs: chromosome index of every region
+    :param chromosome_starts: first region index of every chromosome
+    :param bias: optional bias vector applied to the weights
+    :return: tuple of sparse intra-chromosomal sums (indices, sums),
+             sparse marginals (indices, sums), inter-chromosomal sum
+    """
+    intra_ixs, intra_sums = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    marginal_ixs, marginal_sums = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    inter_sum = 0.0
+    for sources, sinks, weights in edge_chunks:
+        sources = np.asarray(sources, dtype=np.int64)
+        sinks = np.asarray(sinks, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+
+        if bias is not None:
+            weights = weights * bias[sources] * bias[sinks]
+
+        ixs, sums = _sparse_sums(np.concatenate([sources, sinks]),
+                                 np.concatenate([weights, weights]))
+        marginal_ixs.append(ixs)
+        marginal_sums.append(sums)
+
+        is_intra = chromosome_ixs[sources] == chromosome_ixs[sinks]
+        inter_sum += float(np.sum(weights[~is_intra]))
+
+        ixs, sums = _sparse_sums(chromosome_starts[chromosome_ixs[sources[is_intra]]] +
+                                 sinks[is_intra] - sources[is_intra],
+                                 weights[is_intra])
+        intra_ixs.append(ixs)
+        intra_sums.append(sums)
+
+    return (_sparse_sums(np.concatenate(intra_ixs), np.concatenate(intra_sums)),
+            _sparse_sums(np.concatenate(marginal_ixs), np.concatenate(marginal_sums)),
+            inter_sum)
+
+
 class RegionPairsContainer(RegionBased):
     """
     Class representing pairs of genomic regions.
@@ -797,6 +855,75 @@ class RegionPairsContainer(RegionBased):
         for edge in self.edges(*args, **kwargs):
             yield getattr(edge, attribute)
 
+    def _edges_array_fields(self, fields=None):
+        """
+        Determine the edge fields returned by :func:`~RegionPairsContainer.edges_array`.
+
+        Source and sink are always part of the output and always come first.
+        """
+        if fields is None:
+            fields = [self._default_score_field if self._default_score_field is not None else 'weight']
+        elif isinstance(fields, string_types):
+            fields = [fields]
+
+        return ['source', 'sink'] + [field for field in fields if field not in ('source', 'sink')]
+
+    @staticmethod
+    def _edges_array_output(columns, fields, as_dict=False):
+        """
+        Convert a dict of edge column arrays into the output format of
+        :func:`~RegionPairsContainer.edges_array`.
+        """
+        if as_dict:
+            return {field: columns[field] for field in fields}
+
+        n = len(columns[fields[0]])
+        records = np.empty(n, dtype=[(field, columns[field].dtype) for field in fields])
+        for field in fields:
+            records[field] = columns[field]
+        return records
+
+    def edges_array(self, key=None, norm=True, fields=None, as_dict=False, **kwargs):
+        """
+        Get edges as numpy arrays instead of :class:`~Edge` objects.
+
+        This is the columnar equivalent of :func:`~RegionPairsContainer.edges`,
+        and accepts the same keys and keyword arguments. The default
+        implementation iterates over :func:`~RegionPairsContainer.edges`,
+        subclasses such as :class:`~RegionPairsTable` provide much faster,
+        vectorised implementations.
+
+        .. code ::
+
+            edges = hic.edges_array(('chr18', 'chr18'))
+            edges['source']  # array([ 0,  0,  0, ...])
+            edges['weight']  # array([0.1229, 0.0252, ...])
+
+        :param key: Edge selector, see :func:`~RegionPairsContainer.edges`
+        :param norm: If True (default), the weight field is multiplied by the
+                     bias of the source and sink regions
+        :param fields: List of edge fields to return. "source" and "sink" are
+                       always returned. By default, this is the default score
+                       field of the object (usually "weight")
+        :param as_dict: If True, return a dict of arrays (one per field)
+                        instead of a numpy structured array
+        :param kwargs: Keyword arguments passed to :func:`~RegionPairsContainer.edges`
+        :return: numpy structured array or dict of numpy arrays
+        """
+        fields = self._edges_array_fields(fields)
+        kwargs['lazy'] = True
+
+        columns = {field: [] for field in fields}
+        for edge in self.edges(key, norm=norm, **kwargs):
+            for field in fields:
+                columns[field].append(getattr(edge, field, self._default_value))
+
+        columns = {field: np.array(values) for field, values in columns.items()}
+        for field in ('source', 'sink'):
+            columns[field] = columns[field].astype(np.int64)
+
+        return self._edges_array_output(columns, fields, as_dict=as_dict)
+
     def regions_and_edges(self, key, *args, **kwargs):
         """
         Convenient access to regions and edges selected by key.
@@ -886,76 +1013,128 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         self._default_value = 0.0
         self._default_score_field = 'weight'
 
-    def regions_and_matrix_entries(self, key=None, oe=False, oe_per_chromosome=True,
+    def _regions_and_matrix_arrays(self, key=None, oe=False, oe_per_chromosome=True,
                                    score_field=None, *args, **kwargs):
         """
-        Convenient access to non-zero matrix entries and associated regions.
+        Columnar equivalent of :func:`~RegionMatrixContainer.regions_and_matrix_entries`.
 
-        :param key: Edge key, see :func:`~RegionPairsContainer.edges`
-        :param oe: If True, will divide observed values by their expected value
-                   at the given distance. False by default
-        :param oe_per_chromosome: If True (default), will do a per-chromosome O/E
-                                  calculation rather than using the whole matrix
-                                  to obtain expected values
-        :param score_field: (optional) any edge attribute that returns a number
-                            can be specified here for filling the matrix. Usually
-                            this is defined by the :code:`_default_score_field`
-                            attribute of the matrix class.
-        :param args: Positional arguments passed to :func:`~RegionPairsContainer.edges`
-        :param kwargs: Keyword arguments passed to :func:`~RegionPairsContainer.edges`
-        :return: list of row regions, list of col regions, iterator over (i, j, weight) tuples
+        Takes the same arguments as
+        :func:`~RegionMatrixContainer.regions_and_matrix_entries`, but returns
+        matrix entries as three numpy arrays (row indices, column indices, and
+        weights) instead of an iterator over tuples.
+
+        :return: list of row regions, list of col regions, tuple of numpy arrays (i, j, weight)
         """
-        row_regions, col_regions, edges_iter = self.regions_and_edges(key, *args, **kwargs)
+        row_regions, col_regions = self._key_to_regions(key)
+        if isinstance(row_regions, GenomicRegion):
+            row_regions = [row_regions]
+        else:
+            row_regions = list(row_regions)
+
+        if isinstance(col_regions, GenomicRegion):
+            col_regions = [col_regions]
+        else:
+            col_regions = list(col_regions)
 
         try:
             row_offset = row_regions[0].ix
             col_offset = col_regions[0].ix
         except IndexError:
-            return row_regions, col_regions, []
+            return row_regions, col_regions, (np.zeros(0, dtype=np.int64),
+                                              np.zeros(0, dtype=np.int64),
+                                              np.zeros(0))
 
         if score_field is None:
             score_field = self._default_score_field
 
-        def offset_iter(edge_iter):
-            for edge in edge_iter:
-                source, sink, weight = edge.source, edge.sink, getattr(edge, score_field, self._default_value)
+        edges = self.edges_array((row_regions, col_regions), fields=[score_field],
+                                 as_dict=True, **kwargs)
+        sources, sinks, weights = edges['source'], edges['sink'], edges[score_field]
 
-                i = source - row_offset
-                j = sink - col_offset
-                if i >= 0 and j >= 0:
-                    yield source, sink, i, j, weight
+        # entries in the upper and (mirrored) lower triangle of the requested matrix
+        i = sources - row_offset
+        j = sinks - col_offset
+        upper = np.logical_and(i >= 0, j >= 0)
 
-                l = source - col_offset
-                k = sink - row_offset
-                if (i, j) != (k, l) and k >= 0 and l >= 0:
-                    yield source, sink, k, l, weight
+        k = sinks - row_offset
+        l = sources - col_offset
+        lower = np.logical_and.reduce([k >= 0, l >= 0, np.logical_or(i != k, j != l)])
 
-        edges_iter = self.edges((row_regions, col_regions), *args, **kwargs)
-        if not oe:
-            entry_iter = ((i, j, weight)
-                          for _, _, i, j, weight in offset_iter(edges_iter))
-        else:
+        entry_sources = np.concatenate([sources[upper], sources[lower]])
+        entry_sinks = np.concatenate([sinks[upper], sinks[lower]])
+        entry_i = np.concatenate([i[upper], k[lower]])
+        entry_j = np.concatenate([j[upper], l[lower]])
+        entry_weights = np.concatenate([weights[upper], weights[lower]])
+
+        if oe:
+            entry_weights = entry_weights.astype(np.float64)
             norm = kwargs.get("norm", True)
             intra_expected, chromosome_intra_expected, inter_expected = self.expected_values(norm=norm)
 
+            # map regions to chromosome indexes for vectorised intra/inter comparison
+            chromosome_ixs = dict()
+            row_chromosomes = np.array([chromosome_ixs.setdefault(r.chromosome, len(chromosome_ixs))
+                                        for r in row_regions])
+            col_chromosomes = np.array([chromosome_ixs.setdefault(r.chromosome, len(chromosome_ixs))
+                                        for r in col_regions])
+
+            # only entries within the matrix bounds can be assigned a chromosome
+            in_bounds = np.logical_and(entry_i < len(row_regions), entry_j < len(col_regions))
+            entry_chromosomes = np.full(len(entry_i), -1)
+            entry_chromosomes[in_bounds] = row_chromosomes[entry_i[in_bounds]]
+            is_intra = np.zeros(len(entry_i), dtype=bool)
+            is_intra[in_bounds] = entry_chromosomes[in_bounds] == col_chromosomes[entry_j[in_bounds]]
+            distances = np.abs(entry_sources - entry_sinks)
+
+            expected = np.full(len(entry_weights), inter_expected, dtype=np.float64)
             if oe_per_chromosome:
-                entry_iter = ((i, j,
-                               weight / chromosome_intra_expected[row_regions[i].chromosome][abs(source - sink)]
-                               if row_regions[i].chromosome == col_regions[j].chromosome
-                               else weight / inter_expected)
-                              for source, sink, i, j, weight in offset_iter(edges_iter))
+                for chromosome, chromosome_ix in chromosome_ixs.items():
+                    is_chromosome = np.logical_and(is_intra, entry_chromosomes == chromosome_ix)
+                    if not np.any(is_chromosome):
+                        continue
+                    chromosome_expected = np.asarray(chromosome_intra_expected[chromosome], dtype=np.float64)
+                    expected[is_chromosome] = chromosome_expected[distances[is_chromosome]]
             else:
-                entry_iter = ((i, j,
-                               weight / intra_expected[abs(source - sink)]
-                               if row_regions[i].chromosome == col_regions[j].chromosome
-                               else weight / inter_expected)
-                              for source, sink, i, j, weight in offset_iter(edges_iter))
+                expected[is_intra] = np.asarray(intra_expected, dtype=np.float64)[distances[is_intra]]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                entry_weights = entry_weights / expected
 
-        return row_regions, col_regions, entry_iter
+        return row_regions, col_regions, (entry_i, entry_j, entry_weights)
+
+    def regions_and_matrix_entries(self, key=None, oe=False, oe_per_chromosome=True,
+                                   score_field=None, *args, **kwargs):
+        """
+        Convenient access to non-zero matrix entries and associated regions.
+
+        :param key: Edge key, see :func:`~RegionPairsContainer.edges`
+        :param oe: If True, will divide observed values by their expected value
+                   at the given distance. False by default
+        :param oe_per_chromosome: If True (default), will do a per-chromosome O/E
+                                  calculation rather than using the whole matrix
+                                  to obtain expected values
+        :param score_field: (optional) any edge attribute that returns a number
+                            can be specified here for filling the matrix. Usually
+                            this is defined by the :code:`_default_score_field`
+                            attribute of the matrix class.
+        :param args: Positional arguments passed to :func:`~RegionPairsContainer.edges`
+        :param kwargs: Keyword arguments passed to :func:`~RegionPairsContainer.edges`
+        :return: list of row regions, list of col regions, iterator over (i, j, weight) tuples
+        """
+        row_regions, col_regions, (i, j, weights) = self._regions_and_matrix_arrays(
+            key, oe=oe, oe_per_chromosome=oe_per_chromosome, score_field=score_field,
+            *args, **kwargs
+        )
+
+        if len(row_regions) == 0 or len(col_regions) == 0:
+            return row_regions, col_regions, []
+
+        return row_regions, col_regions, zip(i.tolist(), j.tolist(), weights.tolist())
 
     def matrix(self, key=None,
                log=False,
                default_value=None, mask=True, log_base=2,
+               sparse=False, dtype=None,
                *args, **kwargs):
         """
         Assemble a :class:`~RegionMatrix` from region pairs.
@@ -968,6 +1147,14 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         :param default_value: (optional) set the default value of matrix entries
                               that have no associated edge/contact
         :param mask: If False, do not mask unmappable regions
+        :param sparse: If True (or 'csr'), return a :class:`~scipy.sparse.csr_matrix`
+                       instead of a :class:`~fanc.matrix.RegionMatrix`. Use 'coo'
+                       to obtain a :class:`~scipy.sparse.coo_matrix`. Entries
+                       without an associated edge are not stored in sparse
+                       matrices, regardless of default_value, and no masking
+                       is applied
+        :param dtype: numpy dtype of the matrix, float64 by default. Use
+                      e.g. 'float32' to halve the memory footprint of large matrices
         :param args: Positional arguments passed to
                      :func:`~fanc.matrix.RegionMatrixContainer.regions_and_matrix_entries`
         :param kwargs: Keyword arguments passed to
@@ -981,21 +1168,45 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         if kwargs.get('oe', False):
             default_value = 1.0
 
-        kwargs['lazy'] = True
-        row_regions, col_regions, matrix_entries = self.regions_and_matrix_entries(key,
-                                                                                   *args,
-                                                                                   **kwargs)
-
-        m = np.full((len(row_regions), len(col_regions)), default_value)
+        if dtype is None:
+            dtype = np.float64
 
-        for source, sink, weight in matrix_entries:
-            ir = source
-            jr = sink
-            if 0 <= ir < m.shape[0] and 0 <= jr < m.shape[1]:
-                m[ir, jr] = weight
+        kwargs['lazy'] = True
+        row_regions, col_regions, (i, j, weights) = self._regions_and_matrix_arrays(key,
+                                                                                    *args,
+                                                                                    **kwargs)
+        shape = (len(row_regions), len(col_regions))
+
+        in_bounds = np.logical_and(i < shape[0], j < shape[1])
+        i, j, weights = i[in_bounds], j[in_bounds], weights[in_bounds].astype(dtype)
+
+        if sparse:
+            if log:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    weights = (np.log(weights) / np.log(log_base)).astype(dtype)
+                weights[~np.isfinite(weights)] = default_value
+
+            m = scipy.sparse.coo_matrix((weights, (i, j)), shape=shape, dtype=dtype).tocsr()
+            m.eliminate_zeros()
+
+            if isinstance(key, tuple) and len(key) == 2:
+                if isinstance(key[0], int) and isinstance(key[1], int):
+                    return m[0, 0]
+                elif isinstance(key[0], int):
+                    m = m[0, :]
+                elif isinstance(key[1], int):
+                    m = m[:, 0]
+
+            if sparse == 'coo':
+                return m.tocoo()
+            return m
+
+        m = np.full(shape, default_value, dtype=dtype)
+        m[i, j] = weights
 
         if log:
-            m = np.log(m) / np.log(log_base)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                m = np.log(m) / np.log(log_base)
             m[~np.isfinite(m)] = default_value
 
         if isinstance(key, tuple) and len(key) == 2:
@@ -1130,10 +1341,8 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
                 chromosome_dict[i] = chromosome
 
         chromosome_intra_sums = dict()
-        chromosome_intra_expected = dict()
         for chromosome, d in chromosome_max_distance.items():
             chromosome_intra_sums[chromosome] = [0.0] * d
-            chromosome_intra_expected[chromosome] = [0.0] * d
 
         # get the sums of edges at any given distance
         marginals = [0.0] * len(self.regions)
@@ -1161,6 +1370,31 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
                     chromosome_intra_sums[source_chromosome][distance] += weight
                 pb.update(i)
 
+        return self._expected_values_from_sums(intra_sums, chromosome_intra_sums, inter_sums,
+                                               marginals, selected_chromosome=selected_chromosome)
+
+    def _expected_values_from_sums(self, intra_sums, chromosome_intra_sums, inter_sums,
+                                   marginals, selected_chromosome=None):
+        """
+        Convert summed edge weights into expected values.
+
+        :param intra_sums: list of genome-wide intra-chromosomal edge weight
+                           sums, list index corresponds to number of separating bins
+        :param chromosome_intra_sums: dict of intra-chromosomal edge weight
+                                      sums by chromosome
+        :param inter_sums: sum of inter-chromosomal edge weights
+        :param marginals: list of marginals
+        :param selected_chromosome: (optional) Chromosome name. If provided,
+                                    will only return expected values for this
+                                    chromosome.
+        :return: see :func:`~RegionMatrixContainer.expected_values_and_marginals`
+        """
+        max_distance = len(intra_sums)
+        chromosome_max_distance = {chromosome: len(sums)
+                                   for chromosome, sums in chromosome_intra_sums.items()}
+        chromosome_intra_expected = {chromosome: [0.0] * d
+                                     for chromosome, d in chromosome_max_distance.items()}
+
         intra_total, chromosome_intra_total, inter_total = self.possible_contacts()
 
         # expected values
@@ -1393,6 +1627,7 @@ class TableBuffer(object):
             logger.debug("Disabling edge indexes")
             self._matrix._edges_dirty = True
             self._matrix._disable_edge_indexes()
+        self._matrix._dirty_edge_partitions.add(partition)
 
         try:
             ix = self._counter[partition]
@@ -1467,6 +1702,99 @@ class TableBuffer(object):
         if weight is not None:
             row[self._weight_field] = weight
 
+    def add_weights(self, sources, sinks, weights=None):
+        """
+        Add many edges at once from source, sink, and weight arrays.
+
+        Edges are assigned to partitions in vectorised form and copied
+        into the partition buffers in contiguous blocks.
+        """
+        sources, sinks = np.asarray(sources), np.asarray(sinks)
+        sources, sinks = np.minimum(sources, sinks), np.maximum(sources, sinks)
+        if weights is not None:
+            weights = np.asarray(weights)
+
+        partition_breaks = np.asarray(self._matrix._partition_breaks)
+        source_partitions = np.searchsorted(partition_breaks, sources, side='right')
+        sink_partitions = np.searchsorted(partition_breaks, sinks, side='right')
+
+        order = np.lexsort((sink_partitions, source_partitions))
+        source_partitions, sink_partitions = source_partitions[order], sink_partitions[order]
+        boundaries = np.where(np.logical_or(np.diff(source_partitions) != 0,
+                                            np.diff(sink_partitions) != 0))[0] + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(order)]])
+
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue
+            partition = (int(source_partitions[start]), int(sink_partitions[start]))
+            ixs = order[start:end]
+            self._add_weights_to_partition(partition, sources[ixs], sinks[ixs],
+                                           None if weights is None else weights[ixs])
+
+    def template_rows(self, n):
+        """
+        Return a structured array of n edge table rows with default values.
+        """
+        if not self._is_initialised:
+            self.initialise_buffers()
+        return np.repeat(self._template_row, n)
+
+    def add_rows(self, rows, partition):
+        """
+        Append complete edge table rows to a partition.
+
+        Rows must be a structured array with the dtype of
+        :func:`~TableBuffer.template_rows`. Any buffered edges in
+        the same partition are written first to preserve edge order.
+        """
+        if not self._matrix._edges_dirty:
+            logger.debug("Disabling edge indexes")
+            self._matrix._edges_dirty = True
+            self._matrix._disable_edge_indexes()
+        self._matrix._dirty_edge_partitions.add(partition)
+
+        if partition in self._counter:
+            self.flush(partition=partition)
+
+        edge_table = self._matrix._edge_table(partition[0], partition[1])
+        edge_table.append(rows)
+        edge_table.flush(update_index=False)
+
+    def _add_weights_to_partition(self, partition, sources, sinks, weights=None):
+        if not self._matrix._edges_dirty:
+            logger.debug("Disabling edge indexes")
+            self._matrix._edges_dirty = True
+            self._matrix._disable_edge_indexes()
+        self._matrix._dirty_edge_partitions.add(partition)
+
+        if partition not in self._counter:
+            if not self._is_initialised:
+                self.initialise_buffers()
+            self._reset_buffer_table(partition)
+
+        source_name = self._colnames[self._source_field]
+        sink_name = self._colnames[self._sink_field]
+        weight_name = self._colnames[self._weight_field] if self._weight_field is not None else None
+
+        offset = 0
+        while offset < len(sources):
+            buffer_table = self._buffer[partition]
+            ix = self._counter[partition]
+            if ix == buffer_table.shape[0]:
+                self.flush(partition=partition)
+                self._reset_buffer_table(partition)
+                continue
+
+            size = min(len(sources) - offset, buffer_table.shape[0] - ix)
+            buffer_table[source_name][ix:ix + size] = sources[offset:offset + size]
+            buffer_table[sink_name][ix:ix + size] = sinks[offset:offset + size]
+            if weights is not None and weight_name is not None:
+                buffer_table[weight_name][ix:ix + size] = weights[offset:offset + size]
+            self._counter[partition] += size
+            offset += size
+
 
 class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
     """
@@ -1494,6 +1822,7 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
 
         # private variables
         self._edges_dirty = False
+        self._dirty_edge_partitions = set()
         self._mappability_dirty = False
         self._partition_strategy = partition_strategy
         self._edge_table_prefix = _edge_table_prefix
@@ -1628,6 +1957,7 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
 
             self._enable_edge_indexes()
             self._edges_dirty = False
+            self._dirty_edge_partitions = set()
 
             self._update_mappability()
 
@@ -1757,6 +2087,19 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
     def add_edge_simple(self, source, sink, weight=None, *args, **kwargs):
         self._edge_buffer.add_weight(source, sink, weight=weight, **kwargs)
 
+    def add_edges_simple(self, sources, sinks, weights=None):
+        """
+        Bulk-add edges from source, sink, and weight arrays.
+
+        This is the vectorised equivalent of repeatedly calling
+        :func:`~RegionPairsTable.add_edge_simple`.
+
+        :param sources: Array of source region indices
+        :param sinks: Array of sink region indices
+        :param weights: Array of edge weights
+        """
+        self._edge_buffer.add_weights(sources, sinks, weights=weights)
+
     def add_edge_from_edge(self, edge, *args, **kwargs):
         self._edge_buffer.add_edge(edge, **kwargs)
 
@@ -1864,6 +2207,287 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
 
                         yield edge_row
 
+    def _excluded_mask_ix(self, excluded_filters=0):
+        """
+        Convert excluded filters (int, mask names, or 'all') into a binary mask.
+        """
+        if isinstance(excluded_filters, (int, np.integer)):
+            return int(excluded_filters)
+        if excluded_filters == 'all':
+            excluded_filters = list(self.masks())
+        return self.get_binary_mask_from_masks(excluded_filters)
+
+    @staticmethod
+    def _edge_table_arrays(edge_table, excluded_mask_ix=0, condition=None,
+                           chunk_size=1000000):
+        """
+        Iterate over the visible rows of an edge table in chunks.
+
+        :return: iterator over numpy structured arrays
+        """
+        mask_field = edge_table._mask_field
+        for start in range(0, edge_table.nrows, chunk_size):
+            stop = min(start + chunk_size, edge_table.nrows)
+            if condition is None:
+                rows = edge_table.read(start=start, stop=stop)
+            else:
+                rows = edge_table.read_where(condition, start=start, stop=stop)
+
+            visible = (rows[mask_field] | excluded_mask_ix) == excluded_mask_ix
+            if not np.all(visible):
+                rows = rows[visible]
+            yield rows
+
+    def _edge_subset_arrays_from_regions(self, row_regions, col_regions, excluded_filters=0,
+                                         chunk_size=1000000):
+        """
+        Columnar equivalent of :func:`~RegionPairsTable._edge_subset_rows_from_regions`.
+
+        :return: iterator over numpy structured arrays of edge table rows
+        """
+        excluded_mask_ix = self._excluded_mask_ix(excluded_filters)
+
+        row_start, row_end = self._min_max_region_ix(row_regions)
+        col_start, col_end = self._min_max_region_ix(col_regions)
+        if row_start > row_end or col_start > col_end:
+            return
+
+        row_partition_start = self._get_partition_ix(row_start)
+        row_partition_end = self._get_partition_ix(row_end)
+        col_partition_start = self._get_partition_ix(col_start)
+        col_partition_end = self._get_partition_ix(col_end)
+
+        partition_extracted = set()
+        for a in range(row_partition_start, row_partition_end + 1):
+            for b in range(col_partition_start, col_partition_end + 1):
+                if b < a:
+                    i, j = b, a
+                else:
+                    i, j = a, b
+
+                if (i, j) in partition_extracted:
+                    continue
+                else:
+                    partition_extracted.add((i, j))
+
+                row_covered = self._is_partition_covered(a, row_start, row_end)
+                col_covered = self._is_partition_covered(b, col_start, col_end)
+
+                try:
+                    edge_table = self._edge_table(i, j, create_if_missing=False)
+                except ValueError:
+                    continue
+
+                # if we need to get all regions in a table, return the whole thing
+                if row_covered and col_covered:
+                    for rows in self._edge_table_arrays(edge_table, excluded_mask_ix,
+                                                        chunk_size=chunk_size):
+                        yield rows
+
+                # otherwise only return the subset defined by the respective indices
+                else:
+                    condition = "(%d < source) & (source < %d) & (% d < sink) & (sink < %d)"
+                    condition1 = condition % (row_start - 1, row_end + 1, col_start - 1, col_end + 1)
+                    condition2 = condition % (col_start - 1, col_end + 1, row_start - 1, row_end + 1)
+
+                    if row_start > col_start:
+                        condition1, condition2 = condition2, condition1
+
+                    overlap = range_overlap(row_start, row_end, col_start, col_end)
+
+                    for rows in self._edge_table_arrays(edge_table, excluded_mask_ix,
+                                                        condition=condition1,
+                                                        chunk_size=chunk_size):
+                        yield rows
+
+                    for rows in self._edge_table_arrays(edge_table, excluded_mask_ix,
+                                                        condition=condition2,
+                                                        chunk_size=chunk_size):
+                        if overlap is not None:
+                            in_overlap = np.logical_and.reduce([overlap[0] <= rows['source'],
+                                                                rows['source'] <= overlap[1],
+                                                                overlap[0] <= rows['sink'],
+                                                                rows['sink'] <= overlap[1]])
+                            rows = rows[~in_overlap]
+                        yield rows
+
+    def _region_array(self, field, default=None):
+        """
+        Get a region attribute for all regions as a numpy array.
+
+        If the attribute does not exist, an array filled with
+        :code:`default` is returned.
+        """
+        if field in self._regions.colnames:
+            return self._regions.col(field)
+        return np.full(len(self._regions), default)
+
+    def _region_chromosome_ix_array(self):
+        """
+        Get the chromosome index (in the order of :func:`~RegionsTable.chromosomes`)
+        of all regions as a numpy array.
+        """
+        chromosome_ixs = np.zeros(len(self._regions), dtype=np.int32)
+        for i, chromosome in enumerate(self.chromosomes()):
+            start, end = self.chromosome_bins[chromosome]
+            chromosome_ixs[start:end] = i
+        return chromosome_ixs
+
+    def _edges_array_fields(self, fields=None):
+        if fields is None:
+            fields = [field for field in RegionPairsContainer._edges_array_fields(self)
+                      if field in self.field_names]
+        return RegionPairsContainer._edges_array_fields(self, fields)
+
+    def _edges_array_chunks(self, key=None, norm=True, fields=None,
+                            intra_chromosomal=True, inter_chromosomal=True,
+                            check_valid=True, bias_field='bias', valid_field='valid',
+                            weight_field='weight', excluded_filters=0,
+                            chunk_size=1000000):
+        """
+        Iterate over edges as chunks of column arrays.
+
+        Takes the same arguments as :func:`~RegionPairsTable.edges_array`.
+
+        :return: iterator over dicts of numpy arrays, one per field
+        """
+        fields = self._edges_array_fields(fields)
+
+        if key is None:
+            # only the first and last region are required to cover all partitions
+            n_regions = len(self.regions)
+            if n_regions == 0:
+                return
+            row_regions = col_regions = [self.regions[0], self.regions[n_regions - 1]]
+        else:
+            row_regions, col_regions = self._key_to_regions(key, lazy=True)
+            if isinstance(row_regions, GenomicRegion):
+                row_regions = [row_regions]
+            if isinstance(col_regions, GenomicRegion):
+                col_regions = [col_regions]
+
+        chromosome_ixs = None
+        if not intra_chromosomal or not inter_chromosomal:
+            chromosome_ixs = self._region_chromosome_ix_array()
+
+        valid = None
+        if check_valid:
+            valid = self._region_array(valid_field, True).astype(bool)
+
+        bias = None
+        if norm and weight_field in fields:
+            try:
+                bias = self._region_array(bias_field, 1.0).astype(np.float64)
+            except (TypeError, ValueError):
+                bias = None
+
+        for rows in self._edge_subset_arrays_from_regions(row_regions, col_regions,
+                                                          excluded_filters=excluded_filters,
+                                                          chunk_size=chunk_size):
+            sources = rows['source']
+            sinks = rows['sink']
+
+            keep = None
+            if chromosome_ixs is not None:
+                is_intra_chromosomal = chromosome_ixs[sources] == chromosome_ixs[sinks]
+                if not intra_chromosomal:
+                    keep = ~is_intra_chromosomal
+                if not inter_chromosomal:
+                    keep = is_intra_chromosomal if keep is None else keep & is_intra_chromosomal
+
+            if valid is not None:
+                is_valid = valid[sources] & valid[sinks]
+                keep = is_valid if keep is None else keep & is_valid
+
+            if keep is not None:
+                rows = rows[keep]
+                sources = rows['source']
+                sinks = rows['sink']
+
+            columns = dict()
+            for field in fields:
+                if field == 'source' or field == 'sink':
+                    columns[field] = rows[field].astype(np.int64)
+                elif field == weight_field and bias is not None:
+                    columns[field] = rows[field] * bias[sources] * bias[sinks]
+                else:
+                    columns[field] = rows[field]
+            yield columns
+
+    def edges_array(self, key=None, norm=True, fields=None, as_dict=False,
+                    intra_chromosomal=True, inter_chromosomal=True,
+                    check_valid=True, bias_field='bias', valid_field='valid',
+                    weight_field='weight', excluded_filters=0,
+                    _chunk_size=1000000, **kwargs):
+        """
+        Get edges as numpy arrays instead of :class:`~Edge` objects.
+
+        Edge tables are read in large chunks directly into numpy arrays, and
+        masked edges, invalid regions, and biases are dealt with in vectorised
+        form. This is much faster than iterating over
+        :func:`~RegionPairsContainer.edges`, and returns the same edges:
+
+        .. code ::
+
+            edges = hic.edges_array(('chr18', 'chr18'))
+            edges['source']  # array([ 0,  0,  0, ...])
+            edges['weight']  # array([0.1229, 0.0252, ...])
+
+            # dict of arrays with unnormalised weights
+            edges = hic.edges_array(('chr18', 'chr18'), norm=False, as_dict=True)
+
+        :param key: Edge selector, see :func:`~RegionPairsContainer.edges`
+        :param norm: If True (default), the weight field is multiplied by the
+                     bias of the source and sink regions
+        :param fields: List of edge fields to return. "source" and "sink" are
+                       always returned. By default, this is the default score
+                       field of the object (usually "weight")
+        :param as_dict: If True, return a dict of arrays (one per field)
+                        instead of a numpy structured array
+        :param intra_chromosomal: If False, omit intra-chromosomal edges
+        :param inter_chromosomal: If False, omit inter-chromosomal edges
+        :param check_valid: If True (default), omit edges connecting invalid regions
+        :param bias_field: Name of the region bias attribute
+        :param valid_field: Name of the region validity attribute
+        :param weight_field: Name of the edge field biases are applied to
+        :param excluded_filters: Filters (masks) to ignore when selecting edges
+        :return: numpy structured array or dict of numpy arrays
+        """
+        # lazy is accepted for compatibility with edges, but has no meaning here
+        kwargs.pop('lazy', None)
+        if len(kwargs) > 0:
+            raise TypeError("edges_array() got unexpected keyword argument(s): "
+                            "{}".format(", ".join(sorted(kwargs.keys()))))
+
+        fields = self._edges_array_fields(fields)
+
+        chunks = defaultdict(list)
+        for columns in self._edges_array_chunks(key, norm=norm, fields=fields,
+                                                intra_chromosomal=intra_chromosomal,
+                                                inter_chromosomal=inter_chromosomal,
+                                                check_valid=check_valid,
+                                                bias_field=bias_field,
+                                                valid_field=valid_field,
+                                                weight_field=weight_field,
+                                                excluded_filters=excluded_filters,
+                                                chunk_size=_chunk_size):
+            for field, values in columns.items():
+                chunks[field].append(values)
+
+        columns = dict()
+        edge_table = self._edge_table(0, 0, create_if_missing=False)
+        for field in fields:
+            if len(chunks[field]) > 0:
+                columns[field] = np.concatenate(chunks[field])
+            elif field == 'source' or field == 'sink':
+                columns[field] = np.zeros(0, dtype=np.int64)
+            elif field == weight_field and norm:
+                columns[field] = np.zeros(0, dtype=np.float64)
+            else:
+                columns[field] = np.zeros(0, dtype=edge_table.coldtypes[field])
+
+        return self._edges_array_output(columns, fields, as_dict=as_dict)
+
     def _matrix_entries(self, key, row_regions, col_regions,
                         score_field=None, *args, **kwargs):
         if score_field is None:
@@ -2249,6 +2873,8 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
         else:
             self._expected_value_group = self.file.create_group('/', _table_name_expected_values)
 
+        self._expected_partials_cache = dict()
+
     def _remove_expected_values(self):
         if self._expected_value_group is not None:
             try:
@@ -2261,18 +2887,246 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
             except tables.NoSuchNodeError:
                 pass
 
+    def _remove_expected_partials(self, partitions):
+        """
+        Remove cached expected value sums of edge table partitions.
+
+        :param partitions: list of (source_partition, sink_partition) tuples
+        """
+        partitions = set(partitions)
+        breaks = [] if self._partition_breaks is None else list(self._partition_breaks)
+        for norm in (True, False):
+            partials = self._expected_partials_cache.get(norm, None)
+            if partials is None or partials[0] != breaks:
+                partials = (breaks, self._load_expected_partials(norm=norm))
+
+            remaining = {key: value for key, value in partials[1].items()
+                         if key not in partitions}
+            if len(remaining) < len(partials[1]):
+                self._save_expected_partials(remaining, norm=norm)
+            self._expected_partials_cache[norm] = (breaks, remaining)
+
     def _flush_edges(self, silent=config.hide_progressbars):
         if self._edges_dirty:
-           self._remove_expected_values()
+            self._remove_expected_values()
+
+            partitions = self._dirty_edge_partitions
+            if len(partitions) == 0:
+                # edges were written without the edge buffer, e.g. by updating
+                # rows in place, so every edge table may have changed
+                partitions = [key for key, _ in self._iter_edge_tables()]
+            self._remove_expected_partials(partitions)
 
         RegionPairsTable._flush_edges(self, silent=silent)
 
     def set_biases(self, biases):
         self.region_data('bias', biases)
-        self._remove_expected_values()
+
+    def _partition_region_bounds(self):
+        """
+        Get the first and last (exclusive) region index of every partition.
+        """
+        breaks = [] if self._partition_breaks is None else list(self._partition_breaks)
+        return list(zip([0] + breaks, breaks + [len(self.regions)]))
+
+    def _edge_table_expected_sums(self, edge_table, chromosome_ixs, chromosome_starts,
+                                  bias=None):
+        """
+        Sum up the edge weights of a single edge table.
+
+        See :func:`~_expected_sums_from_edges`.
+        """
+        weight_field = self._default_score_field
+
+        def _edge_chunks():
+            for rows in self._edge_table_arrays(edge_table):
+                if weight_field in rows.dtype.names:
+                    weights = rows[weight_field]
+                else:
+                    weights = np.full(len(rows), self._default_value, dtype=np.float64)
+                yield rows['source'], rows['sink'], weights
+
+        return _expected_sums_from_edges(_edge_chunks(), chromosome_ixs, chromosome_starts,
+                                         bias=bias)
+
+    def _load_expected_partials(self, norm=True):
+        """
+        Load per-partition expected value sums from file.
+
+        :return: dict with (source_partition, sink_partition) keys and
+                 (fingerprint, sums) values
+        """
+        partials = dict()
+        if self._expected_value_group is None:
+            return partials
+
+        group_name = 'partials_corrected' if norm else 'partials_uncorrected'
+        try:
+            group = self.file.get_node(self._expected_value_group, group_name)
+        except tables.NoSuchNodeError:
+            return partials
+
+        breaks = [] if self._partition_breaks is None else list(self._partition_breaks)
+        if list(getattr(group._v_attrs, 'partition_breaks', [])) != breaks:
+            return partials
+
+        index = group.index[:]
+        intra_ixs, intra_sums = group.intra_ixs[:], group.intra_sums[:]
+        marginal_ixs, marginal_sums = group.marginal_ixs[:], group.marginal_sums[:]
+        intra_offset, marginal_offset = 0, 0
+        for row in index:
+            intra_end = intra_offset + row['intra_length']
+            marginal_end = marginal_offset + row['marginal_length']
+            fingerprint = (int(row['n_rows']), int(row['n_visible']),
+                           int(row['source_checksum']), int(row['sink_checksum']))
+            sums = ((intra_ixs[intra_offset:intra_end], intra_sums[intra_offset:intra_end]),
+                    (marginal_ixs[marginal_offset:marginal_end],
+                     marginal_sums[marginal_offset:marginal_end]),
+                    float(row['inter']))
+            partials[(int(row['source_partition']), int(row['sink_partition']))] = (fingerprint, sums)
+            intra_offset, marginal_offset = intra_end, marginal_end
+        return partials
+
+    def _save_expected_partials(self, partials, norm=True):
+        """
+        Save per-partition expected value sums to file.
+        """
+        if self._expected_value_group is None:
+            return
+
+        group_name = 'partials_corrected' if norm else 'partials_uncorrected'
+        keys = sorted(partials.keys())
+        index = np.zeros(len(keys), dtype=[('source_partition', np.int64), ('sink_partition', np.int64),
+                                           ('n_rows', np.int64), ('n_visible', np.int64),
+                                           ('source_checksum', np.int64), ('sink_checksum', np.int64),
+                                           ('intra_length', np.int64), ('marginal_length', np.int64),
+                                           ('inter', np.float64)])
+        intra_ixs, intra_sums = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        marginal_ixs, marginal_sums = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for k, key in enumerate(keys):
+            fingerprint, ((i_ixs, i_sums), (m_ixs, m_sums), inter_sum) = partials[key]
+            index[k] = key + fingerprint + (len(i_ixs), len(m_ixs), inter_sum)
+            intra_ixs.append(i_ixs)
+            intra_sums.append(i_sums)
+            marginal_ixs.append(m_ixs)
+            marginal_sums.append(m_sums)
+
+        try:
+            try:
+                self.file.remove_node(self._expected_value_group, group_name, recursive=True)
+            except tables.NoSuchNodeError:
+                pass
+
+            group = self.file.create_group(self._expected_value_group, group_name)
+            group._v_attrs.partition_breaks = [] if self._partition_breaks is None \
+                else list(self._partition_breaks)
+            self.file.create_table(group, 'index', obj=index)
+            self.file.create_array(group, 'intra_ixs', np.concatenate(intra_ixs))
+            self.file.create_array(group, 'intra_sums', np.concatenate(intra_sums))
+            self.file.create_array(group, 'marginal_ixs', np.concatenate(marginal_ixs))
+            self.file.create_array(group, 'marginal_sums', np.concatenate(marginal_sums))
+        except tables.FileModeError:
+            pass
+
+    def _expected_partials(self, norm=True):
+        """
+        Get the edge weight sums required for expected values by partition.
+
+        Sums are cached for each edge table, together with its number of rows,
+        its number of unmasked rows and a checksum of the biases of the regions
+        in its partitions. Only edge tables where any of these have changed,
+        e.g. by adding edges, filtering or setting biases, are summed up again.
+
+        :param norm: If False, sum up uncorrected edge weights
+        :return: dict with (source_partition, sink_partition) keys and
+                 (fingerprint, sums) values
+        """
+        bounds = self._partition_region_bounds()
+        bias = None
+        checksums = [0] * len(bounds)
+        if norm:
+            bias = self._region_array('bias', 1.0).astype(np.float64)
+            checksums = [zlib.crc32(bias[start:end].tobytes()) for start, end in bounds]
+
+        partials = self._expected_partials_cache.get(norm, None)
+        breaks = [] if self._partition_breaks is None else list(self._partition_breaks)
+        if partials is None or partials[0] != breaks:
+            partials = (breaks, self._load_expected_partials(norm=norm))
+        cached = partials[1]
+
+        stale = []
+        current = dict()
+        for (i, j), edge_table in self._iter_edge_tables():
+            fingerprint = (edge_table._original_len(), len(edge_table), checksums[i], checksums[j])
+            if (i, j) in cached and cached[(i, j)][0] == fingerprint:
+                current[(i, j)] = cached[(i, j)]
+            else:
+                stale.append(((i, j), edge_table, fingerprint))
+
+        if len(stale) > 0 or len(current) != len(cached):
+            logger.debug("Updating expected value sums for {} partitions".format(len(stale)))
+            chromosome_ixs = self._region_chromosome_ix_array()
+            chromosome_starts = np.array([self.chromosome_bins[chromosome][0]
+                                          for chromosome in self.chromosomes()], dtype=np.int64)
+            with RareUpdateProgressBar(max_value=len(stale), prefix='Expected',
+                                       silent=config.hide_progressbars) as pb:
+                for k, (key, edge_table, fingerprint) in enumerate(stale):
+                    sums = self._edge_table_expected_sums(edge_table, chromosome_ixs,
+                                                          chromosome_starts, bias=bias)
+                    current[key] = (fingerprint, sums)
+                    pb.update(k)
+            self._save_expected_partials(current, norm=norm)
+
+        self._expected_partials_cache[norm] = (breaks, current)
+        return current
+
+    def _expected_sums(self, norm=True):
+        """
+        Combine per-partition sums into sums over the whole matrix.
+
+        :return: genome-wide intra-chromosomal sums,
+                 intra-chromosomal sums by chromosome,
+                 inter-chromosomal sum, marginals
+        """
+        n_regions = len(self.regions)
+        intra = np.zeros(n_regions)
+        marginals = np.zeros(n_regions)
+        inter_sums = 0.0
+        for _, ((intra_ixs, intra_sums), (marginal_ixs, marginal_sums),
+                inter_sum) in self._expected_partials(norm=norm).values():
+            intra[intra_ixs] += intra_sums
+            marginals[marginal_ixs] += marginal_sums
+            inter_sums += inter_sum
+
+        chromosome_intra_sums = dict()
+        max_distance = 0
+        for chromosome, (start, stop) in self.chromosome_bins.items():
+            chromosome_intra_sums[chromosome] = intra[start:stop]
+            max_distance = max(max_distance, stop - start)
+
+        intra_sums = np.zeros(max_distance)
+        for sums in chromosome_intra_sums.values():
+            intra_sums[:len(sums)] += sums
+
+        return (intra_sums.tolist(), {chromosome: sums.tolist() for chromosome, sums
+                                      in chromosome_intra_sums.items()},
+                inter_sums, marginals.tolist())
 
     def expected_values_and_marginals(self, selected_chromosome=None, norm=True,
                                       force=False, *args, **kwargs):
+        """
+        Calculate the expected values for genomic contacts at all distances
+        and the whole matrix marginals.
+
+        See :func:`~RegionMatrixContainer.expected_values_and_marginals`.
+        Results are stored in the object and returned on subsequent calls.
+        Edge weight sums are additionally stored for each edge table
+        partition, so after adding edges, filtering or setting biases only
+        the affected partitions need to be read again.
+
+        :param force: Recalculate expected values from the partition sums
+                      even if results are stored in the object
+        """
         group_name = 'corrected' if norm else 'uncorrected'
 
         if not force and self._expected_value_group is not None:
@@ -2305,9 +3159,16 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
             except tables.NoSuchNodeError:
                 pass
 
+        intra_sums, chromosome_intra_sums, inter_sums, marginals = self._expected_sums(norm=norm)
+
+        try:
+            self.region_data('valid', np.array(marginals) > 0)
+        except (OSError, KeyError):  # ignore older Hic versions and read-only files
+            pass
+
         (intra_expected, chromosome_intra_expected,
-         inter_expected, marginals) = RegionMatrixContainer.expected_values_and_marginals(self, norm=norm, *args,
-                                                                                          **kwargs)
+         inter_expected, marginals) = self._expected_values_from_sums(intra_sums, chromosome_intra_sums,
+                                                                      inter_sums, marginals)
 
         # try saving to object
         if hasattr(self, '_expected_value_group') and self._expected_value_group is not None:
@@ -2339,11 +3200,6 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
                               "computation are not affected if you don't "
                               "do this, but it will speed things up in the future.")
 
-        try:
-            self.region_data('valid', np.array(marginals) > 0)
-        except (OSError, KeyError):  # ignore older Hic versions and read-only files
-            pass
-
         if selected_chromosome is not None:
             return chromosome_intra_expected[selected_chromosome], marginals
 
@@ -2355,8 +3211,9 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
     def region_data(self, key, value=None):
         data = RegionPairsTable.region_data(self, key, value)
 
-        if key == 'bias':
+        if key == 'bias' and value is not None:
             logger.debug("Recalculating mappability and expected values after bias vector change!")
+            self._remove_expected_values()
             self._update_mappability()
 
         return data
@@ -1,23 +1,26 @@
 from __future__ import division
 
 import copy
+import csv
 import gzip
+import io
+import itertools
 import logging
 import multiprocessing as mp
 import os
+import re
 import threading
 import uuid
 from abc import abstractmethod, ABCMeta
-from bisect import bisect_right
 from builtins import object
 from collections import defaultdict
 from queue import Empty
-from timeit import default_timer as timer
 import tempfile
 import shutil
 
 import msgpack
 import numpy as np
+import pandas as pd
 import pysam
 import tables as t
 from future.utils import with_metaclass, viewitems, string_types
@@ -30,7 +33,6 @@ from .matrix import Edge, RegionPairsTable
 from .regions import genome_regions
 from .tools.general import RareUpdateProgressBar, add_dict, find_alignment_match_positions, WorkerMonitor
 from .tools.sambam import natural_cmp
-from .tools.files import split_sam_pairs
 
 
 logger = logging.getLogger(__name__)
@@ -153,106 +155,203 @@ class Monitor(WorkerMonitor):
             return self.generating_pairs
 
 
-def _split_sam_worker(sam_file1, sam_file2, input_queue, monitor, batch_size=10000000,
-                      tmpdir=None, check_sorted=True):
+# fixed-width record of a read pair's fragment info, ordered by fragment index
+_fragment_info_dtype = np.dtype([
+    ('left_partition', np.int32), ('right_partition', np.int32),
+    ('source', np.int64), ('sink', np.int64),
+    ('left_read_position', np.int64), ('left_read_strand', np.int8),
+    ('left_fragment_chromosome', np.int32),
+    ('left_fragment_start', np.int64), ('left_fragment_end', np.int64),
+    ('right_read_position', np.int64), ('right_read_strand', np.int8),
+    ('right_fragment_chromosome', np.int32),
+    ('right_fragment_start', np.int64), ('right_fragment_end', np.int64),
+])
+
+
+# restriction fragments sorted by lookup key (chromosome index and fragment end)
+_fragment_lookup_dtype = np.dtype([
+    ('key', np.int64), ('ix', np.int64), ('chromosome_ix', np.int32),
+    ('start', np.int64), ('end', np.int64),
+])
+
+
+def _fragment_lookup_keys(chromosome_ixs, positions):
+    return (np.asarray(chromosome_ixs, dtype=np.int64) << 40) + np.asarray(positions, dtype=np.int64)
+
+
+def _chromosome_ixs(chromosomes, chromosome_to_ix):
+    """
+    Convert chromosome names (str or bytes) to chromosome indexes, -1 if unknown.
+    """
+    lookup = dict(chromosome_to_ix)
+    lookup.update({chromosome.encode(): ix for chromosome, ix in chromosome_to_ix.items()})
+    return np.array([lookup.get(chromosome, -1) for chromosome in chromosomes], dtype=np.int64)
+
+
+def _lookup_fragments(fragments, chromosome_ixs, positions, side='right'):
+    """
+    Find the restriction fragments of reads in vectorised form.
+
+    With side='right', this finds the first fragment on the chromosome that ends
+    after the read position (like :code:`bisect_right` on fragment ends),
+    with side='left' the first fragment ending at or after the position.
+
+    :param fragments: array with :code:`_fragment_lookup_dtype`, sorted by key.
+                      Can be memory-mapped
+    :param chromosome_ixs: array of chromosome indexes of the reads (-1 if unknown)
+    :param positions: array of read positions
+    :param side: 'right' or 'left', see above
+    :return: tuple (boolean array, True if a fragment was found,
+             fragments array with one fragment per read)
+    """
+    chromosome_ixs = np.asarray(chromosome_ixs, dtype=np.int64)
+    fragment_ixs = np.searchsorted(fragments['key'], _fragment_lookup_keys(chromosome_ixs, positions),
+                                   side=side)
+    found = np.logical_and(chromosome_ixs >= 0, fragment_ixs < len(fragments))
+    fragment_ixs[~found] = 0
+    if len(fragments) == 0:
+        return found, np.zeros(len(fragment_ixs), dtype=_fragment_lookup_dtype)
+
+    read_fragments = fragments[fragment_ixs]
+    found &= read_fragments['chromosome_ix'] == chromosome_ixs
+    return found, read_fragments
+
+
+def _fragment_info_records(fragments, partition_breaks, chromosome_ixs1, positions1, flags1,
+                           chromosome_ixs2, positions2, flags2):
+    """
+    Find restriction fragments and partitions for a batch of read pairs.
+
+    Pairs are ordered so that the left read maps to the fragment with the
+    lower index.
+
+    :return: tuple (array with :code:`_fragment_info_dtype`, number of pairs
+             skipped because a read could not be assigned to a fragment)
+    """
+    positions1 = np.asarray(positions1, dtype=np.int64)
+    positions2 = np.asarray(positions2, dtype=np.int64)
+    found1, fragments1 = _lookup_fragments(fragments, chromosome_ixs1, positions1)
+    found2, fragments2 = _lookup_fragments(fragments, chromosome_ixs2, positions2)
+    found = np.logical_and(found1, found2)
+
+    strands1 = np.where(np.bitwise_and(np.asarray(flags1, dtype=np.int64), 16) > 0, -1, 1)
+    strands2 = np.where(np.bitwise_and(np.asarray(flags2, dtype=np.int64), 16) > 0, -1, 1)
+
+    left = [positions1[found], strands1[found], fragments1[found]]
+    right = [positions2[found], strands2[found], fragments2[found]]
+    swap = left[2]['ix'] > right[2]['ix']
+    for i in range(3):
+        left[i], right[i] = left[i].copy(), right[i].copy()
+        left[i][swap], right[i][swap] = right[i][swap], left[i][swap]
+
+    records = np.empty(len(swap), dtype=_fragment_info_dtype)
+    for side, (positions, strands, read_fragments) in (('left', left), ('right', right)):
+        records['{}_read_position'.format(side)] = positions
+        records['{}_read_strand'.format(side)] = strands
+        records['{}_fragment_chromosome'.format(side)] = read_fragments['chromosome_ix']
+        records['{}_fragment_start'.format(side)] = read_fragments['start']
+        records['{}_fragment_end'.format(side)] = read_fragments['end']
+        records['{}_partition'.format(side)] = np.searchsorted(partition_breaks, read_fragments['ix'],
+                                                                side='right')
+    records['source'] = left[2]['ix']
+    records['sink'] = right[2]['ix']
+
+    return records, int(np.sum(~found))
+
+
+def _sam_chunks_worker(pair_generator, input_queue, monitor, batch_size=1000000):
+    """
+    Worker that splits SAM/BAM input into chunks of read pairs.
+
+    :param pair_generator: :class:`~SamBamReadPairGenerator` or
+                           :class:`~PairedSamBamReadPairGenerator`
+    :param input_queue: Queue for chunks of the input files
+    :param monitor: :class:`~Monitor`
+    :param batch_size: Number of read pairs per chunk
+    """
     monitor.set_generating_pairs(True)
     try:
-        if tmpdir is None:
-            tmpdir = tempfile.mkdtemp()
-
-        output_prefix = os.path.join(tmpdir, 'split_pairs')
-        try:
-            logger.debug("Splitting and pairing SAM files")
-            for pairs_file in split_sam_pairs(sam_file1, sam_file2, output_prefix,
-                                              chunk_size=batch_size, check_sorted=check_sorted):
-                logger.debug("Split pairs batch {}".format(pairs_file))
-                input_queue.put(pairs_file)
-                monitor.increment()
-        except ValueError as e:
-            logger.error(e)
-            input_queue.put(None)
+        for chunk in pair_generator.chunks(batch_size=batch_size):
+            logger.debug("Submitting SAM chunk {}".format(chunk))
+            input_queue.put(chunk)
+            monitor.increment()
+    except ValueError as e:
+        logger.error(e)
     finally:
         monitor.set_generating_pairs(False)
 
 
-def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe,
-                            partition_breaks, read_filters=None,
-                            tmpdir=None, buffer_size=1000000):
+def _sam_chunk_fragment_info_worker(monitor, input_queue, output_queue, pair_generator,
+                                    fragments_file, chromosome_to_ix, partition_breaks,
+                                    buffer_size=100000):
+    """
+    Worker that generates read pairs from chunks of SAM/BAM files and
+    finds their restriction fragment info.
+
+    For each chunk, the worker puts tuples (records, stats) on the
+    output queue, where records are arrays of fragment info records
+    (:code:`_fragment_info_dtype`) of at most :code:`buffer_size` pairs.
+    stats is None for all but the last tuple of a chunk, which carries
+    the read filter statistics of the chunk.
+
+    :param monitor: :class:`~Monitor`
+    :param input_queue: Queue for input chunks, as generated by the
+                        chunks method of the read pair generator
+    :param output_queue: Queue for output (records, stats) tuples
+    :param pair_generator: :class:`~SamBamReadPairGenerator` or
+                           :class:`~PairedSamBamReadPairGenerator`,
+                           including read filters
+    :param fragments_file: .npy file with the fragment lookup table
+                           (:code:`_fragment_lookup_dtype`)
+    :param chromosome_to_ix: Dictionary of chromosome indexes by chromosome name
+    :param partition_breaks: Partition breaks of the :class:`~ReadPairs` object
+    :param buffer_size: Maximum number of read pairs in each records array
+    """
     worker_uuid = uuid.uuid4()
-    monitor.set_worker_busy(worker_uuid)
-    logger.debug("Starting load SAM worker {}".format(worker_uuid))
+    logger.debug("Starting SAM chunk worker {}".format(worker_uuid))
+
+    # fragment lookup table is shared between workers via a memory-mapped file
+    fragments = np.load(fragments_file, mmap_mode='r')
 
-    if tmpdir is None:
-        tmpdir = tempfile.mkdtemp()
+    def _records(batch):
+        chromosomes1, positions1, flags1, chromosomes2, positions2, flags2 = batch
+        records, skipped = _fragment_info_records(fragments, partition_breaks,
+                                                  _chromosome_ixs(chromosomes1, chromosome_to_ix),
+                                                  positions1, flags1,
+                                                  _chromosome_ixs(chromosomes2, chromosome_to_ix),
+                                                  positions2, flags2)
+        logger.debug("Worker {} skipped {} pairs".format(worker_uuid, skipped))
+        return records
 
-    file_counter = 0
     while True:
         # wait for input
         monitor.set_worker_idle(worker_uuid)
         logger.debug("Worker {} waiting for input".format(worker_uuid))
-        read_pairs_file = input_file_queue.get(True)
+        chunk = input_queue.get(True)
         monitor.set_worker_busy(worker_uuid)
-        logger.debug('Worker {} received input!'.format(worker_uuid))
-
-        output_file = os.path.join(tmpdir, 'fragment_info_{}_{}.txt'.format(worker_uuid, file_counter))
-        logger.debug("Writing fragment info to output file {}".format(output_file))
-        file_counter += 1
-
-        lines = []
-        skipped_counter = 0
-        pair_generator = PairedSamBamReadPairGenerator(read_pairs_file)
-        if read_filters is not None:
-            for f in read_filters:
-                pair_generator.add_filter(f)
-
-        for read1, read2 in pair_generator:
-            chrom1, pos1, flag1 = read1.reference_name, read1.pos, read1.flag
-            chrom2, pos2, flag2 = read2.reference_name, read2.pos, read2.flag
-            chrom1 = chrom1.decode() if isinstance(chrom1, bytes) else chrom1
-            chrom2 = chrom2.decode() if isinstance(chrom2, bytes) else chrom2
+        logger.debug('Worker {} received chunk {}'.format(worker_uuid, chunk))
 
-            try:
-                pos_ix1 = bisect_right(fe[chrom1], pos1)
-                pos_ix2 = bisect_right(fe[chrom2], pos2)
-
-                f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi[chrom1][pos_ix1]
-                f_ix2, f_chromosome_ix2, f_start2, f_end2 = fi[chrom2][pos_ix2]
-
-                p_ix1 = bisect_right(partition_breaks, f_ix1)
-                p_ix2 = bisect_right(partition_breaks, f_ix2)
-
-                r_strand1 = -1 if flag1 & 16 else 1
-                r_strand2 = -1 if flag2 & 16 else 1
+        chunk_generator = copy.copy(pair_generator)
+        chunk_generator.chunk = chunk
 
-                if p_ix1 > p_ix2:
-                    line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                        p_ix2, pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2,
-                        p_ix1, pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1
-                    )
-                else:
-                    line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                        p_ix1, pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1,
-                        p_ix2, pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2
-                    )
-                lines.append(line)
-
-                if len(lines) > buffer_size:
-                    with open(output_file, 'a') as o:
-                        for line in lines:
-                            o.write(line)
-                    lines = []
-            except (KeyError, IndexError):
-                skipped_counter += 1
+        batch = ([], [], [], [], [], [])
+        for read1, read2 in chunk_generator:
+            batch[0].append(read1.reference_name)
+            batch[1].append(read1.pos)
+            batch[2].append(read1.flag)
+            batch[3].append(read2.reference_name)
+            batch[4].append(read2.pos)
+            batch[5].append(read2.flag)
 
-        with open(output_file, 'a') as o:
-            for line in lines:
-                o.write(line)
+            if len(batch[0]) >= buffer_size:
+                output_queue.put((_records(batch), None))
+                batch = ([], [], [], [], [], [])
 
-        logger.debug("Done obtaining fragment info for {} in {}".format(read_pairs_file, output_file))
-        output_file_queue.put((read_pairs_file, output_file, pair_generator.stats()))
+        output_queue.put((_records(batch), chunk_generator.stats()))
 
 
-def _fragment_info_worker(monitor, input_queue, output_queue, fi, fe):
+def _fragment_info_worker(monitor, input_queue, output_queue, fragments_file,
+                          chromosome_to_ix, partition_breaks):
     """
     Worker that finds the restriction fragment info for read pairs.
 
@@ -261,14 +360,19 @@ def _fragment_info_worker(monitor, input_queue, output_queue, fi, fe):
 
     :param monitor: :class:`~Monitor`
     :param input_queue: Queue for input read_pairs
-    :param output_queue: Queue for output fragment infos
-    :param fi: Fragment info dictionary by chromosome and fragment index
-    :param fe: Fragment end coordinates by chromosome
-    :return: list of fragment infos
+    :param output_queue: Queue for output fragment info records
+    :param fragments_file: .npy file with the fragment lookup table
+                           (:code:`_fragment_lookup_dtype`)
+    :param chromosome_to_ix: Dictionary of chromosome indexes by chromosome name
+    :param partition_breaks: Partition breaks of the :class:`~ReadPairs` object
+    :return: array of fragment info records (:code:`_fragment_info_dtype`)
     """
     worker_uuid = uuid.uuid4()
     logger.debug("Starting fragment info worker {}".format(worker_uuid))
 
+    # fragment lookup table is shared between workers via a memory-mapped file
+    fragments = np.load(fragments_file, mmap_mode='r')
+
     while True:
         # wait for input
         monitor.set_worker_idle(worker_uuid)
@@ -276,32 +380,15 @@ def _fragment_info_worker(monitor, input_queue, output_queue, fi, fe):
         read_pairs = input_queue.get(True)
         monitor.set_worker_busy(worker_uuid)
         logger.debug('Worker {} reveived input!'.format(worker_uuid))
-        read_pairs = msgpack.loads(read_pairs)
-
-        fragment_infos = []
-        skipped_counter = 0
-        for (chrom1, pos1, flag1), (chrom2, pos2, flag2) in read_pairs:
-            chrom1 = chrom1.decode() if isinstance(chrom1, bytes) else chrom1
-            chrom2 = chrom2.decode() if isinstance(chrom2, bytes) else chrom2
+        chromosomes1, positions1, flags1, chromosomes2, positions2, flags2 = msgpack.loads(read_pairs)
 
-            try:
-                pos_ix1 = bisect_right(fe[chrom1], pos1)
-                pos_ix2 = bisect_right(fe[chrom2], pos2)
-
-                f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi[chrom1][pos_ix1]
-                f_ix2, f_chromosome_ix2, f_start2, f_end2 = fi[chrom2][pos_ix2]
-
-                r_strand1 = -1 if flag1 & 16 else 1
-                r_strand2 = -1 if flag2 & 16 else 1
-
-                fragment_infos.append(
-                    ((pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1),
-                     (pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2))
-                )
-            except (KeyError, IndexError):
-                skipped_counter += 1
+        records, skipped_counter = _fragment_info_records(fragments, partition_breaks,
+                                                          _chromosome_ixs(chromosomes1, chromosome_to_ix),
+                                                          positions1, flags1,
+                                                          _chromosome_ixs(chromosomes2, chromosome_to_ix),
+                                                          positions2, flags2)
         logger.debug("Worker {} skipped {} pairs".format(worker_uuid, skipped_counter))
-        output_queue.put(msgpack.dumps(fragment_infos))
+        output_queue.put(records)
         del read_pairs
 
 
@@ -315,19 +402,25 @@ def _read_pairs_worker(read_pairs, input_queue, monitor, batch_size=100000):
     :param batch_size: Number of read pairs sent to each worker
     """
     logger.debug("Starting read pairs worker")
+
+    def _read_pairs_batch():
+        return [], [], [], [], [], []
+
     try:
-        read_pairs_batch = []
+        read_pairs_batch = _read_pairs_batch()
         for read1, read2 in read_pairs:
-            read_pairs_batch.append((
-                (read1.reference_name, read1.pos, read1.flag),
-                (read2.reference_name, read2.pos, read2.flag)
-            ))
-            if len(read_pairs_batch) >= batch_size:
+            read_pairs_batch[0].append(read1.reference_name)
+            read_pairs_batch[1].append(read1.pos)
+            read_pairs_batch[2].append(read1.flag)
+            read_pairs_batch[3].append(read2.reference_name)
+            read_pairs_batch[4].append(read2.pos)
+            read_pairs_batch[5].append(read2.flag)
+            if len(read_pairs_batch[0]) >= batch_size:
                 logger.debug("Submitting read pair batch ({}) to input queue".format(batch_size))
                 input_queue.put(msgpack.dumps(read_pairs_batch))
-                read_pairs_batch = []
+                read_pairs_batch = _read_pairs_batch()
                 monitor.increment()
-        if len(read_pairs_batch) > 0:
+        if len(read_pairs_batch[0]) > 0:
             logger.debug("Submitting read pair batch ({}) to input queue".format(batch_size))
             input_queue.put(msgpack.dumps(read_pairs_batch))
             monitor.increment()
@@ -336,6 +429,80 @@ def _read_pairs_worker(read_pairs, input_queue, monitor, batch_size=100000):
     logger.debug("Terminating read pairs worker")
 
 
+# comment lines in txt read pair files
+_comment_lines = re.compile(r'^#.*\n?', re.MULTILINE)
+
+
+def _remove_comment_lines(text):
+    # header lines at the start of a file are removed without scanning the whole text
+    start = 0
+    while text.startswith('#', start):
+        end = text.find('\n', start)
+        start = end + 1 if end >= 0 else len(text)
+    if start > 0:
+        text = text[start:]
+    if '\n#' in text:
+        return _comment_lines.sub('', text)
+    return text
+
+
+class _SamBamChunkIterator(object):
+    """
+    Iterator over the reads of a SAM/BAM file between two file offsets.
+
+    Offsets are those returned by :func:`~pysam.AlignmentFile.tell`,
+    i.e. BGZF virtual offsets for BAM files. The number of unmapped
+    reads returned by the iterator is counted in unmapped_count.
+    """
+    def __init__(self, sam, start=None, stop=None):
+        """
+        :param sam: :class:`~pysam.AlignmentFile`
+        :param start: Offset of the first read. If None, starts at the
+                      current position in the file
+        :param stop: Offset at which to stop. If None, iterates until
+                     the end of the file
+        """
+        self.sam = sam
+        self.stop = stop
+        self.unmapped_count = 0
+        if start is not None:
+            sam.seek(start)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop is not None and self.sam.tell() >= self.stop:
+            raise StopIteration
+        read = next(self.sam)
+        if read.is_unmapped:
+            self.unmapped_count += 1
+        return read
+
+
+def _qname_offsets(sam):
+    """
+    Iterate over the groups of reads with identical names in a SAM/BAM file.
+
+    :param sam: :class:`~pysam.AlignmentFile`
+    :return: iterator over (offset, qname) tuples, where offset is the file
+             offset of the first read in each group and qname its
+             name (bytes)
+    """
+    qname = None
+    while True:
+        offset = sam.tell()
+        try:
+            read = next(sam)
+        except StopIteration:
+            return
+
+        read_qname = read.qname.encode()
+        if qname is None or natural_cmp(read_qname, qname) != 0:
+            qname = read_qname
+            yield offset, qname
+
+
 class MinimalRead(object):
     """
     Minimal class representing an aligned read.
@@ -398,9 +565,17 @@ class ReadPairGenerator(object):
 
     Subclasses of :class:`~ReadPairGenerator` must implement the
     :func:`~ReadPairGenerator._iter_read_pairs` function.
+
+    Read pairs are filtered in batches of :code:`batch_size` pairs:
+    the read fields required by the filters (see
+    :attr:`~ReadFilter.chunk_fields`) are extracted into arrays once
+    per batch, and each filter implementing
+    :func:`~ReadFilter.valid_chunk` is evaluated on all reads in the
+    batch at once.
     """
-    def __init__(self):
+    def __init__(self, batch_size=10000):
         self.filters = []
+        self.batch_size = batch_size
         self._filter_stats = defaultdict(int)
         self._total_pairs = 0
         self._valid_pairs = 0
@@ -463,16 +638,53 @@ class ReadPairGenerator(object):
         self._filter_stats = defaultdict(int)
         self._total_pairs = 0
         self._valid_pairs = 0
-        for (read1, read2) in self._iter_read_pairs():
-            valid_reads = True
-            for i, f in enumerate(self.filters):
-                if not f.valid_read(read1) or not f.valid_read(read2):
-                    self._filter_stats[i] += 1
-                    valid_reads = False
-            if valid_reads:
-                yield (read1, read2)
-                self._valid_pairs += 1
-            self._total_pairs += 1
+        read_pairs = self._iter_read_pairs()
+        while True:
+            batch = list(itertools.islice(read_pairs, max(1, self.batch_size)))
+            if len(batch) == 0:
+                break
+
+            self._total_pairs += len(batch)
+            if len(self.filters) > 0:
+                valid = self._valid_batch(batch)
+                batch = [pair for pair, is_valid in zip(batch, valid) if is_valid]
+            self._valid_pairs += len(batch)
+
+            for pair in batch:
+                yield pair
+
+    def _valid_batch(self, read_pairs):
+        """
+        Evaluate all filters on a batch of read pairs.
+
+        Filter statistics are updated for every filter that
+        removes at least one pair in this batch.
+
+        :param read_pairs: list of (read1, read2) tuples
+        :return: boolean array, True for valid read pairs
+        """
+        n = len(read_pairs)
+        reads = [pair[0] for pair in read_pairs] + [pair[1] for pair in read_pairs]
+
+        fields = set()
+        for f in self.filters:
+            if f.has_valid_chunk():
+                fields.update(f.chunk_fields)
+        arrays = _read_arrays(reads, fields)
+
+        valid = np.ones(n, dtype=bool)
+        for i, f in enumerate(self.filters):
+            if f.has_valid_chunk():
+                valid_reads = np.asarray(f.valid_chunk(arrays), dtype=bool)
+            else:
+                valid_reads = np.fromiter((f.valid_read(read) for read in reads),
+                                          dtype=bool, count=len(reads))
+            valid_pairs = np.logical_and(valid_reads[:n], valid_reads[n:])
+            n_invalid = n - np.count_nonzero(valid_pairs)
+            if n_invalid > 0:
+                self._filter_stats[i] += int(n_invalid)
+            valid &= valid_pairs
+        return valid
 
 
 class TxtReadPairGenerator(ReadPairGenerator):
@@ -491,6 +703,10 @@ class TxtReadPairGenerator(ReadPairGenerator):
     "pos<1|2>_field", and "strand<1|2>_field". If your file does not
     have strand fields, or if you don't want to load them, you can
     simply set them to "None".
+
+    Without read filters, :func:`~ReadPairs.add_read_pairs` does not
+    iterate over individual read pairs, but parses whole blocks of the
+    file into columns using :func:`~TxtReadPairGenerator.read_pair_chunks`.
     """
     def __init__(self, valid_pairs_file, sep=None,
                  chr1_field=1, pos1_field=2, strand1_field=3,
@@ -590,6 +806,73 @@ class TxtReadPairGenerator(ReadPairGenerator):
                                     strand=strand2)
                 yield (read1, read2)
 
+    def _text_blocks(self, block_size):
+        """
+        Iterate over blocks of complete lines in the txt file, without comment lines.
+        """
+        with self._open_file(self._file_name, 'rt') as f:
+            remainder = ''
+            while True:
+                text = f.read(block_size)
+                if text == '':
+                    break
+
+                text = remainder + text
+                end = text.rfind('\n') + 1
+                remainder = text[end:]
+                block = _remove_comment_lines(text[:end])
+                if block != '' and not block.isspace():
+                    yield block
+
+            block = _remove_comment_lines(remainder)
+            if block != '' and not block.isspace():
+                yield block
+
+    def read_pair_chunks(self, block_size=64000000):
+        """
+        Iterate over read pairs in the txt file in columnar form.
+
+        The file is read in blocks of about :code:`block_size` characters,
+        and the fields of each block are parsed into arrays at once.
+        Chromosome names are returned as :class:`~pandas.Categorical`,
+        so that they can be converted to chromosome indexes by looking
+        up each distinct name only once. Flags are 0 for reads on the
+        "+" strand, and -1 otherwise, as in :class:`~MinimalRead`.
+
+        Read filters are not applied, but the total and valid pair
+        counts in :func:`~ReadPairGenerator.stats` are updated.
+
+        :param block_size: Approximate number of characters parsed at once
+        :return: iterator over tuples (chromosomes1, positions1, flags1,
+                 chromosomes2, positions2, flags2)
+        """
+        fields = [self.chr1_field, self.pos1_field, self.chr2_field, self.pos2_field]
+        dtypes = {self.chr1_field: 'category', self.chr2_field: 'category',
+                  self.pos1_field: np.int64, self.pos2_field: np.int64}
+        for strand_field in (self.strand1_field, self.strand2_field):
+            if strand_field is not None:
+                fields.append(strand_field)
+                dtypes[strand_field] = 'category'
+
+        def _flags(columns, strand_field):
+            if strand_field is None:
+                return np.zeros(len(columns), dtype=np.int64)
+            return np.where(np.asarray(columns[strand_field].values == '+'), 0, -1)
+
+        self._filter_stats = defaultdict(int)
+        self._total_pairs = 0
+        self._valid_pairs = 0
+        for block in self._text_blocks(block_size):
+            columns = pd.read_csv(io.StringIO(block), sep=r'\s+' if self.sep is None else self.sep,
+                                  header=None, usecols=sorted(set(fields)), dtype=dtypes,
+                                  quoting=csv.QUOTE_NONE, na_filter=False)
+            self._total_pairs += len(columns)
+            self._valid_pairs += len(columns)
+            yield (columns[self.chr1_field].values, columns[self.pos1_field].values,
+                   _flags(columns, self.strand1_field),
+                   columns[self.chr2_field].values, columns[self.pos2_field].values,
+                   _flags(columns, self.strand2_field))
+
 
 class HicProPairGenerator(TxtReadPairGenerator):
     """
@@ -636,9 +919,10 @@ class FourDNucleomePairGenerator(TxtReadPairGenerator):
                                      "'#columns' entry in the header")
 
                 if line.startswith('#columns:'):
-                    _, columns_field = line.split(':')
-                    for i, name in columns_field.split():
+                    _, columns_field = line.split(':', 1)
+                    for i, name in enumerate(columns_field.split()):
                         columns[name] = i
+                    break
 
         TxtReadPairGenerator.__init__(self, pairs_file, sep=None,
                                       chr1_field=columns['chr1'],
@@ -662,10 +946,53 @@ class PairedSamBamReadPairGenerator(ReadPairGenerator):
     of the chimeric alignment maps within 100bp of the regular alignment,
     the read pair is kept and returned. In all other cases, the pair is
     removed.
+
+    Read pairs can be generated from a part of the file only by setting
+    :attr:`chunk` to one of the chunks returned by
+    :func:`~PairedSamBamReadPairGenerator.chunks`.
     """
-    def __init__(self, sam_file):
+    def __init__(self, sam_file, chunk=None):
+        """
+        :param sam_file: Path to a SAM/BAM file sorted by read name, or
+                         :class:`~pysam.AlignmentFile`
+        :param chunk: Optional chunk of the SAM/BAM file, see
+                      :func:`~PairedSamBamReadPairGenerator.chunks`
+        """
         ReadPairGenerator.__init__(self)
         self.sam_file = sam_file
+        self.chunk = chunk
+
+    def chunks(self, batch_size=1000000):
+        """
+        Split the SAM/BAM file into chunks at read name boundaries.
+
+        Only read names are compared, so this is considerably faster
+        than generating the read pairs.
+
+        :param batch_size: Number of read names per chunk
+        :return: iterator over chunks, tuples of the form
+                 ((start, stop),) with the file offsets (as returned by
+                 :func:`~pysam.AlignmentFile.tell`) of the first read in the
+                 chunk and of the first read after the chunk (None at the
+                 end of the file)
+        """
+        if isinstance(self.sam_file, pysam.AlignmentFile):
+            sam_file = self.sam_file.filename
+        else:
+            sam_file = self.sam_file
+
+        with pysam.AlignmentFile(sam_file) as sam:
+            start = None
+            n_qnames = 0
+            for offset, _ in _qname_offsets(sam):
+                if start is None:
+                    start = offset
+                elif n_qnames >= batch_size:
+                    yield ((start, offset),)
+                    start = offset
+                    n_qnames = 0
+                n_qnames += 1
+            yield ((start, None),)
 
     @staticmethod
     def resolve_chimeric(reads, max_dist_same_locus=100):
@@ -710,9 +1037,14 @@ class PairedSamBamReadPairGenerator(ReadPairGenerator):
         normal_pairs = 0
         abnormal_pairs = 0
 
+        if self.chunk is None:
+            sam_iter = iter(sam)
+        else:
+            sam_iter = _SamBamChunkIterator(sam, *self.chunk[0])
+
         current_qname = None
         reads = []
-        for read in sam:
+        for read in sam_iter:
             if read.is_unmapped:
                 continue
 
@@ -773,17 +1105,91 @@ class SamBamReadPairGenerator(ReadPairGenerator):
     of the chimeric alignment maps within 100bp of the regular alignment,
     the read pair is kept and returned. In all other cases, the pair is
     removed.
+
+    Read pairs can be generated from a part of the files only by setting
+    :attr:`chunk` to one of the chunks returned by
+    :func:`~SamBamReadPairGenerator.chunks`.
     """
-    def __init__(self, sam_file1, sam_file2, check_sorted=True):
+    def __init__(self, sam_file1, sam_file2, check_sorted=True, chunk=None):
+        """
+        :param sam_file1: Path to a SAM/BAM file sorted by read name (1st mate)
+        :param sam_file2: Path to a SAM/BAM file sorted by read name (2nd mate)
+        :param check_sorted: Raise a ValueError if the files are not sorted
+                             by read name
+        :param chunk: Optional chunk of the SAM/BAM files, see
+                      :func:`~SamBamReadPairGenerator.chunks`
+        """
         ReadPairGenerator.__init__(self)
         self.sam_file1 = sam_file1
         self.sam_file2 = sam_file2
         self._check_sorted = check_sorted
+        self.chunk = chunk
         if not os.path.exists(self.sam_file1):
             raise ValueError("File {} does not exist!".format(self.sam_file1))
         if not os.path.exists(self.sam_file2):
             raise ValueError("File {} does not exist!".format(self.sam_file2))
 
+    def chunks(self, batch_size=1000000):
+        """
+        Split the SAM/BAM files into chunks at read name boundaries.
+
+        The read names in both files are merged like during read pair
+        generation, and a new chunk is started every :code:`batch_size`
+        read names found in both files. Mates of a pair are therefore
+        always in the same chunk. Only read names are compared, so this
+        is considerably faster than generating the read pairs.
+
+        :param batch_size: Number of read names in both files per chunk
+        :return: iterator over chunks, tuples of the form
+                 ((start1, stop1), (start2, stop2)) with the file offsets (as
+                 returned by :func:`~pysam.AlignmentFile.tell`) of the first
+                 read in the chunk and of the first read after the chunk
+                 (None at the end of the file) in the first and second file
+        """
+        with pysam.AlignmentFile(self.sam_file1) as sam1:
+            with pysam.AlignmentFile(self.sam_file2) as sam2:
+                qnames1 = _qname_offsets(sam1)
+                qnames2 = _qname_offsets(sam2)
+                start1, start2 = None, None
+                try:
+                    offset1, qname1 = next(qnames1)
+                    offset2, qname2 = next(qnames2)
+                    start1, start2 = offset1, offset2
+
+                    n_pairs = 0
+                    while True:
+                        previous_qname1 = qname1
+                        previous_qname2 = qname2
+
+                        cmp = natural_cmp(qname1, qname2)
+                        if cmp == 0:  # read name identical
+                            n_pairs += 1
+                            offset1, qname1 = next(qnames1)
+                            offset2, qname2 = next(qnames2)
+                        elif cmp < 0:  # first pointer behind
+                            offset1, qname1 = next(qnames1)
+                        else:  # second pointer behind
+                            offset2, qname2 = next(qnames2)
+
+                        # check that the files are sorted
+                        if self._check_sorted:
+                            if natural_cmp(previous_qname1, qname1) > 0:
+                                raise ValueError("First SAM file is not sorted by "
+                                                 "read name (samtools sort -n)! Read names:"
+                                                 "{} and {}".format(previous_qname1, qname1))
+                            if natural_cmp(previous_qname2, qname2) > 0:
+                                raise ValueError("Second SAM file is not sorted by "
+                                                 "read name (samtools sort -n)! Read names:"
+                                                 "{} and {}".format(previous_qname2, qname2))
+
+                        if n_pairs >= batch_size:
+                            yield (start1, offset1), (start2, offset2)
+                            start1, start2 = offset1, offset2
+                            n_pairs = 0
+                except StopIteration:
+                    pass
+                yield (start1, None), (start2, None)
+
     def _iter_read_pairs(self, *args, **kwargs):
         max_dist_same_locus = kwargs.get('max_dist_same_locus', 100)
         logger.info("Starting to generate read pairs from SAM")
@@ -808,6 +1214,8 @@ class SamBamReadPairGenerator(ReadPairGenerator):
             except StopIteration:
                 if len(reads) == 0:
                     raise
+                # the last read has already been processed
+                next_read = None
             return reads[0].qname.encode(), reads, next_read
 
         def _find_pair(reads1, reads2):
@@ -851,8 +1259,13 @@ class SamBamReadPairGenerator(ReadPairGenerator):
                 chimeric_pairs = 0
                 abnormal_pairs = 0
 
-                sam1_iter = iter(sam1)
-                sam2_iter = iter(sam2)
+                if self.chunk is None:
+                    sam1_iter = iter(sam1)
+                    sam2_iter = iter(sam2)
+                else:
+                    sam1_iter = _SamBamChunkIterator(sam1, *self.chunk[0])
+                    sam2_iter = _SamBamChunkIterator(sam2, *self.chunk[1])
+                unmappable_count = self._unmappable_count
                 try:
                     qname1, reads1, next_read1 = _all_reads(sam1_iter)
                     qname2, reads2, next_read2 = _all_reads(sam2_iter)
@@ -894,6 +1307,16 @@ class SamBamReadPairGenerator(ReadPairGenerator):
                                                  "read name (samtools sort -n)! Read names:"
                                                  "{} and {}".format(previous_qname2, qname2))
                 except StopIteration:
+                    if self.chunk is not None and (sam1_iter.stop is not None or sam2_iter.stop is not None):
+                        # all reads in a chunk before the end of the files would
+                        # eventually be read, count the remaining unmapped ones
+                        for _ in sam1_iter:
+                            pass
+                        for _ in sam2_iter:
+                            pass
+                        self._unmappable_count = (unmappable_count + sam1_iter.unmapped_count +
+                                                  sam2_iter.unmapped_count)
+
                     logger.info("Done generating read pairs.")
                     logger.info("Normal pairs: {}".format(normal_pairs))
                     logger.info("Chimeric pairs: {}".format(chimeric_pairs))
@@ -1179,12 +1602,14 @@ class ReadPairs(RegionPairsTable):
 
         self._ix_to_chromosome = dict()
         self._chromosome_to_ix = dict()
+        self._fragments = None
         self._update_references()
 
     def _update_references(self):
         """
         Update internal chromosome index dictionaries.
         """
+        self._fragments = None
         if self._chromosomes_info is not None:
             for row in self._chromosomes_info.iterrows():
                 ix, chromosome = row['ix'], row['name'].decode()
@@ -1216,17 +1641,43 @@ class ReadPairs(RegionPairsTable):
         """
         RegionPairsTable.flush(self, silent=silent)
 
-    def _read_fragment_info(self, read):
-        chromosome = read.reference_name
-        fragment_info = None
-        for row in self._regions.where(
-                        "(start <= %d) & (end >= %d) & (chromosome == b'%s')" % (read.pos, read.pos, chromosome)):
-            fragment_info = [row['ix'], self._chromosome_to_ix[chromosome], row['start'], row['end']]
+    def _fragment_lookup(self):
+        """
+        Restriction fragments as a lookup table for :func:`~_lookup_fragments`.
+
+        :return: numpy structured array with :code:`_fragment_lookup_dtype`,
+                 sorted by chromosome index and fragment end
+        """
+        if self._fragments is None:
+            fragments = np.empty(len(self._regions), dtype=_fragment_lookup_dtype)
+            fragments['ix'] = self._regions.col('ix')
+            fragments['chromosome_ix'] = _chromosome_ixs(self._regions.col('chromosome'),
+                                                         self._chromosome_to_ix)
+            fragments['start'] = self._regions.col('start')
+            fragments['end'] = self._regions.col('end')
+            fragments['key'] = _fragment_lookup_keys(fragments['chromosome_ix'], fragments['end'])
+            self._fragments = fragments[np.argsort(fragments['key'], kind='stable')]
+        return self._fragments
 
-        if fragment_info is None:
+    def _fragment_lookup_file(self, tmpdir):
+        """
+        Save the fragment lookup table to a .npy file that can be memory-mapped
+        by worker processes.
+        """
+        fragments_file = os.path.join(tmpdir, 'fragments.npy')
+        np.save(fragments_file, self._fragment_lookup())
+        return fragments_file
+
+    def _read_fragment_info(self, read):
+        chromosome_ixs = _chromosome_ixs([read.reference_name], self._chromosome_to_ix)
+        found, fragments = _lookup_fragments(self._fragment_lookup(), chromosome_ixs, [read.pos],
+                                             side='left')
+        if not found[0] or fragments['start'][0] > read.pos:
             raise ValueError("No matching region can be found for {}".format(read))
 
-        return fragment_info
+        fragment = fragments[0]
+        return [int(fragment['ix']), int(fragment['chromosome_ix']),
+                int(fragment['start']), int(fragment['end'])]
 
     def _read_pair_fragment_info(self, read_pair):
         read1, read2 = read_pair
@@ -1249,14 +1700,10 @@ class ReadPairs(RegionPairsTable):
         :param timeout: Time to wait for reply of first worker. If this
                         threshold is exceeded before any read pairs have been
                         returned, a warning is displayed.
+        :return: iterator over arrays of fragment info records (:code:`_fragment_info_dtype`)
         """
-        fragment_infos = defaultdict(list)
-        fragment_ends = defaultdict(list)
-        for region in self.regions(lazy=True):
-            chromosome = region.chromosome
-            fragment_infos[chromosome].append((region.ix, self._chromosome_to_ix[chromosome],
-                                               region.start, region.end))
-            fragment_ends[chromosome].append(region.end)
+        fragments_tmpdir = tempfile.mkdtemp()
+        fragments_file = self._fragment_lookup_file(fragments_tmpdir)
 
         worker_pool = None
         t_pairs = None
@@ -1272,17 +1719,16 @@ class ReadPairs(RegionPairsTable):
             t_pairs.start()
 
             worker_pool = mp.Pool(threads, _fragment_info_worker,
-                                  (monitor, input_queue, output_queue, fragment_infos, fragment_ends))
+                                  (monitor, input_queue, output_queue, fragments_file,
+                                   self._chromosome_to_ix, self._partition_breaks))
 
             output_counter = 0
             while output_counter < monitor.value() or not monitor.workers_idle() or monitor.is_generating_pairs():
                 try:
-                    read_pair_infos = output_queue.get(block=True, timeout=timeout)
-
-                    for read1_info, read2_info in msgpack.loads(read_pair_infos):
-                        yield read1_info, read2_info
+                    records = output_queue.get(block=True, timeout=timeout)
+                    yield records
                     output_counter += 1
-                    del read_pair_infos
+                    del records
                 except Empty:
                     logger.warning("Reached SAM pair generator timeout. This could mean that no "
                                    "valid read pairs were found after filtering. "
@@ -1292,6 +1738,30 @@ class ReadPairs(RegionPairsTable):
                 worker_pool.terminate()
             if t_pairs is not None:
                 t_pairs.join()
+            shutil.rmtree(fragments_tmpdir)
+
+    def _read_pair_chunks_fragment_info(self, read_pairs):
+        """
+        Find restriction fragments for read pairs in columnar form.
+
+        :param read_pairs: :class:`~TxtReadPairGenerator`
+        :return: iterator over arrays of fragment info records (:code:`_fragment_info_dtype`)
+        """
+        fragments = self._fragment_lookup()
+
+        def _categorical_chromosome_ixs(chromosomes):
+            chromosomes = pd.Categorical(chromosomes)
+            category_ixs = _chromosome_ixs(chromosomes.categories, self._chromosome_to_ix)
+            return category_ixs[chromosomes.codes]
+
+        for chromosomes1, positions1, flags1, chromosomes2, positions2, flags2 in read_pairs.read_pair_chunks():
+            records, skipped = _fragment_info_records(fragments, self._partition_breaks,
+                                                      _categorical_chromosome_ixs(chromosomes1),
+                                                      positions1, flags1,
+                                                      _categorical_chromosome_ixs(chromosomes2),
+                                                      positions2, flags2)
+            logger.debug("Skipped {} pairs".format(skipped))
+            yield records
 
     def _add_infos(self, fi1, fi2):
         r_pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi1
@@ -1325,6 +1795,9 @@ class ReadPairs(RegionPairsTable):
             self.flush()
 
     def load_read_pairs_fragment_info_file(self, read_pairs_file):
+        if read_pairs_file.endswith('.npy'):
+            return self._load_read_pairs_fragment_info_records(np.load(read_pairs_file))
+
         if read_pairs_file.endswith('.gz') or read_pairs_file.endswith('.gzip'):
             open_ = gzip.open
         else:
@@ -1358,69 +1831,115 @@ class ReadPairs(RegionPairsTable):
                 self._edge_buffer.add_dict(edge, partition=(int(info1[0]), int(info2[0])))
                 self._pair_count += 1
 
-    def add_read_pairs_from_sam(self, sam_file1, sam_file2, batch_size=10000000, threads=1,
+    def _load_read_pairs_fragment_info_records(self, records):
+        """
+        Add read pairs from a structured array of fragment info records.
+
+        Records are converted into edge table rows in bulk and appended
+        to each partition in one go.
+
+        :param records: numpy structured array with :code:`_fragment_info_dtype`
+        """
+        if self._pair_count is None:
+            self._pair_count = sum(edge_table._original_len()
+                                   for _, edge_table in self._iter_edge_tables())
+
+        if len(records) == 0:
+            return
+
+        rows = self._edge_buffer.template_rows(len(records))
+        rows['ix'] = np.arange(self._pair_count, self._pair_count + len(records))
+        for name in _fragment_info_dtype.names:
+            if name in rows.dtype.names:
+                rows[name] = records[name]
+        self._pair_count += len(records)
+
+        # stable sort keeps the original pair order within each partition
+        order = np.lexsort((records['right_partition'], records['left_partition']))
+        left_partitions = records['left_partition'][order]
+        right_partitions = records['right_partition'][order]
+        boundaries = np.where(np.logical_or(np.diff(left_partitions) != 0,
+                                            np.diff(right_partitions) != 0))[0] + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(order)]])
+        for start, end in zip(starts, ends):
+            partition = (int(left_partitions[start]), int(right_partitions[start]))
+            self._edge_buffer.add_rows(rows[order[start:end]], partition)
+
+    def add_read_pairs_from_sam(self, sam_file1, sam_file2=None, batch_size=10000000, threads=1,
                                 read_filters=None, check_sorted=True, tmpdir=None):
+        """
+        Add read pairs from SAM/BAM files sorted by read name, using multiple processes.
+
+        The input is split into chunks of :code:`batch_size` read pairs at read
+        name boundaries (see :func:`~SamBamReadPairGenerator.chunks`), without
+        writing intermediate files. Each worker reads its chunks directly from
+        the input files, filters the read pairs, and returns their restriction
+        fragment info as arrays of records.
+
+        :param sam_file1: Path to a SAM/BAM file sorted by read name (1st mate).
+                          If sam_file2 is None, this file must contain both mates
+                          (see :class:`~PairedSamBamReadPairGenerator`)
+        :param sam_file2: Path to a SAM/BAM file sorted by read name (2nd mate)
+        :param batch_size: Number of read pairs in each chunk sent to a worker
+        :param threads: Number of worker processes
+        :param read_filters: List of :class:`~ReadFilter` to filter reads
+        :param check_sorted: Raise an error if the input files are not sorted by
+                             read name
+        :param tmpdir: Optional directory for temporary files
+        """
         self._edges_dirty = True
         self._disable_edge_indexes()
 
-        fragment_infos = defaultdict(list)
-        fragment_ends = defaultdict(list)
-        for region in self.regions(lazy=True):
-            chromosome = region.chromosome
-            fragment_infos[chromosome].append((region.ix, self._chromosome_to_ix[chromosome],
-                                               region.start, region.end))
-            fragment_ends[chromosome].append(region.end)
+        if sam_file2 is None:
+            pair_generator = PairedSamBamReadPairGenerator(sam_file1)
+        else:
+            pair_generator = SamBamReadPairGenerator(sam_file1, sam_file2, check_sorted=check_sorted)
+        if read_filters is not None:
+            for f in read_filters:
+                pair_generator.add_filter(f)
 
         if tmpdir is None:
-            split_tmpdir = tempfile.mkdtemp()
             pairs_tmpdir = tempfile.mkdtemp()
         else:
-            split_tmpdir = tempfile.mkdtemp(dir=tmpdir)
             pairs_tmpdir = tempfile.mkdtemp(dir=tmpdir)
+        fragments_file = self._fragment_lookup_file(pairs_tmpdir)
 
         worker_pool = None
-        t_split = None
+        t_chunks = None
         all_stats = defaultdict(int)
         try:
-            queue_manager = mp.Manager()
-            input_file_queue = queue_manager.Queue()
-            output_file_queue = queue_manager.Queue()
+            input_queue = mp.Queue()
+            output_queue = mp.Queue(maxsize=2*threads)
 
             monitor = Monitor()
             monitor.set_generating_pairs(True)
-            t_split = threading.Thread(target=_split_sam_worker, args=(sam_file1, sam_file2,
-                                                                       input_file_queue,
-                                                                       monitor, batch_size,
-                                                                       split_tmpdir,
-                                                                       check_sorted))
-            t_split.daemon = True
-            t_split.start()
-
-            worker_pool = mp.Pool(threads, _load_paired_sam_worker,
-                                  (monitor, input_file_queue, output_file_queue,
-                                   fragment_infos, fragment_ends, self._partition_breaks,
-                                   read_filters, pairs_tmpdir))
+            t_chunks = threading.Thread(target=_sam_chunks_worker, args=(pair_generator, input_queue,
+                                                                         monitor, batch_size))
+            t_chunks.daemon = True
+            t_chunks.start()
+
+            worker_pool = mp.Pool(threads, _sam_chunk_fragment_info_worker,
+                                  (monitor, input_queue, output_queue, pair_generator,
+                                   fragments_file, self._chromosome_to_ix, self._partition_breaks))
 
             output_counter = 0
-            while output_counter < monitor.value() or not monitor.workers_idle() or monitor.is_generating_pairs():
+            while output_counter < monitor.value() or monitor.is_generating_pairs():
                 try:
-                    input_file, read_pairs_file, chunk_stats = output_file_queue.get(block=True)
-                    os.remove(input_file)
-                    self.load_read_pairs_fragment_info_file(read_pairs_file)
-                    os.remove(read_pairs_file)
+                    records, chunk_stats = output_queue.get(block=True, timeout=1)
+                except Empty:
+                    continue
+
+                self._load_read_pairs_fragment_info_records(records)
+                if chunk_stats is not None:
                     for key, value in chunk_stats.items():
                         all_stats[key] += value
                     output_counter += 1
-                except Empty:
-                    logger.warning("Reached SAM pair generator timeout. This could mean that no "
-                                   "valid read pairs were found after filtering. "
-                                   "Check filter settings!")
         finally:
             if worker_pool is not None:
                 worker_pool.terminate()
-            if t_split is not None:
-                t_split.join()
-            shutil.rmtree(split_tmpdir)
+            if t_chunks is not None:
+                t_chunks.join()
             shutil.rmtree(pairs_tmpdir)
 
         if 'read_filter_stats' not in self.meta:
@@ -1453,6 +1972,11 @@ class ReadPairs(RegionPairsTable):
                                                         "output/sam/SRR4271982_chr18_19_2_sort.bam")
             rp.add_read_pairs(rp_generator, threads=4)
 
+        Read pairs from a :class:`~TxtReadPairGenerator` without read filters
+        are parsed and assigned to fragments in blocks (see
+        :func:`~TxtReadPairGenerator.read_pair_chunks`), in which case
+        batch_size and threads are ignored.
+
         :param read_pairs: iterator over tuples of read pairs. Typically
                            instances of :class:`~ReadPairGenerator`
         :param batch_size: Batch size of read pairs sent to fragment info workers
@@ -1465,27 +1989,13 @@ class ReadPairs(RegionPairsTable):
             self._pair_count = sum(edge_table._original_len()
                                    for _, edge_table in self._iter_edge_tables())
 
-        start_time = timer()
-        chunk_start_time = timer()
-        pairs_counter = 0
-        edge = {}
-        for fi1, fi2 in self._read_pairs_fragment_info(read_pairs, batch_size=batch_size, threads=threads):
-            source, sink = int(fi1[2]), int(fi2[2])
-            if source > sink:
-                source, sink = sink, source
-                fi1, fi2 = fi2, fi1
-
-            edge['ix'] = self._pair_count
-            edge['source'] = source
-            edge['sink'] = sink
-            edge['left_read_position'], edge['right_read_position'] = int(fi1[0]), int(fi2[0])
-            edge['left_read_strand'], edge['right_read_strand'] = fi1[1], fi2[1]
-            edge['left_fragment_start'], edge['right_fragment_start'] = int(fi1[4]), int(fi2[4])
-            edge['left_fragment_end'], edge['right_fragment_end'] = int(fi1[5]), int(fi2[5])
-            edge['left_fragment_chromosome'], edge['right_fragment_chromosome'] = int(fi1[3]), int(fi2[3])
-
-            self._edge_buffer.add_dict(edge)
-            self._pair_count += 1
+        if isinstance(read_pairs, TxtReadPairGenerator) and len(read_pairs.filters) == 0:
+            fragment_info = self._read_pair_chunks_fragment_info(read_pairs)
+        else:
+            fragment_info = self._read_pairs_fragment_info(read_pairs, batch_size=batch_size,
+                                                           threads=threads)
+        for records in fragment_info:
+            self._load_read_pairs_fragment_info_records(records)
 
         logger.info('Done saving read pairs.')
 
@@ -2106,6 +2616,75 @@ class FragmentReadPair(object):
         return "{} -- {}".format(left_repr, right_repr)
 
 
+def _alternative_nm(xa):
+    """
+    Return the lowest edit distance among the alternative
+    alignments listed in an XA tag, or inf if it lists none.
+    """
+    nm = np.inf
+    for alt in xa.split(';'):
+        if alt == '':
+            continue
+        _, _, _, nm_alt = alt.split(',')
+        nm = min(nm, int(nm_alt))
+    return nm
+
+
+def _read_tag_array(reads, tag, converter=None):
+    """
+    Extract the values of a numeric SAM tag from a list of reads.
+
+    Tag values are only retrieved for reads that have the tag.
+
+    :param reads: list of :class:`~pysam.AlignedSegment`
+    :param tag: Name of the tag, e.g. "AS"
+    :param converter: Optional function that converts a tag value to a number
+    :return: float array, NaN for reads without the tag
+    """
+    values = np.full(len(reads), np.nan)
+    has_tag = np.array([read.has_tag(tag) for read in reads], dtype=bool)
+    ixs = np.flatnonzero(has_tag)
+    if len(ixs) > 0:
+        if converter is None:
+            values[ixs] = [reads[ix].get_tag(tag) for ix in ixs.tolist()]
+        else:
+            values[ixs] = [converter(reads[ix].get_tag(tag)) for ix in ixs.tolist()]
+    return values
+
+
+def _read_arrays(reads, fields):
+    """
+    Extract fields from a list of reads into numpy arrays.
+
+    Supported fields are "mapq", "flag", "alen" (0 if the read has
+    no alignment length), "qname", the tags "AS", "XS" and "NM"
+    (NaN if missing), and "XA", which holds the lowest edit distance
+    of the alternative alignments in the XA tag (see
+    :func:`~_alternative_nm`).
+
+    :param reads: list of :class:`~pysam.AlignedSegment` or compatible
+    :param fields: iterable of field names
+    :return: dict of field name: numpy array
+    """
+    arrays = dict()
+    for field in fields:
+        if field == 'mapq':
+            arrays[field] = np.array([read.mapq for read in reads], dtype=np.int64)
+        elif field == 'flag':
+            arrays[field] = np.array([read.flag for read in reads], dtype=np.int64)
+        elif field == 'alen':
+            arrays[field] = np.array([read.alen or 0 for read in reads], dtype=np.int64)
+        elif field == 'qname':
+            arrays[field] = np.array([read.qname for read in reads], dtype=str)
+        elif field in ('AS', 'XS', 'NM'):
+            arrays[field] = _read_tag_array(reads, field)
+        elif field == 'XA':
+            arrays[field] = _read_tag_array(reads, field, converter=_alternative_nm)
+        else:
+            raise ValueError("Cannot extract read field '{}'".format(field))
+    return arrays
+
+
 class ReadFilter(object):
     """
     Abstract class that provides filtering functionality for
@@ -2120,8 +2699,20 @@ class ReadFilter(object):
 
     Pass a custom filter to the filter method in
     :class:`~ReadPairGenerator` to apply it.
+
+    Filters can additionally implement valid_chunk(self, arrays),
+    which receives a dictionary of numpy arrays with one entry per
+    read for each of the fields listed in
+    :attr:`~ReadFilter.chunk_fields`, and returns a boolean
+    array. :class:`~ReadPairGenerator` then evaluates the filter
+    on batches of reads instead of calling valid_read on every
+    read.
     """
 
+    #: Read fields required by :func:`~ReadFilter.valid_chunk`,
+    #: see :func:`~_read_arrays` for supported fields
+    chunk_fields = ()
+
     def __init__(self, mask=None):
         """
         Initialize ReadFilter.
@@ -2156,11 +2747,28 @@ class ReadFilter(object):
         """
         raise NotImplementedError("ReadFilters must implement valid_read function")
 
+    def valid_chunk(self, arrays):
+        """
+        Determine the validity of a batch of reads in vectorised form.
+
+        :param arrays: dict of numpy arrays, one entry for each
+                       field in :attr:`~ReadFilter.chunk_fields`
+        :return: boolean array, True for valid reads
+        """
+        raise NotImplementedError("ReadFilter does not implement valid_chunk")
+
+    def has_valid_chunk(self):
+        """
+        Check if this filter implements :func:`~ReadFilter.valid_chunk`.
+        """
+        return type(self).valid_chunk is not ReadFilter.valid_chunk
+
 
 class QualityFilter(ReadFilter):
     """
     Filter mapped reads based on mapping quality.
     """
+    chunk_fields = ('mapq',)
 
     def __init__(self, cutoff=30, mask=None):
         """
@@ -2178,6 +2786,9 @@ class QualityFilter(ReadFilter):
         """
         return read.mapq >= self.cutoff
 
+    def valid_chunk(self, arrays):
+        return arrays['mapq'] >= self.cutoff
+
     def __reduce__(self):
         return QualityFilter, (self.cutoff, self.mask)
 
@@ -2186,6 +2797,7 @@ class ContaminantFilter(ReadFilter):
     """
     Filter reads that also map to a contaminant genome.
     """
+    chunk_fields = ('qname',)
 
     def __init__(self, contaminant_reads, mask=None):
         """
@@ -2201,6 +2813,7 @@ class ContaminantFilter(ReadFilter):
         with pysam.AlignmentFile(contaminant_reads) as contaminant:
             for read in contaminant:
                 self.contaminant_names.add(read.qname)
+        self._contaminant_names_array = np.array(sorted(self.contaminant_names), dtype=str)
 
     def valid_read(self, read):
         """
@@ -2210,6 +2823,9 @@ class ContaminantFilter(ReadFilter):
             return False
         return True
 
+    def valid_chunk(self, arrays):
+        return ~np.isin(arrays['qname'], self._contaminant_names_array)
+
     def __reduce__(self):
         return ContaminantFilter, (self.contaminant_reads, self.mask)
 
@@ -2220,6 +2836,8 @@ class BwaMemQualityFilter(ReadFilter):
     based on the alignment score (normalized by
     the length of the alignment).
     """
+    chunk_fields = ('AS', 'alen')
+
     def __init__(self, cutoff=0.90, mask=None):
         """
         :param cutoff: Ratio of the alignment score to the maximum score
@@ -2238,6 +2856,11 @@ class BwaMemQualityFilter(ReadFilter):
             return float(read.get_tag('AS')) / read.alen >= self.cutoff
         return False
 
+    def valid_chunk(self, arrays):
+        alen = arrays['alen']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.logical_and(alen > 0, arrays['AS'] / alen >= self.cutoff)
+
     def __reduce__(self):
         return BwaMemQualityFilter, (self.cutoff, self.mask)
 
@@ -2246,6 +2869,7 @@ class UniquenessFilter(ReadFilter):
     """
     Filter reads that do not map uniquely to the reference sequence.
     """
+    chunk_fields = ('AS', 'XS')
 
     def __init__(self, strict=True, mask=None):
         """
@@ -2278,6 +2902,12 @@ class UniquenessFilter(ReadFilter):
             pass
         return True
 
+    def valid_chunk(self, arrays):
+        if self.strict:
+            return np.isnan(arrays['XS'])
+        # comparisons with missing (NaN) tags are False
+        return ~(arrays['AS'] <= arrays['XS'])
+
     def __reduce__(self):
         return UniquenessFilter, (self.strict, self.mask)
 
@@ -2287,6 +2917,8 @@ class BwaMemUniquenessFilter(ReadFilter):
     Filters `bwa mem` generated alignments based on whether they are unique or not.
 
     """
+    chunk_fields = ('XA', 'NM')
+
     def __init__(self, strict=False, mask=None):
         """
         :param strict: If True, valid_read checks only for the
@@ -2320,6 +2952,13 @@ class BwaMemUniquenessFilter(ReadFilter):
             pass
         return True
 
+    def valid_chunk(self, arrays):
+        no_alternative = np.isnan(arrays['XA'])
+        if self.strict:
+            return no_alternative
+        # comparisons with missing (NaN) NM tags are False
+        return np.logical_or(no_alternative, arrays['XA'] > arrays['NM'])
+
     def __reduce__(self):
         return BwaMemUniquenessFilter, (self.strict, self.mask)
 
@@ -2328,6 +2967,8 @@ class UnmappedFilter(ReadFilter):
     """
     Filter reads that do not map to the reference sequence.
     """
+    chunk_fields = ('flag',)
+
     def __init__(self, mask=None):
         """
         :param mask: Optional Mask object describing the mask
@@ -2343,6 +2984,9 @@ class UnmappedFilter(ReadFilter):
             return False
         return True
 
+    def valid_chunk(self, arrays):
+        return arrays['flag'] & 4 == 0
+
     def __reduce__(self):
         return UnmappedFilter, (self.mask,)
 
@@ -2388,6 +3032,26 @@ class FragmentReadPairFilter(with_metaclass(ABCMeta, MaskFilter)):
         pair = self.pairs._pair_from_row(row, lazy_pair=self._lazy_pair)
         return self.valid_pair(pair)
 
+    @staticmethod
+    def _same_chromosome_chunk(arrays):
+        return arrays['left_fragment_chromosome'] == arrays['right_fragment_chromosome']
+
+    @staticmethod
+    def _same_fragment_chunk(arrays):
+        return np.logical_and(FragmentReadPairFilter._same_chromosome_chunk(arrays),
+                              arrays['left_fragment_start'] == arrays['right_fragment_start'])
+
+    @staticmethod
+    def _gap_size_chunk(arrays):
+        """
+        Vectorised :func:`~FragmentReadPair.get_gap_size`. Gap sizes of
+        inter-chromosomal pairs are undefined and must be masked by the caller.
+        """
+        gap = arrays['right_fragment_start'] - arrays['left_fragment_end']
+        gap[gap == 1] = 0
+        gap[FragmentReadPairFilter._same_fragment_chunk(arrays)] = 0
+        return gap
+
 
 class InwardPairsFilter(FragmentReadPairFilter):
     """
@@ -2415,15 +3079,37 @@ class InwardPairsFilter(FragmentReadPairFilter):
             return False
         return True
 
+    def valid_chunk(self, arrays):
+        is_inward = np.logical_and.reduce([self._same_chromosome_chunk(arrays),
+                                           arrays['left_read_strand'] == 1,
+                                           arrays['right_read_strand'] == -1])
+        return np.logical_not(np.logical_and(is_inward,
+                                             self._gap_size_chunk(arrays) <= self.minimum_distance))
+
 
 class PCRDuplicateFilter(FragmentReadPairFilter):
     """
     Masks alignments that are suspected to be PCR duplicates.
-    In order to be considered duplicates, two pairs need to have identical
-    start positions of their respective left alignments AND of their right alignments.
+    In order to be considered duplicates, two pairs need to map to the same
+    chromosomes and strands, and have identical start positions of their
+    respective left alignments AND of their right alignments.
+
+    Pairs from all partitions are sorted together by chromosomes, strands,
+    and positions, and a pair is a duplicate if both of its positions are
+    within :code:`threshold` of the previous pair in this order. If there
+    are more than :code:`chunk_size` pairs, sorting is done externally, in
+    buckets of left read positions that are written to temporary files.
     """
 
-    def __init__(self, pairs, threshold=2, mask=None):
+    _duplicate_dtype = np.dtype([('ix', np.int64),
+                                 ('left_fragment_chromosome', np.int32),
+                                 ('right_fragment_chromosome', np.int32),
+                                 ('left_read_strand', np.int8),
+                                 ('right_read_strand', np.int8),
+                                 ('left_read_position', np.int64),
+                                 ('right_read_position', np.int64)])
+
+    def __init__(self, pairs, threshold=2, mask=None, chunk_size=10000000, tmpdir=None):
         """
         Initialize filter with filter settings.
 
@@ -2433,67 +3119,188 @@ class PCRDuplicateFilter(FragmentReadPairFilter):
                           the alignments are considered to be starting at the same position
         :param mask: Optional Mask object describing the mask
                      that is applied to filtered reads.
+        :param chunk_size: Approximate maximum number of pairs held in memory at once
+        :param tmpdir: Directory for temporary files used by the external sort
         """
         FragmentReadPairFilter.__init__(self, mask=mask)
         self.threshold = threshold
         self.pairs = pairs
-        self.duplicates_set = set()
+        self.chunk_size = chunk_size
         self.duplicate_stats = defaultdict(int)
-        original_len = 0
-        for _, edge_table in self.pairs._iter_edge_tables():
-            original_len += edge_table._original_len()
-            self._mark_duplicates(edge_table)
 
-        n_dups = len(self.duplicates_set)
-        percent_dups = 1. * n_dups / original_len
+        edge_tables = [edge_table for _, edge_table in self.pairs._iter_edge_tables()]
+        original_len = sum(edge_table._original_len() for edge_table in edge_tables)
+
+        duplicates = [np.zeros(0, dtype=np.int64)]
+        carry = None
+        for rows in self._sorted_buckets(edge_tables, original_len, tmpdir=tmpdir):
+            bucket_duplicates, carry = self._mark_duplicates(rows, carry)
+            duplicates.append(bucket_duplicates)
+        if carry is not None:
+            self._add_duplicate_stats(carry[1])
+        self.duplicates = np.sort(np.concatenate(duplicates))
+
+        n_dups = len(self.duplicates)
+        percent_dups = 1. * n_dups / original_len if original_len > 0 else 0.
         logger.info("PCR duplicate stats: " +
                     "{} ({:.1%}) of pairs marked as duplicate. ".format(n_dups, percent_dups) +
                     " (multiplicity:occurances) " +
-                    " ".join("{}:{}".format(k, v) for k, v in self.duplicate_stats.items()))
-
-    def _mark_duplicates(self, edge_table):
-        pairs = [
-            (
-                row['ix'],
-                row['left_fragment_chromosome'], row['right_fragment_chromosome'],
-                row['left_read_position'], row['right_read_position']
-             ) for row in edge_table._iter_visible_and_masked()
-        ]
-        pairs = sorted(pairs, key=lambda p: p[3])
-
-        current_positions = {}
-        current_duplicates = {}
-        for ix, left_chromosome, right_chromosome, left_position, right_position in pairs:
-            chromosomes = (left_chromosome, right_chromosome)
-
-            # case 1: no current duplicates
-            if current_positions.get(chromosomes) is None:
-                current_positions[chromosomes] = (left_position, right_position)
-                current_duplicates[chromosomes] = 1
-                continue
-
-            # case 2: found duplicate
-            if (abs(left_position - current_positions[chromosomes][0]) <= self.threshold and
-                    abs(right_position - current_positions[chromosomes][1]) <= self.threshold):
-                self.duplicates_set.add(ix)
-                current_duplicates[chromosomes] += 1
-                continue
-
-            # update statistics
-            if current_duplicates[chromosomes] > 1:
-                self.duplicate_stats[current_duplicates[chromosomes]] += 1
-
-            current_positions[chromosomes] = (left_position, right_position)
-            current_duplicates[chromosomes] = 1
+                    " ".join("{}:{}".format(k, v) for k, v in sorted(self.duplicate_stats.items())))
+
+    def _table_chunks(self, edge_table):
+        """
+        Iterate over all (also masked) rows of an edge table in chunks
+        of duplicate-relevant fields.
+        """
+        n_rows = edge_table._original_len()
+        for start in range(0, n_rows, self.chunk_size):
+            rows = edge_table.read(start=start, stop=min(start + self.chunk_size, n_rows))
+            chunk = np.empty(len(rows), dtype=self._duplicate_dtype)
+            for field in self._duplicate_dtype.names:
+                chunk[field] = rows[field]
+            yield chunk
+
+    def _sorted_buckets(self, edge_tables, n_rows, tmpdir=None):
+        """
+        Iterate over buckets of pairs, so that each chromosome pair is
+        contained in consecutive buckets, in order of left read position.
+
+        If all pairs fit into a single chunk, there is only one bucket.
+        Otherwise, pairs are split into buckets of left read position windows
+        of about :code:`chunk_size` pairs (assuming uniformly distributed
+        positions), and written to temporary files.
+        """
+        if n_rows <= self.chunk_size:
+            chunks = [chunk for edge_table in edge_tables
+                      for chunk in self._table_chunks(edge_table)]
+            if len(chunks) > 0:
+                yield np.concatenate(chunks)
+            return
+
+        def chromosome_pair_keys(chunk):
+            return ((chunk['left_fragment_chromosome'].astype(np.int64) << 32) +
+                    chunk['right_fragment_chromosome'].astype(np.int64))
+
+        # count pairs and maximum positions per chromosome pair
+        counts = defaultdict(int)
+        max_positions = defaultdict(int)
+        for edge_table in edge_tables:
+            for chunk in self._table_chunks(edge_table):
+                chunk_keys, inverse = np.unique(chromosome_pair_keys(chunk), return_inverse=True)
+                chunk_counts = np.bincount(inverse, minlength=len(chunk_keys))
+                chunk_max_positions = np.zeros(len(chunk_keys), dtype=np.int64)
+                np.maximum.at(chunk_max_positions, inverse, chunk['left_read_position'])
+                for key, count, max_position in zip(chunk_keys.tolist(), chunk_counts.tolist(),
+                                                    chunk_max_positions.tolist()):
+                    counts[key] += count
+                    max_positions[key] = max(max_positions[key], max_position)
+
+        keys = np.array(sorted(counts.keys()), dtype=np.int64)
+        n_buckets = np.array([int(np.ceil(counts[key] / self.chunk_size)) for key in keys])
+        windows = np.array([int(np.ceil((max_positions[key] + 1) / n)) for key, n in zip(keys, n_buckets)])
+        bucket_offsets = np.concatenate([[0], np.cumsum(n_buckets)[:-1]])
+
+        bucket_tmpdir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            for edge_table in edge_tables:
+                for chunk in self._table_chunks(edge_table):
+                    key_ixs = np.searchsorted(keys, chromosome_pair_keys(chunk))
+                    buckets = bucket_offsets[key_ixs] + np.minimum(chunk['left_read_position'] // windows[key_ixs],
+                                                                   n_buckets[key_ixs] - 1)
+                    order = np.argsort(buckets, kind='stable')
+                    chunk, buckets = chunk[order], buckets[order]
+                    bucket_ids, bucket_starts = np.unique(buckets, return_index=True)
+                    bucket_ends = np.concatenate([bucket_starts[1:], [len(buckets)]])
+                    for bucket, start, end in zip(bucket_ids, bucket_starts, bucket_ends):
+                        with open(os.path.join(bucket_tmpdir, 'bucket_{}'.format(bucket)), 'ab') as f:
+                            chunk[start:end].tofile(f)
+
+            for bucket in range(np.sum(n_buckets)):
+                bucket_file = os.path.join(bucket_tmpdir, 'bucket_{}'.format(bucket))
+                if os.path.exists(bucket_file):
+                    yield np.fromfile(bucket_file, dtype=self._duplicate_dtype)
+                    os.remove(bucket_file)
+        finally:
+            shutil.rmtree(bucket_tmpdir)
+
+    def _add_duplicate_stats(self, multiplicities):
+        values, counts = np.unique(multiplicities[multiplicities > 1], return_counts=True)
+        for value, count in zip(values, counts):
+            self.duplicate_stats[int(value)] += int(count)
+
+    def _mark_duplicates(self, rows, carry=None):
+        """
+        Find duplicates in a bucket of pairs.
+
+        :param rows: structured array of pairs
+        :param carry: tuple (last pairs, multiplicities) of each chromosome/strand
+                      group in previous buckets, so that duplicates across bucket
+                      boundaries are detected
+        :return: tuple (array of duplicate ix, carry for the next bucket)
+        """
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), carry
+
+        multiplicities = np.ones(len(rows), dtype=np.int64)
+        n_carry = 0
+        if carry is not None:
+            n_carry = len(carry[0])
+            rows = np.concatenate([carry[0], rows])
+            multiplicities = np.concatenate([carry[1], multiplicities])
+
+        order = np.lexsort((rows['right_read_position'], rows['left_read_position'],
+                            rows['right_read_strand'], rows['left_read_strand'],
+                            rows['right_fragment_chromosome'], rows['left_fragment_chromosome']))
+        rows, multiplicities = rows[order], multiplicities[order]
+        is_carry = order < n_carry
+
+        same_group = np.ones(len(rows) - 1, dtype=bool)
+        for field in ('left_fragment_chromosome', 'right_fragment_chromosome',
+                      'left_read_strand', 'right_read_strand'):
+            same_group &= rows[field][1:] == rows[field][:-1]
+
+        is_duplicate = np.zeros(len(rows), dtype=bool)
+        is_duplicate[1:] = np.logical_and.reduce([
+            same_group,
+            np.abs(np.diff(rows['left_read_position'])) <= self.threshold,
+            np.abs(np.diff(rows['right_read_position'])) <= self.threshold,
+        ])
+        is_duplicate[is_carry] = False
+
+        # multiplicity of each duplicate cluster (original and its duplicates)
+        cluster_ixs = np.cumsum(~is_duplicate) - 1
+        cluster_sizes = np.bincount(cluster_ixs, weights=multiplicities).astype(np.int64)
+
+        # clusters at the end of each group can continue in the next bucket
+        is_last = np.ones(len(rows), dtype=bool)
+        is_last[:-1] = ~same_group
+        open_clusters = cluster_ixs[is_last]
+        is_closed = np.ones(len(cluster_sizes), dtype=bool)
+        is_closed[open_clusters] = False
+        self._add_duplicate_stats(cluster_sizes[is_closed])
+
+        # only the last chromosome pair can continue in the next bucket
+        carry_rows, carry_multiplicities = rows[is_last], cluster_sizes[open_clusters]
+        is_current = np.logical_and(
+            carry_rows['left_fragment_chromosome'] == rows['left_fragment_chromosome'][-1],
+            carry_rows['right_fragment_chromosome'] == rows['right_fragment_chromosome'][-1])
+        self._add_duplicate_stats(carry_multiplicities[~is_current])
+
+        return (rows['ix'][is_duplicate],
+                (carry_rows[is_current], carry_multiplicities[is_current]))
 
     def valid_pair(self, pair):
         """
         Check if a pair is duplicated.
         """
-        if pair.ix in self.duplicates_set:
+        i = np.searchsorted(self.duplicates, pair.ix)
+        if i < len(self.duplicates) and self.duplicates[i] == pair.ix:
             return False
         return True
 
+    def valid_chunk(self, arrays):
+        return ~np.isin(arrays['ix'], self.duplicates)
+
 
 class OutwardPairsFilter(FragmentReadPairFilter):
     """
@@ -2521,6 +3328,13 @@ class OutwardPairsFilter(FragmentReadPairFilter):
             return True
         return False
 
+    def valid_chunk(self, arrays):
+        is_outward = np.logical_and.reduce([self._same_chromosome_chunk(arrays),
+                                            arrays['left_read_strand'] == -1,
+                                            arrays['right_read_strand'] == 1])
+        return np.logical_or(np.logical_not(is_outward),
+                             self._gap_size_chunk(arrays) > self.minimum_distance)
+
 
 class ReDistanceFilter(FragmentReadPairFilter):
     """
@@ -2546,6 +3360,13 @@ class ReDistanceFilter(FragmentReadPairFilter):
 
         return True
 
+    def valid_chunk(self, arrays):
+        d1 = np.minimum(np.abs(arrays['left_read_position'] - arrays['left_fragment_start']),
+                        np.abs(arrays['left_read_position'] - arrays['left_fragment_end']))
+        d2 = np.minimum(np.abs(arrays['right_read_position'] - arrays['right_fragment_start']),
+                        np.abs(arrays['right_read_position'] - arrays['right_fragment_end']))
+        return d1 + d2 <= self.maximum_distance
+
 
 class SelfLigationFilter(FragmentReadPairFilter):
     """
@@ -2563,3 +3384,6 @@ class SelfLigationFilter(FragmentReadPairFilter):
         if pair.is_same_fragment():
             return False
         return True
+
+    def valid_chunk(self, arrays):
+        return np.logical_not(self._same_fragment_chunk(arrays))
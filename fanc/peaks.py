@@ -11,6 +11,7 @@ from .general import MaskFilter
 import msgpack
 import msgpack_numpy
 import math
+import multiprocessing
 import pandas as pd
 from .tools.general import RareUpdateProgressBar, pairwise
 import warnings
@@ -893,7 +894,8 @@ class RaoPeakCaller(object):
 
     def __init__(self, p=None, w_init=None, min_locus_dist=None, max_w=20, min_ll_reads=16,
                  process_inter=False, correct_inter='fdr', n_processes=4,
-                 slice_size=200, min_mappable_fraction=0.7, cluster=False):
+                 slice_size=200, min_mappable_fraction=0.7, cluster=False,
+                 backend='vectorised'):
         """
         Initialize RaoPeakCaller with peak calling parameters.
 
@@ -911,6 +913,11 @@ class RaoPeakCaller(object):
         :param slice_size: length of the matrix square investigated by each process.
         :param cluster: If True, attempts to call peaks using an SGE cluster. If False,
                         will use multiprocessing.
+        :param backend: Method used to compute neighborhood sums in each matrix
+                        segment. 'vectorised' (default) computes the sums for all
+                        pixels of a segment at once from summed-area tables,
+                        'pixel' evaluates each pixel separately using the
+                        static neighborhood methods of this class.
         """
         self.p = p
         self.w_init = w_init
@@ -932,6 +939,11 @@ class RaoPeakCaller(object):
                 logger.warning("Cannot use the cluster because of previous error.")
                 self.cluster = False
 
+        if backend not in _segment_backends:
+            raise ValueError("Backend '{}' not recognised, must be one of {}".format(
+                backend, ", ".join(sorted(_segment_backends.keys()))))
+        self.backend = backend
+
         super(RaoPeakCaller, self).__init__()
 
     # sum of reads in lower-left neighborhood
@@ -1039,21 +1051,41 @@ class RaoPeakCaller(object):
             return None
         return max(0, int(v) + 1)
 
-    def _process_jobs(self, jobs, peaks, observed_chunk_distribution):
+    def _process_jobs(self, jobs, peaks, observed_chunk_distribution, pool=None):
         """
         Process the output from :func:`~process_matrix_range` and save in peak table.
-        """
-        # if the grid does not work for some reason, this will fall back on
-        # multiprocessing itself
-        logger.debug("Getting gridmap output...")
 
-        job_kwargs = {}
-        if config.gridmap_tmpdir is not None:
-            job_kwargs['temp_dir'] = config.gridmap_tmpdir
-        job_outputs = gridmap.process_jobs(jobs, max_processes=self.n_processes,
-                                           local=not self.cluster, **job_kwargs)
-        logger.debug("Got gridmap output.")
+        :param jobs: list of serialised segment arguments
+        :param pool: optional :class:`~multiprocessing.Pool` used to process
+                     jobs locally if gridmap is not available
+        """
+        segment_function = _segment_backends[self.backend]
+
+        if has_gridmap:
+            # if the grid does not work for some reason, this will fall back on
+            # multiprocessing itself
+            logger.debug("Getting gridmap output...")
+
+            job_kwargs = {}
+            if config.gridmap_tmpdir is not None:
+                job_kwargs['temp_dir'] = config.gridmap_tmpdir
+            job_outputs = gridmap.process_jobs([gridmap.Job(segment_function, [args]) for args in jobs],
+                                               max_processes=self.n_processes,
+                                               local=not self.cluster, **job_kwargs)
+            logger.debug("Got gridmap output.")
+        elif pool is not None:
+            job_outputs = pool.map(segment_function, jobs)
+        else:
+            job_outputs = [segment_function(args) for args in jobs]
+
+        self._process_job_outputs(job_outputs, peaks, observed_chunk_distribution)
 
+    @staticmethod
+    def _process_job_outputs(job_outputs, peaks, observed_chunk_distribution):
+        """
+        Save the (compressed) segment results in peak table and update
+        the observed chunk distribution.
+        """
         for compressed_results in job_outputs:
             results = msgpack.loads(compressed_results)
             for result in results:
@@ -1143,34 +1175,71 @@ class RaoPeakCaller(object):
                 ms = m[i_start:i_end, j_start:j_end]
                 yield ms, i_range, i_inspect, j_range, j_inspect
 
+    @staticmethod
+    def segment_hic_intra(hic, chromosome, chunk_size, w_max):
+        """
+        Same as :func:`~RaoPeakCaller.segment_matrix_intra`, but only
+        loads the matrix segments from the Hi-C object on demand instead
+        of assembling the whole chromosome matrix in memory.
+        """
+        start, end = hic.chromosome_bins[chromosome]
+        n = end - start
+        for i in range(0, n, chunk_size):
+            i_start = max(0, i - w_max)
+            i_end = min(i + chunk_size + w_max, n)
+            i_range = (i_start, i_end)
+            i_inspect = (i, min(i + chunk_size, n))
+            for j in range(i, n, chunk_size):
+                j_start = max(0, j - w_max)
+                j_end = min(j + chunk_size + w_max, n)
+                j_range = (j_start, j_end)
+                j_inspect = (j, min(j + chunk_size, n))
+                ms = hic.matrix((slice(start + i_start, start + i_end),
+                                 slice(start + j_start, start + j_end)))
+                yield ms, i_range, i_inspect, j_range, j_inspect
+
     def _find_peaks_intra_matrix(self, m, e, c, peak_info, mappable, ix_offset,
                                  observed_chunk_distribution, w, p):
         """
         Given a matrix (strictly intra-chromosomal), calculate peak
         information for all pixels.
-        """
-
-        jobs = []
-        for segment in RaoPeakCaller.segment_matrix_intra(m, self.slice_size, self.max_w):
-            ms, i_range, i_inspect, j_range, j_inspect = segment
 
-            args = [ms, e, ix_offset,
-                    i_range, i_inspect, mappable[i_range[0]:i_range[1]], c[i_range[0]:i_range[1]],
-                    j_range, j_inspect, mappable[j_range[0]:j_range[1]], c[j_range[0]:j_range[1]],
-                    w, p, self.min_locus_dist, self.min_ll_reads, self.min_mappable_fraction,
-                    self.max_w]
-
-            args = msgpack.dumps(args)
-            job = gridmap.Job(process_matrix_segment_intra, [args])
-            jobs.append(job)
+        :param m: Intra-chromosomal matrix or iterable of matrix segments
+                  as returned by :func:`~RaoPeakCaller.segment_matrix_intra`
+        """
+        if isinstance(m, np.ndarray):
+            segments = RaoPeakCaller.segment_matrix_intra(m, self.slice_size, self.max_w)
+        else:
+            segments = m
 
-            # submit intermediate segments if maximum number of jobs reached
-            if len(jobs) >= self.n_processes:
-                self._process_jobs(jobs, peak_info, observed_chunk_distribution)
-                jobs = []
+        pool = None
+        if not has_gridmap and self.n_processes > 1:
+            pool = multiprocessing.Pool(self.n_processes)
 
-        if len(jobs) > 0:
-            self._process_jobs(jobs, peak_info, observed_chunk_distribution)
+        try:
+            jobs = []
+            for segment in segments:
+                ms, i_range, i_inspect, j_range, j_inspect = segment
+
+                args = [np.asarray(ms), e, ix_offset,
+                        i_range, i_inspect, mappable[i_range[0]:i_range[1]], c[i_range[0]:i_range[1]],
+                        j_range, j_inspect, mappable[j_range[0]:j_range[1]], c[j_range[0]:j_range[1]],
+                        w, p, self.min_locus_dist, self.min_ll_reads, self.min_mappable_fraction,
+                        self.max_w]
+
+                jobs.append(msgpack.dumps(args))
+
+                # submit intermediate segments if maximum number of jobs reached
+                if len(jobs) >= self.n_processes:
+                    self._process_jobs(jobs, peak_info, observed_chunk_distribution, pool=pool)
+                    jobs = []
+
+            if len(jobs) > 0:
+                self._process_jobs(jobs, peak_info, observed_chunk_distribution, pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
     def call_peaks(self, hic, chromosome_pairs=None, file_name=None, intra_expected=None, inter_expected=None):
         """
@@ -1268,8 +1337,8 @@ class RaoPeakCaller(object):
             ix_offset = start1
             start2, end2 = chromosome_bins[chromosome2]
             if chromosome1 == chromosome2:
-                m = hic.matrix((chromosome1, chromosome2))
-                self._find_peaks_intra_matrix(m, intra_expected[chromosome1], c[start1:end1],
+                segments = RaoPeakCaller.segment_hic_intra(hic, chromosome1, self.slice_size, self.max_w)
+                self._find_peaks_intra_matrix(segments, intra_expected[chromosome1], c[start1:end1],
                                               peaks, mappable[start1:end1], ix_offset,
                                               observed_chunk_distribution, w_init, p)
             elif self.process_inter:
@@ -1361,9 +1430,8 @@ def process_matrix_segment_intra(data):
     row_ixs = np.arange(i_range[0], i_range[1])
     col_ixs = np.arange(j_range[0], j_range[1])
     m_uncorrected = np.rint(m_original/c_i[:, None]/c_j)
-    m_distance = np.array([abs(col_ixs - i) for i in row_ixs])
-    expected_f = np.vectorize(lambda x: e[x])
-    m_expected = expected_f(m_distance)
+    m_distance = np.abs(col_ixs[None, :] - row_ixs[:, None])
+    m_expected = np.asarray(e)[m_distance]
 
     # mask above matrices by mappability
     mask = np.zeros(m_original.shape, dtype=bool)
@@ -1442,6 +1510,219 @@ def process_matrix_segment_intra(data):
     return msgpack.dumps(results)
 
 
+def _summed_area_table(m):
+    """
+    Summed-area table of a 2D array, padded with a leading row and
+    column of zeros.
+    """
+    sat = np.zeros((m.shape[0] + 1, m.shape[1] + 1))
+    np.cumsum(np.cumsum(m, axis=0), axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def _box_sums(sat, r0, r1, c0, c1):
+    """
+    Sums of m[r0:r1, c0:c1] for arrays of box boundaries, obtained
+    from the summed-area table of m. Boundaries are clipped to the
+    matrix dimensions in the same way as slices.
+    """
+    n_rows, n_cols = sat.shape[0] - 1, sat.shape[1] - 1
+    r0 = np.clip(r0, 0, n_rows)
+    r1 = np.maximum(np.clip(r1, 0, n_rows), r0)
+    c0 = np.clip(c0, 0, n_cols)
+    c1 = np.maximum(np.clip(c1, 0, n_cols), c0)
+    return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+
+
+def _neighborhood_boxes(neighborhood, i, j, w, p):
+    """
+    Boxes (row start, row end, column start, column end) of a pixel
+    neighborhood, as used in :func:`~RaoPeakCaller.e_ll_sum`,
+    :func:`~RaoPeakCaller.e_h_sum`, :func:`~RaoPeakCaller.e_v_sum`, and
+    :func:`~RaoPeakCaller.e_d_sum`. The first box is added to the
+    neighborhood sum, all other boxes are subtracted.
+    """
+    if neighborhood == 'll':
+        return [(i + 1, i + w + 1, j - w, j),
+                (i + 1, i + p + 1, j - p, j)]
+    if neighborhood == 'h':
+        return [(i - 1, i + 2, j - w, j + w + 1),
+                (i - 1, i + 2, j - p, j + p + 1)]
+    if neighborhood == 'v':
+        return [(i - w, i + w + 1, j - 1, j + 2),
+                (i - p, i + p + 1, j - 1, j + 2)]
+    if neighborhood == 'd':
+        return [(i - w, i + w + 1, j - w, j + w + 1),
+                (i - p, i + p + 1, j - p, j + p + 1),
+                (i - w, i - p, j, j + 1),
+                (i + p + 1, i + w + 1, j, j + 1),
+                (i, i + 1, j - w, j - p),
+                (i, i + 1, j + p + 1, j + w + 1)]
+    raise ValueError("Unknown neighborhood type '{}'".format(neighborhood))
+
+
+def _neighborhood_sums(sat, neighborhood, i, j, w, p, count_sat=None):
+    """
+    Vectorised equivalent of the neighborhood sum methods of
+    :class:`~RaoPeakCaller` for arrays of pixel coordinates.
+
+    :param sat: Summed-area table of the matrix (masked entries set to 0)
+    :param neighborhood: One of 'll', 'h', 'v', or 'd'
+    :param count_sat: Summed-area table of unmasked entries. If provided,
+                      boxes without unmasked entries are treated like
+                      masked sums in :mod:`numpy.ma`
+    :return: tuple of neighborhood sums and boolean array indicating
+             masked sums
+    """
+    sums = np.zeros(len(i))
+    masked = np.zeros(len(i), dtype=bool)
+    for k, (r0, r1, c0, c1) in enumerate(_neighborhood_boxes(neighborhood, i, j, w, p)):
+        box_sums = _box_sums(sat, r0, r1, c0, c1)
+        if count_sat is not None:
+            box_masked = _box_sums(count_sat, r0, r1, c0, c1) == 0
+            if neighborhood == 'd':
+                # donut sums treat fully masked boxes as 0
+                box_sums[box_masked] = 0
+            else:
+                masked |= box_masked
+
+        if k == 0:
+            sums += box_sums
+        else:
+            sums -= box_sums
+    return sums, masked
+
+
+def _find_chunks(values, chunk_func=lambda x: 3*np.log2(x)):
+    """
+    Vectorised :func:`~RaoPeakCaller.find_chunk`. Values without a
+    matching chunk are assigned -1.
+    """
+    values = np.asarray(values, dtype=float)
+    chunks = np.full(values.shape, -1, dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v = chunk_func(np.where(values >= 1, values, 1))
+    chunks[values < 1] = 0
+    valid = np.logical_and(values >= 1, np.isfinite(v))
+    chunks[valid] = np.maximum(0, v[valid].astype(np.int64) + 1)
+    return chunks
+
+
+def process_matrix_segment_intra_vectorised(data):
+    """
+    Same as :func:`~process_matrix_segment_intra`, but computes the
+    neighborhood sums of all pixels in a segment at once using
+    summed-area tables.
+    """
+    m_original, e, ix_offset, \
+        i_range, i_inspect, mappable_i, c_i, \
+        j_range, j_inspect, mappable_j, c_j, \
+        w, p, min_locus_dist, min_ll_reads, min_mappable, \
+        max_w = msgpack.loads(data)
+
+    m_original = np.array(m_original)
+    c_i, c_j = np.asarray(c_i), np.asarray(c_j)
+    mappable_i, mappable_j = np.asarray(mappable_i, dtype=bool), np.asarray(mappable_j, dtype=bool)
+
+    # construct convenient matrices
+    row_ixs = np.arange(i_range[0], i_range[1])
+    col_ixs = np.arange(j_range[0], j_range[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m_uncorrected = np.rint(m_original/c_i[:, None]/c_j)
+    m_expected = np.asarray(e)[np.abs(col_ixs[None, :] - row_ixs[:, None])]
+
+    mask = np.logical_or(np.logical_not(mappable_i)[:, None], np.logical_not(mappable_j)[None, :])
+
+    sat_original = _summed_area_table(np.where(mask, 0, m_original))
+    sat_uncorrected = _summed_area_table(np.where(mask, 0, m_uncorrected))
+    sat_expected = _summed_area_table(np.where(mask, 0, m_expected))
+    sat_unmasked = _summed_area_table(np.logical_not(mask))
+    sat_mask = _summed_area_table(mask)
+    sat_ones = _summed_area_table(np.ones(mask.shape))
+
+    # pixels to inspect, in row-major order
+    i, j = np.meshgrid(np.arange(i_inspect[0], i_inspect[1]) - i_range[0],
+                       np.arange(j_inspect[0], j_inspect[1]) - j_range[0], indexing='ij')
+    i, j = i.ravel(), j.ravel()
+
+    # only inspect mappable pixels at a certain distance above the diagonal
+    valid = np.logical_and(j + j_range[0] - i - i_range[0] >= p + min_locus_dist,
+                           np.logical_not(mask[i, j]))
+    i, j = i[valid], j[valid]
+
+    # only inspect pixels if they have more than
+    # a minimum number of reads
+    w_corr = np.full(len(i), w, dtype=np.int64)
+    ll_sums = np.zeros(len(i))
+    if min_ll_reads > 0:
+        unresolved = np.ones(len(i), dtype=bool)
+        for w_current in range(w, max_w):
+            ixs = np.nonzero(unresolved)[0]
+            if len(ixs) == 0:
+                break
+            sums, masked = _neighborhood_sums(sat_uncorrected, 'll', i[ixs], j[ixs], w_current, p,
+                                              count_sat=sat_unmasked)
+            sums[masked] = 0
+            found = sums >= min_ll_reads
+            w_corr[ixs[found]] = w_current + 1
+            ll_sums[ixs[found]] = sums[found]
+            unresolved[ixs[found]] = False
+        valid = np.logical_not(unresolved)
+    else:
+        valid = np.full(len(i), w <= max_w)
+    i, j, w_corr, ll_sums = i[valid], j[valid], w_corr[valid], ll_sums[valid]
+
+    # calculate mappability and enrichment values
+    mappabilities = dict()
+    valid = np.ones(len(i), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for neighborhood in ('ll', 'v', 'h', 'd'):
+            masked_count, _ = _neighborhood_sums(sat_mask, neighborhood, i, j, w, p)
+            total_count, _ = _neighborhood_sums(sat_ones, neighborhood, i, j, w, p)
+            mappabilities[neighborhood] = 1 - masked_count / total_count
+            valid = np.logical_and(valid, np.logical_not(mappabilities[neighborhood] < min_mappable))
+    i, j, w_corr, ll_sums = i[valid], j[valid], w_corr[valid], ll_sums[valid]
+    for neighborhood in mappabilities.keys():
+        mappabilities[neighborhood] = mappabilities[neighborhood][valid]
+
+    enrichments = dict()
+    e_pixel = m_expected[i, j]
+    for neighborhood in ('ll', 'v', 'h', 'd'):
+        observed, observed_masked = _neighborhood_sums(sat_original, neighborhood, i, j, w_corr, p,
+                                                       count_sat=sat_unmasked)
+        expected, expected_masked = _neighborhood_sums(sat_expected, neighborhood, i, j, w_corr, p,
+                                                       count_sat=sat_unmasked)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            enrichment = observed / expected * e_pixel
+        enrichment[np.logical_or(observed_masked, expected_masked)] = np.nan
+        enrichments[neighborhood] = enrichment
+
+    # find chunks
+    cf = c_i[i] * c_j[j]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chunks = [_find_chunks(m_uncorrected[i, j])]
+        for neighborhood in ('ll', 'v', 'h', 'd'):
+            chunks.append(_find_chunks(enrichments[neighborhood] / cf))
+    chunks = [[None if chunk < 0 else chunk for chunk in cs.tolist()] for cs in chunks]
+
+    columns = [(i + i_range[0] + ix_offset).tolist(), (j + j_range[0] + ix_offset).tolist(),
+               m_original[i, j].astype(float).tolist(), w_corr.tolist(), [p] * len(i),
+               m_uncorrected[i, j].astype(np.int64).tolist(), ll_sums.astype(np.int64).tolist(),
+               enrichments['ll'].tolist(), enrichments['v'].tolist(),
+               enrichments['h'].tolist(), enrichments['d'].tolist()] + chunks + \
+              [mappabilities['ll'].tolist(), mappabilities['v'].tolist(),
+               mappabilities['h'].tolist(), mappabilities['d'].tolist()]
+
+    results = [list(result) for result in zip(*columns)]
+    return msgpack.dumps(results)
+
+
+_segment_backends = {
+    'pixel': process_matrix_segment_intra,
+    'vectorised': process_matrix_segment_intra_vectorised,
+}
+
+
 def overlap_peaks(peaks, max_distance=6000):
     """
     Calculate overlap between different peak calls.
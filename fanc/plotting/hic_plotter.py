@@ -18,23 +18,26 @@ import itertools as it
 import types
 import seaborn as sns
 from future.utils import with_metaclass, string_types
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from itertools import cycle
 from ..matrix import RegionMatrix
+from ..tools.general import str_to_int
 from ..peaks import ObservedPeakFilter, FdrPeakFilter, EnrichmentPeakFilter, MappabilityPeakFilter
 import logging
 logger = logging.getLogger(__name__)
 
 
-def prepare_hic_buffer(hic_data, buffering_strategy="relative", buffering_arg=1,
+def prepare_hic_buffer(hic_data, buffering_strategy="tiled", buffering_arg=1,
                        weight_field=None, default_value=None, smooth_sigma=None,
-                       norm=True, oe=False, log=False):
+                       norm=True, oe=False, log=False, **kwargs):
     """
     Prepare :class:`~BufferedMatrix` from hic data.
 
     :param hic_data: :class:`~fanc.data.genomic.RegionMatrixTable` or
                      :class:`~fanc.data.genomic.RegionMatrix`
-    :param buffering_strategy: "all", "fixed" or "relative"
+    :param buffering_strategy: "tiled", "all", "fixed" or "relative"
+                               "tiled" buffers fixed-size tiles of the matrix
+                                       with LRU eviction
                                "all" buffers the whole matrix
                                "fixed" buffers a fixed area, specified by buffering_arg
                                        around the query area
@@ -43,12 +46,13 @@ def prepare_hic_buffer(hic_data, buffering_strategy="relative", buffering_arg=1,
                                           the same amount upstream and downstream
                                           are buffered
     :param buffering_arg: Number specifying how much around the query area is buffered
+    :param kwargs: Additional keyword arguments passed to :class:`~BufferedMatrix`
     """
     if isinstance(hic_data, RegionMatrixContainer):
         return BufferedMatrix(hic_data, buffering_strategy=buffering_strategy,
                               buffering_arg=buffering_arg, weight_field=weight_field,
                               default_value=default_value, smooth_sigma=smooth_sigma,
-                              norm=norm, oe=oe, log=log)
+                              norm=norm, oe=oe, log=log, **kwargs)
     else:
         raise ValueError("Unknown type for hic_data")
 
@@ -63,17 +67,23 @@ class BufferedMatrix(object):
     _STRATEGY_ALL = "all"
     _STRATEGY_FIXED = "fixed"
     _STRATEGY_RELATIVE = "relative"
+    _STRATEGY_TILED = "tiled"
 
-    def __init__(self, data, buffering_strategy="relative", buffering_arg=1,
+    def __init__(self, data, buffering_strategy="tiled", buffering_arg=1,
                  weight_field=None, default_value=None, smooth_sigma=None,
-                 norm=True, oe=False, log=False):
+                 norm=True, oe=False, log=False, tile_size=256,
+                 tile_buffer_size=config.plot_buffer_size):
         """
         Initialize a buffer for Matrix-like objects that support
         indexing using class:`~GenomicRegion` objects, such as class:`~fanc.Hic`
         or class:`~fanc.RegionMatrix` objects.
 
         :param data: Data to be buffered
-        :param buffering_strategy: "all", "fixed" or "relative"
+        :param buffering_strategy: "tiled", "all", "fixed" or "relative"
+                                   "tiled" buffers square tiles of tile_size bins
+                                           and assembles the query area from them.
+                                           Least recently used tiles are discarded
+                                           once tile_buffer_size is exceeded
                                    "all" buffers the whole matrix
                                    "fixed" buffers a fixed area, specified by buffering_arg
                                            around the query area
@@ -82,6 +92,9 @@ class BufferedMatrix(object):
                                               the same amount upstream and downstream
                                               are buffered
         :param buffering_arg: Number specifying how much around the query area is buffered
+        :param tile_size: Width of buffered tiles in bins ("tiled" strategy only)
+        :param tile_buffer_size: Maximum memory used by buffered tiles, in bytes
+                                 or as string, e.g. "1G" ("tiled" strategy only)
         """
         self.data = data
         if buffering_strategy not in self._BUFFERING_STRATEGIES:
@@ -96,6 +109,10 @@ class BufferedMatrix(object):
         self.norm = norm
         self.oe = oe
         self.log = log
+        self.tile_size = tile_size
+        self.tile_buffer_size = str_to_int(tile_buffer_size)
+        self._tiles = OrderedDict()
+        self._tiles_bytes = 0
 
     @classmethod
     def from_hic_matrix(cls, hic_matrix, weight_field=None, default_value=None,
@@ -206,6 +223,82 @@ class BufferedMatrix(object):
                                                 default_value=self.default_value,
                                                 norm=self.norm, oe=self.oe, log=self.log)
 
+    def _tile(self, row_chromosome, col_chromosome, row_tile, col_tile):
+        """
+        Return the buffered matrix tile at the given tile coordinates,
+        loading it from the data if necessary.
+
+        :return: tuple (first row bin, first column bin, tile array)
+        """
+        key = (row_chromosome, col_chromosome, self.norm, self.oe, row_tile, col_tile)
+        try:
+            tile = self._tiles.pop(key)
+        except KeyError:
+            chromosome_bins = self.data.chromosome_bins
+            row_start, row_end = chromosome_bins[row_chromosome]
+            col_start, col_end = chromosome_bins[col_chromosome]
+            row_start += row_tile * self.tile_size
+            col_start += col_tile * self.tile_size
+            row_end = min(row_end, row_start + self.tile_size)
+            col_end = min(col_end, col_start + self.tile_size)
+
+            logger.debug("Buffering tile {}".format(key))
+            m = self.data.matrix(key=(slice(row_start, row_end), slice(col_start, col_end)),
+                                 score_field=self.weight_field,
+                                 default_value=self.default_value,
+                                 norm=self.norm, oe=self.oe, log=self.log)
+            tile = row_start, col_start, np.array(np.ma.getdata(m))
+            self._tiles_bytes += tile[2].nbytes
+
+        self._tiles[key] = tile
+        while self._tiles_bytes > self.tile_buffer_size and len(self._tiles) > 1:
+            _, (_, _, evicted) = self._tiles.popitem(last=False)
+            self._tiles_bytes -= evicted.nbytes
+        return tile
+
+    def _buffer_tiled(self, *regions):
+        """
+        Assemble the requested :class:`~GenomicRegion` from matrix tiles,
+        loading only those tiles that are not buffered yet.
+
+        :param regions: :class:`~GenomicRegion` objects
+        :return: :class:`~HicMatrix`
+        """
+        if len(regions) != 2:
+            return self._buffer_relative(*regions)
+
+        row_regions = list(self.data.regions(regions[0]))
+        col_regions = list(self.data.regions(regions[1]))
+        row_offset, col_offset = row_regions[0].ix, col_regions[0].ix
+        row_end, col_end = row_regions[-1].ix + 1, col_regions[-1].ix + 1
+
+        m = np.empty((row_end - row_offset, col_end - col_offset))
+        chromosome_bins = self.data.chromosome_bins
+        for row_chromosome, (row_chromosome_start, row_chromosome_end) in chromosome_bins.items():
+            if row_chromosome_end <= row_offset or row_chromosome_start >= row_end:
+                continue
+            row_tiles = range((max(row_offset, row_chromosome_start) - row_chromosome_start) // self.tile_size,
+                              (min(row_end, row_chromosome_end) - 1 - row_chromosome_start) // self.tile_size + 1)
+            for col_chromosome, (col_chromosome_start, col_chromosome_end) in chromosome_bins.items():
+                if col_chromosome_end <= col_offset or col_chromosome_start >= col_end:
+                    continue
+                col_tiles = range((max(col_offset, col_chromosome_start) - col_chromosome_start) // self.tile_size,
+                                  (min(col_end, col_chromosome_end) - 1 - col_chromosome_start) // self.tile_size + 1)
+
+                for row_tile in row_tiles:
+                    for col_tile in col_tiles:
+                        tile_row_start, tile_col_start, tile = self._tile(row_chromosome, col_chromosome,
+                                                                          row_tile, col_tile)
+                        r0 = max(row_offset, tile_row_start)
+                        r1 = min(row_end, tile_row_start + tile.shape[0])
+                        c0 = max(col_offset, tile_col_start)
+                        c1 = min(col_end, tile_col_start + tile.shape[1])
+                        m[r0 - row_offset:r1 - row_offset, c0 - col_offset:c1 - col_offset] = \
+                            tile[r0 - tile_row_start:r1 - tile_row_start, c0 - tile_col_start:c1 - tile_col_start]
+
+        self.buffered_region = list(regions)
+        self.buffered_matrix = RegionMatrix(m, row_regions=row_regions, col_regions=col_regions)
+
     @property
     def buffered_min(self):
         """
@@ -226,7 +319,8 @@ class BufferedMatrix(object):
 
     _BUFFERING_STRATEGIES = {_STRATEGY_ALL: _buffer_all,
                              _STRATEGY_RELATIVE: _buffer_relative,
-                             _STRATEGY_FIXED: _buffer_fixed}
+                             _STRATEGY_FIXED: _buffer_fixed,
+                             _STRATEGY_TILED: _buffer_tiled}
 
 
 class BufferedCombinedMatrix(BufferedMatrix):
@@ -236,6 +330,9 @@ class BufferedCombinedMatrix(BufferedMatrix):
     """
     def __init__(self, top_matrix, bottom_matrix, scale_matrices=True,
                  **kwargs):
+        # diagonal split depends on the query area, so cannot be assembled from tiles
+        if kwargs.get('buffering_strategy', None) in (None, self._STRATEGY_TILED):
+            kwargs['buffering_strategy'] = self._STRATEGY_RELATIVE
         super(BufferedCombinedMatrix, self).__init__(None, **kwargs)
 
         scaling_factor = top_matrix.scaling_factor(bottom_matrix) if scale_matrices else 1.
@@ -252,7 +349,7 @@ class BasePlotterHic(BasePlotterMatrix):
     Makes use of matrix buffering by :class:`~BufferedMatrix` internally.
     """
 
-    def __init__(self, hic_data, adjust_range=False, buffering_strategy="relative",
+    def __init__(self, hic_data, adjust_range=False, buffering_strategy="tiled",
                  buffering_arg=1, weight_field=None, default_value=None, smooth_sigma=None,
                  matrix_norm=True, oe=False, log=False, **kwargs):
         """
@@ -385,7 +482,7 @@ class HicSlicePlot(ScalarDataPlot):
 
     def __init__(self, hic_data, slice_region, names=None,
                  colors=None, fill=None,
-                 buffering_strategy="relative", buffering_arg=1,
+                 buffering_strategy="tiled", buffering_arg=1,
                  weight_field=None, default_value=None, **kwargs):
         """
         :param hic_data: :class:`~fanc.Hic` or :class:`~fanc.RegionMatrix`. Can be list of
@@ -646,10 +743,17 @@ class HicPeakPlot(BaseOverlayPlotter):
 
 
 class EdgeFilterBuffer(object):
-    def __init__(self, hic, plot_field='weight', default_value=0, log2=False):
+    def __init__(self, hic, plot_field='weight', default_value=0, log2=False,
+                 buffer_size=20):
+        """
+        :param buffer_size: Maximum number of region lists and edge lists
+                            kept in memory. Least recently used entries
+                            are discarded first.
+        """
         self.hic = hic
-        self._region_buffer = dict()
-        self._edge_buffer = dict()
+        self._buffer_size = buffer_size
+        self._region_buffer = OrderedDict()
+        self._edge_buffer = OrderedDict()
         self._filters = []
         self._plot_field = plot_field
         self._default_value = default_value
@@ -677,32 +781,36 @@ class EdgeFilterBuffer(object):
         """
         return float(np.nanmax(self._last_matrix)) if self._last_matrix is not None else None
 
+    def _buffered(self, buffer, key, load):
+        """
+        Get an entry from an LRU buffer, loading it with load() if necessary.
+        """
+        try:
+            value = buffer.pop(key)
+        except KeyError:
+            value = load()
+
+        buffer[key] = value
+        while len(buffer) > self._buffer_size:
+            buffer.popitem(last=False)
+        return value
+
     def get_matrix(self, *regions):
         row_region = regions[0]
         col_region = regions[1]
         row_key = (row_region.chromosome, row_region.start, row_region.end)
         col_key = (col_region.chromosome, col_region.start, col_region.end)
 
-        if row_key in self._region_buffer:
-            sub_row_regions = self._region_buffer[row_key]
-        else:
-            sub_row_regions = list(self.hic.regions(row_region))
-            self._region_buffer[row_key] = sub_row_regions
-
-        if col_key in self._region_buffer:
-            sub_col_regions = self._region_buffer[col_key]
-        else:
-            sub_col_regions = list(self.hic.regions(col_region))
-            self._region_buffer[col_key] = sub_col_regions
+        sub_row_regions = self._buffered(self._region_buffer, row_key,
+                                         lambda: list(self.hic.regions(row_region)))
+        sub_col_regions = self._buffered(self._region_buffer, col_key,
+                                         lambda: list(self.hic.regions(col_region)))
 
         row_offset = sub_row_regions[0].ix
         col_offset = sub_col_regions[0].ix
 
-        if (row_key, col_key) in self._edge_buffer:
-            edges = self._edge_buffer[(row_key, col_key)]
-        else:
-            edges = list(self.hic.edge_subset((row_region, col_region)))
-            self._edge_buffer[(row_key, col_key)] = edges
+        edges = self._buffered(self._edge_buffer, (row_key, col_key),
+                               lambda: list(self.hic.edge_subset((row_region, col_region))))
 
         m = np.full((len(sub_row_regions), len(sub_col_regions)), self._default_value,
                     dtype=np.float64)
@@ -0,0 +1,172 @@
+import os
+import numpy as np
+import pytest
+from genomic_regions import GenomicRegion
+from fanc.architecture.aggregate import AggregateMatrix
+from fanc.architecture.compartments import ABCompartmentMatrix
+from fanc.architecture.domains import DirectionalityIndexes, InsulationScores
+from fanc.tools.load import load
+
+
+@pytest.fixture
+def binned_hic_file(tmpdir):
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    file_name = str(tmpdir) + "/binned.hic"
+    with load(test_dir + "/test_matrix/cerevisiae.chrI.HindIII_upgrade.hic", mode='r') as hic:
+        binned = hic.bin(5000, file_name=file_name)
+        binned.close()
+    return file_name
+
+
+def _dense_insulation_scores(m, unmappable, bin_window_size, window_offset=0, na_threshold=0.5,
+                             normalise=True, subtract_mean=False, log=True):
+    """
+    Insulation scores of a single chromosome from its dense matrix.
+    """
+    n = m.shape[0]
+    window_offset += 1
+    values = np.full(n, np.nan)
+    for k in range(n):
+        if k - window_offset < bin_window_size - 1 or k + window_offset > n - bin_window_size:
+            continue
+        rows = slice(k - window_offset - bin_window_size + 1, k - window_offset + 1)
+        cols = slice(k + window_offset, k + window_offset + bin_window_size)
+        na_total = np.sum(np.logical_or(unmappable[rows][:, None], unmappable[cols][None, :]))
+        if na_total > bin_window_size ** 2 * na_threshold:
+            continue
+        values[k] = np.sum(m[rows, cols]) / (bin_window_size ** 2 - na_total)
+
+    if normalise:
+        mean_ins = np.mean(values[np.isfinite(values)])
+        values = values - mean_ins if subtract_mean else values / mean_ins
+    if log:
+        values = np.log2(values)
+    return values
+
+
+class TestAggregateMatrix:
+    @pytest.mark.parametrize("keep_components", [True, False])
+    def test_from_center_threads(self, binned_hic_file, caplog, keep_components):
+        regions = [GenomicRegion(chromosome='chrI', start=s, end=s + 1000)
+                   for s in range(20000, 200000, 20000)]
+
+        # workers have to open the file while it is open for writing here
+        with load(binned_hic_file, mode='a') as hic:
+            single = AggregateMatrix.from_center(hic, regions, window=20000, threads=1,
+                                                 keep_components=keep_components)
+            parallel = AggregateMatrix.from_center(hic, regions, window=20000, threads=2,
+                                                   keep_components=keep_components)
+        assert "single process" not in caplog.text
+
+        assert np.allclose(single.matrix(), parallel.matrix(), equal_nan=True)
+
+        single_components = single.components()
+        parallel_components = parallel.components()
+        assert len(single_components) == len(parallel_components)
+        if keep_components:
+            assert len(parallel_components) == len(regions)
+        for m1, m2 in zip(single_components, parallel_components):
+            assert np.array_equal(np.ma.getmaskarray(m1), np.ma.getmaskarray(m2))
+            assert np.ma.allclose(m1, m2)
+
+        single.close()
+        parallel.close()
+
+
+class TestDirectionalityIndexes:
+    def test_from_hic_threads(self, binned_hic_file, caplog):
+        window_sizes = [20000, 50000]
+        with load(binned_hic_file, mode='a') as hic:
+            single = DirectionalityIndexes.from_hic(hic, window_sizes, threads=1)
+            parallel = DirectionalityIndexes.from_hic(hic, window_sizes, threads=2)
+        assert "single process" not in caplog.text
+
+        for window_size in window_sizes:
+            single_scores = np.array(list(single.scores(window_size)))
+            parallel_scores = np.array(list(parallel.scores(window_size)))
+            assert np.allclose(single_scores, parallel_scores, equal_nan=True)
+
+        single.close()
+        parallel.close()
+
+
+class TestInsulationScores:
+    @pytest.mark.parametrize("kwargs", [
+        dict(),
+        dict(log=False),
+        dict(normalise=False),
+        dict(subtract_mean=True, log=False),
+        dict(window_offset=1),
+        dict(window_offset=2, normalise=False, log=False),
+    ])
+    def test_from_hic(self, binned_hic_file, kwargs):
+        window_sizes = [10000, 20000, 40000]
+        with load(binned_hic_file, mode='r') as hic:
+            m = np.ma.filled(hic.matrix(), 0)
+            unmappable = ~np.array(hic.mappable(), dtype=bool)
+            assert np.sum(unmappable) > 0
+
+            insulation_scores = InsulationScores.from_hic(hic, window_sizes, **kwargs)
+            for window_size in window_sizes:
+                bin_window_size = int(hic.distance_to_bins(window_size) / 2)
+                expected = _dense_insulation_scores(m, unmappable, bin_window_size, **kwargs)
+                scores = np.array(list(insulation_scores.scores(window_size)))
+                assert np.allclose(scores, expected, equal_nan=True)
+            insulation_scores.close()
+
+    def test_from_hic_impute_missing(self, binned_hic_file):
+        window_sizes = [10000, 20000, 40000]
+        with load(binned_hic_file, mode='r') as hic:
+            unmappable = ~np.array(hic.mappable(), dtype=bool)
+            _, intra_expected_chromosome, _ = hic.expected_values()
+            expected = np.array(intra_expected_chromosome['chrI'])
+
+            # replace every contact of an unmappable bin with its expected value
+            m = np.ma.filled(hic.matrix(), 0)
+            ix = np.arange(m.shape[0])
+            imputed = np.logical_or(unmappable[:, None], unmappable[None, :])
+            m[imputed] = expected[np.abs(ix[:, None] - ix[None, :])][imputed]
+
+            insulation_scores = InsulationScores.from_hic(hic, window_sizes, impute_missing=True,
+                                                          normalise=False, log=False)
+            for window_size in window_sizes:
+                bin_window_size = int(hic.distance_to_bins(window_size) / 2)
+                dense_scores = _dense_insulation_scores(m, np.zeros(len(m), dtype=bool), bin_window_size,
+                                                        normalise=False, log=False)
+                scores = np.array(list(insulation_scores.scores(window_size)))
+                assert np.allclose(scores, dense_scores, equal_nan=True)
+            insulation_scores.close()
+
+
+class TestABCompartmentMatrix:
+    def _assert_ab_equal(self, ab, ab_edges):
+        assert len(ab.edges) == len(ab_edges.edges)
+        assert len(list(ab.edges(('chrI', 'chrI')))) == len(list(ab_edges.edges(('chrI', 'chrI'))))
+        assert np.array_equal(np.array(ab.mappable()), np.array(ab_edges.mappable()))
+
+        intra, intra_chromosome, inter = ab.expected_values(force=True)
+        intra_edges, intra_chromosome_edges, inter_edges = ab_edges.expected_values(force=True)
+        assert np.allclose(intra, intra_edges, atol=1e-4)
+        for chromosome, values in intra_chromosome_edges.items():
+            assert np.allclose(intra_chromosome[chromosome], values, atol=1e-4)
+        assert np.isclose(inter, inter_edges)
+        assert np.array_equal(np.array(ab.mappable()), np.array(ab_edges.mappable()))
+
+        ev = ab.eigenvector(force=True)
+        ev_edges = ab_edges.eigenvector(force=True)
+        assert np.sum(np.abs(ev)) > 0
+        assert np.allclose(np.abs(ev), np.abs(ev_edges), atol=1e-4)
+
+    def test_dense(self, binned_hic_file, tmpdir):
+        file_name = str(tmpdir) + "/ab.ab"
+        with load(binned_hic_file, mode='r') as hic:
+            ab = ABCompartmentMatrix.from_hic(hic, file_name=file_name)
+            ab_edges = ABCompartmentMatrix.from_hic(hic, dense=False)
+
+        assert len(ab_edges.edges) > 0
+        self._assert_ab_equal(ab, ab_edges)
+        ab.close()
+
+        with load(file_name, mode='a') as ab:
+            self._assert_ab_equal(ab, ab_edges)
+        ab_edges.close()
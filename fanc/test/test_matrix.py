@@ -1,15 +1,19 @@
 import os
+from collections import defaultdict
 import numpy as np
+import scipy.sparse
 from fanc.compatibility.cooler import to_cooler
 from genomic_regions import GenomicRegion
-from fanc.matrix import Edge, RegionPairsTable, RegionMatrixTable, RegionMatrix
-from fanc.hic import Hic, _get_overlap_map, _edge_overlap_split_rao, kr_balancing, ice_balancing
+from fanc.matrix import Edge, RegionPairsTable, RegionMatrixTable, RegionMatrix, RegionMatrixContainer
+from fanc.hic import Hic, _get_overlap_map, _get_overlap_bounds, _edge_overlap_split_rao, \
+    _bin_edges_rao, kr_balancing, ice_balancing, correct_matrix, DiagonalFilter, LowCoverageFilter
 from fanc.regions import Chromosome, Genome
 from fanc.pairs import ReadPairs, SamBamReadPairGenerator
 from fanc.tools.matrix import is_symmetric
-from fanc.compatibility.juicer import JuicerHic
+from fanc.compatibility.juicer import JuicerHic, _decode_block
 from fanc.compatibility.cooler import CoolerHic
 from fanc.tools.load import load
+import struct
 import tables
 import pytest
 
@@ -108,6 +112,15 @@ class RegionMatrixContainerTestFactory:
                               edges_dict[(edge.source, edge.sink)],
                               rtol=1e-03)
 
+    @pytest.mark.parametrize("norm", [True, False])
+    def test_edges_array(self, norm):
+        edges_dict = {(e.source, e.sink): e.weight for e in self.matrix.edges(norm=norm, lazy=True)}
+
+        edges = self.matrix.edges_array(norm=norm)
+        assert len(edges) == len(edges_dict)
+        for source, sink, weight in edges:
+            assert np.isclose(weight, edges_dict[(source, sink)], equal_nan=True)
+
 
 class TestHic(RegionMatrixContainerTestFactory):
     def setup_method(self, method):
@@ -127,6 +140,42 @@ class TestJuicer(RegionMatrixContainerTestFactory):
         pass
 
 
+class TestJuicerBlocks:
+    def test_decode_list_of_rows(self):
+        for use_float, weight_format in ((0, '<h'), (1, '<f')):
+            block = struct.pack('<iiibbh', 3, 100, 200, use_float, 1, 2)
+            block += struct.pack('<hh', 0, 2) + struct.pack('<h', 1) + struct.pack(weight_format, 5)
+            block += struct.pack('<h', 3) + struct.pack(weight_format, 7)
+            block += struct.pack('<hh', 2, 1) + struct.pack('<h', 0) + struct.pack(weight_format, 9)
+
+            x, y, weight = _decode_block(block, 8)
+            assert list(x) == [101, 103, 100]
+            assert list(y) == [200, 200, 202]
+            assert list(weight) == [5, 7, 9]
+
+    def test_decode_dense(self):
+        block = struct.pack('<iiibb', 2, 10, 20, 0, 2) + struct.pack('<ih', 4, 2)
+        block += struct.pack('<hhhh', 3, -32768, -32768, 4)
+        x, y, weight = _decode_block(block, 8)
+        assert list(x) == [10, 11]
+        assert list(y) == [20, 21]
+        assert list(weight) == [3, 4]
+
+        block = struct.pack('<iiibb', 2, 10, 20, 1, 2) + struct.pack('<ih', 4, 2)
+        block += struct.pack('<ffff', np.nan, 1.5, 2.5, np.nan)
+        x, y, weight = _decode_block(block, 8)
+        assert list(x) == [11, 10]
+        assert list(y) == [20, 21]
+        assert list(weight) == [1.5, 2.5]
+
+    def test_decode_v6(self):
+        block = struct.pack('<i', 2) + struct.pack('<iif', 1, 2, 3.) + struct.pack('<iif', 4, 5, 6.)
+        x, y, weight = _decode_block(block, 6)
+        assert list(x) == [1, 4]
+        assert list(y) == [2, 5]
+        assert list(weight) == [3., 6.]
+
+
 class TestCooler(RegionMatrixContainerTestFactory):
     def setup_method(self, method):
         hic_file = os.path.join(test_dir, 'test_matrix', 'test_cooler.hic')
@@ -274,6 +323,28 @@ class TestRegionPairs:
             assert edge.bar == max(edge.sink, edge.source)
         assert s == 55
 
+    def test_edges_array(self):
+        edges = self.rmt.edges_array(fields=['foo', 'bar', 'baz'])
+        assert edges.dtype.names == ('source', 'sink', 'foo', 'bar', 'baz')
+        assert len(edges) == 55
+        for source, sink, foo, bar, baz in edges:
+            assert foo == source
+            assert bar == sink
+            assert baz.decode('utf-8') == 'x' + str(source * sink)
+
+        for key in [('chr2', 'chr2'), ('chr2', 'chr3'), ('chr3', 'chr1'),
+                    (slice(1, 6), slice(3, 9)), 'chr1']:
+            edges = self.rmt.edges_array(key, fields=['weight'], as_dict=True)
+            assert set(edges.keys()) == {'source', 'sink', 'weight'}
+            expected = {(e.source, e.sink): e.weight for e in self.rmt.edges(key)}
+            observed = {(source, sink): weight for source, sink, weight in
+                        zip(edges['source'], edges['sink'], edges['weight'])}
+            assert len(edges['source']) == len(expected)
+            assert observed == expected
+
+        with pytest.raises(TypeError):
+            self.rmt.edges_array(intra_chromosmal=False)
+
     def test_add_edge(self):
         rmt = self.rp_class(additional_edge_fields={'weight': tables.Float64Col()})
         rmt.add_region(GenomicRegion(chromosome='1', start=1, end=1000))
@@ -391,6 +462,126 @@ class TestRegionMatrixTable:
             for j, col_region in enumerate(m.col_regions):
                 assert m[i, j] == max(row_region.ix, col_region.ix)
 
+    def test_matrix_sparse(self):
+        for key in (None, ('chr2', 'chr2'), ('chr1', 'chr3'), ('chr3', 'chr1')):
+            m = self.rmt.matrix(key, score_field='bar', mask=False)
+            s = self.rmt.matrix(key, score_field='bar', sparse=True)
+            assert isinstance(s, scipy.sparse.csr_matrix)
+            assert s.shape == m.shape
+            assert np.array_equal(s.toarray(), np.array(m))
+
+            c = self.rmt.matrix(key, score_field='bar', sparse='coo')
+            assert isinstance(c, scipy.sparse.coo_matrix)
+            assert np.array_equal(c.toarray(), np.array(m))
+
+        s = self.rmt.matrix(('chr1', 'chr1'), sparse=True)
+        # contacts of region 0 have zero weight and are not stored
+        assert s.nnz == 16
+
+        assert self.rmt.matrix((1, 2), score_field='bar', sparse=True) == 2
+        row = self.rmt.matrix((1, slice(0, 5)), score_field='bar', sparse=True)
+        # there is no (0, 1) edge in the fixture
+        assert np.array_equal(row.toarray()[0], [0, 1, 2, 3, 4])
+
+    def test_matrix_dtype(self):
+        m = self.rmt.matrix(score_field='bar', dtype='float32', mask=False)
+        assert m.dtype == np.float32
+        assert np.array_equal(m, self.rmt.matrix(score_field='bar', mask=False))
+
+        s = self.rmt.matrix(score_field='bar', dtype=np.float32, sparse=True)
+        assert s.dtype == np.float32
+
+    def test_matrix_oe(self):
+        intra_expected, chromosome_intra_expected, inter_expected = self.rmt.expected_values()
+        edge_pixels = set()
+        for edge in self.rmt.edges():
+            edge_pixels.add((edge.source, edge.sink))
+            edge_pixels.add((edge.sink, edge.source))
+
+        for oe_per_chromosome in (True, False):
+            m = self.rmt.matrix(score_field='weight', oe=True,
+                                oe_per_chromosome=oe_per_chromosome, mask=False)
+            regions = list(self.rmt.regions)
+            for i, row_region in enumerate(regions):
+                for j, col_region in enumerate(regions):
+                    if (i, j) not in edge_pixels:
+                        # pixels without an edge default to 1.0 in O/E matrices
+                        assert m[i, j] == 1.0
+                        continue
+
+                    if row_region.chromosome != col_region.chromosome:
+                        expected = inter_expected
+                    elif oe_per_chromosome:
+                        expected = chromosome_intra_expected[row_region.chromosome][abs(i - j)]
+                    else:
+                        expected = intra_expected[abs(i - j)]
+                    assert np.isclose(m[i, j], i * j / expected)
+
+    def test_expected_values_partials(self):
+        rmt = RegionMatrixTable(partition_strategy='chromosome')
+        rmt.add_regions(self.rmt.regions(lazy=False))
+        rmt.add_edges([(i, j, i + j + 1) for i in range(10) for j in range(i, 10)])
+
+        def _assert_expected_equal(a, b):
+            assert np.allclose(a[0], b[0])
+            for chromosome in b[1]:
+                assert np.allclose(a[1][chromosome], b[1][chromosome])
+            assert np.isclose(a[2], b[2])
+            assert np.allclose(a[3], b[3])
+
+        for norm in (True, False):
+            _assert_expected_equal(rmt.expected_values_and_marginals(norm=norm, force=True),
+                                   RegionMatrixContainer.expected_values_and_marginals(rmt, norm=norm))
+
+        summed_partitions = []
+        original_sums = rmt._edge_table_expected_sums
+
+        def _edge_table_expected_sums(edge_table, *args, **kwargs):
+            summed_partitions.append((edge_table.attrs['source_partition'],
+                                      edge_table.attrs['sink_partition']))
+            return original_sums(edge_table, *args, **kwargs)
+        rmt._edge_table_expected_sums = _edge_table_expected_sums
+
+        # adding chr2-chr3 edges only affects a single partition
+        rmt.add_edges([(6, 9, 10), (7, 8, 20)])
+        assert summed_partitions == [(1, 2)]
+        _assert_expected_equal(rmt.expected_values_and_marginals(norm=True),
+                               RegionMatrixContainer.expected_values_and_marginals(rmt, norm=True))
+
+        # bias of a chr3 region affects all partitions containing chr3
+        del summed_partitions[:]
+        biases = np.ones(10)
+        biases[9] = 0.5
+        rmt.region_data('bias', biases)
+        assert sorted(summed_partitions) == [(0, 2), (1, 2), (2, 2)]
+        _assert_expected_equal(rmt.expected_values_and_marginals(norm=True),
+                               RegionMatrixContainer.expected_values_and_marginals(rmt, norm=True))
+
+        # uncorrected sums only need to catch up on the added edges
+        del summed_partitions[:]
+        _assert_expected_equal(rmt.expected_values_and_marginals(norm=False, force=True),
+                               RegionMatrixContainer.expected_values_and_marginals(rmt, norm=False))
+        assert summed_partitions == [(1, 2)]
+        rmt.close()
+
+    def test_expected_values_partials_in_place_update(self):
+        rmt = RegionMatrixTable(partition_strategy='chromosome')
+        rmt.add_regions(self.rmt.regions(lazy=False))
+        rmt.add_edges([(i, j, i + j + 1) for i in range(10) for j in range(i, 10)])
+        intra_expected, _, _ = rmt.expected_values(norm=False)
+
+        # double all weights without changing the number of edges
+        for _, edge_table in rmt._iter_edge_tables():
+            for row in edge_table:
+                row['weight'] *= 2
+                row.update()
+        rmt._edges_dirty = True
+        rmt.flush()
+
+        new_intra_expected, _, _ = rmt.expected_values(norm=False)
+        assert np.allclose(np.array(new_intra_expected), 2 * np.array(intra_expected))
+        rmt.close()
+
 
 class TestHicBasic:
     def setup_method(self, method):
@@ -465,6 +656,25 @@ class TestHicBasic:
         edges = list(self.hic.edges(inter_chromosomal=False))
         assert sum(1 for _ in edges) == 31
 
+    def test_edges_array(self):
+        self.hic.region_data('bias', np.arange(1, 13) / 10)
+        self.hic.filter_diagonal(distance=1)
+
+        for key in [None, ('chr1', 'chr1'), ('chr2', 'chr1'), 'chr3', 'chr1:1000-3500']:
+            for norm in (True, False):
+                for intra_chromosomal, inter_chromosomal in ((True, True), (True, False), (False, True)):
+                    kwargs = dict(norm=norm, intra_chromosomal=intra_chromosomal,
+                                  inter_chromosomal=inter_chromosomal)
+                    expected = {(e.source, e.sink): e.weight
+                                for e in self.hic.edges(key, lazy=True, **kwargs)}
+                    edges = self.hic.edges_array(key, **kwargs)
+                    assert len(edges) == len(expected)
+                    for source, sink, weight in edges:
+                        assert np.isclose(weight, expected[(source, sink)])
+
+        edges = self.hic.edges_array(excluded_filters=['diagonal'])
+        assert len(edges) == 78
+
     def test_get_node_x_by_region(self):
         region1 = GenomicRegion.from_string('chr1')
         nodes1 = list(self.hic.regions(region1))
@@ -809,6 +1019,42 @@ class TestHicBasic:
         for bin_size in bin_sizes:
             assert_binning(bin_size)
 
+    def test_bin_edges_rao(self):
+        overlap_map = {0: [[0, 1.0]], 1: [[0, 0.5]], 2: [[1, 1.0], [2, 1.0], [3, 0.5]], 3: []}
+        first_bins, last_bins = _get_overlap_bounds(overlap_map, 4)
+        assert list(first_bins) == [0, 0, 1, -1]
+        assert list(last_bins) == [0, 0, 3, -1]
+
+        sources = np.array([0, 0, 1, 2, 0])
+        sinks = np.array([0, 1, 2, 2, 3])
+        weights = np.array([3.0, 5.0, 9.0, 7.0, 2.0])
+        new_sources, new_sinks, new_weights = _bin_edges_rao(sources, sinks, weights,
+                                                             first_bins, last_bins)
+
+        expected = defaultdict(int)
+        for edge in zip(sources, sinks, weights):
+            for new_source, new_sink, new_weight in _edge_overlap_split_rao(list(edge), overlap_map):
+                expected[(new_source, new_sink)] += new_weight
+
+        observed = {(source, sink): weight for source, sink, weight in
+                    zip(new_sources, new_sinks, new_weights)}
+        assert set(observed.keys()) == set(expected.keys())
+        assert observed[(0, 0)] == 8
+        assert sum(observed.values()) == sum(expected.values()) == 24
+        for value in observed.values():
+            assert value == int(value)
+
+    def test_bin_threads(self):
+        original_reads = sum(edge.weight for edge in self.hic_cerevisiae.edges())
+
+        binned = self.hic_cerevisiae.bin(10000, threads=2)
+        assert sum(edge.weight for edge in binned.edges()) == original_reads
+        edges = set()
+        for edge in binned.edges():
+            assert (edge.source, edge.sink) not in edges
+            edges.add((edge.source, edge.sink))
+        binned.close()
+
     def test_from_hic_sample(self, tmpdir):
         dest_file = os.path.join(str(tmpdir), "hic.h5")
         hic = self.hic_class(file_name=dest_file, mode='w')
@@ -933,6 +1179,27 @@ class TestHicBasic:
             assert abs(1.0 - n) < 1e-5 or n == 0
         hic.close()
 
+    def test_knight_matrix_balancing_sparse(self):
+        chrI = Chromosome.from_fasta(self.dir + "/test_matrix/chrI.fa")
+        genome = Genome(chromosomes=[chrI])
+
+        hic = self.hic_class()
+        regions = genome.get_regions(10000)
+        genome.close()
+        hic.add_regions(regions)
+        regions.close()
+        hic.load_from_hic(self.hic_cerevisiae)
+
+        m = hic.matrix(norm=False, mask=False)
+        m_corrected, bias_vector = correct_matrix(np.array(m))
+
+        m_sparse = hic.matrix(norm=False, sparse=True)
+        m_corrected_sparse, bias_vector_sparse = correct_matrix(m_sparse)
+        assert scipy.sparse.issparse(m_corrected_sparse)
+        assert np.allclose(bias_vector, bias_vector_sparse)
+        assert np.allclose(m_corrected, m_corrected_sparse.toarray())
+        hic.close()
+
     def test_ice_matrix_balancing(self):
         chrI = Chromosome.from_fasta(self.dir + "/test_matrix/chrI.fa")
         genome = Genome(chromosomes=[chrI])
@@ -958,6 +1225,29 @@ class TestHicBasic:
             assert (sum_m_corr[0] - 5 < n < sum_m_corr[0] + 5) or n == 0
         hic.close()
 
+    def test_ice_matrix_balancing_per_chromosome(self):
+        chrI = Chromosome.from_fasta(self.dir + "/test_matrix/chrI.fa")
+        genome = Genome(chromosomes=[chrI])
+
+        hic = self.hic_class()
+        regions = genome.get_regions(10000)
+        genome.close()
+        hic.add_regions(regions)
+        regions.close()
+        hic.load_from_hic(self.hic_cerevisiae)
+
+        bias_vector = ice_balancing(hic, whole_matrix=False)
+        assert len(bias_vector) == len(hic.regions)
+        m_corr = hic[:, :]
+        assert is_symmetric(m_corr)
+
+        sum_m_corr = sum(m_corr)
+        for n in sum_m_corr:
+            if np.ma.is_masked(n):
+                continue
+            assert (sum_m_corr[0] - 5 < n < sum_m_corr[0] + 5) or n == 0
+        hic.close()
+
     def test_diagonal_filter(self):
         hic = self.hic
 
@@ -974,6 +1264,18 @@ class TestHicBasic:
                 if abs(i - j) <= 1:
                     assert m[i, j] == 0
 
+    def test_valid_chunk(self):
+        hic = self.hic
+        filters = [DiagonalFilter(hic, distance=1), LowCoverageFilter(hic, rel_cutoff=0.5)]
+        for edge_filter in filters:
+            assert edge_filter.has_valid_chunk()
+            for _, edge_table in hic._iter_edge_tables():
+                rows = edge_table.read()
+                arrays = {name: rows[name] for name in rows.dtype.names}
+                valid_chunk = edge_filter.valid_chunk(arrays)
+                valid = [edge_filter.valid(row) for row in edge_table._iter_visible_and_masked()]
+                assert list(valid_chunk) == valid
+
     def test_low_coverage_filter(self):
         hic = self.hic
 
@@ -3,7 +3,8 @@ import pytest
 from fanc.pairs import SamBamReadPairGenerator, ReadPairs, UnmappedFilter, FragmentReadPair, \
     FragmentRead, InwardPairsFilter, OutwardPairsFilter, ContaminantFilter, QualityFilter, \
     BwaMemQualityFilter, ReDistanceFilter, SelfLigationFilter, LazyFragment, LazyFragmentRead, \
-    PCRDuplicateFilter
+    PCRDuplicateFilter, UniquenessFilter, BwaMemUniquenessFilter, _read_arrays, \
+    HicProPairGenerator, FourDNucleomePairGenerator
 from genomic_regions import GenomicRegion
 from fanc.regions import Genome, Chromosome
 from fanc.general import Mask
@@ -97,6 +98,97 @@ class TestReadPairs:
     def test_len(self):
         assert len(self.pairs) == 44
 
+    def test_add_read_pairs_from_sam(self, tmpdir):
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        pairs = ReadPairs()
+        regions = self.genome.get_regions(1000)
+        pairs.add_regions(regions.regions)
+        regions.close()
+        pairs.add_read_pairs_from_sam(sam1_file, sam2_file, batch_size=10, threads=2,
+                                      tmpdir=str(tmpdir))
+
+        def pair_tuples(p):
+            return sorted((pair.left.fragment.ix, pair.right.fragment.ix,
+                           pair.left.position, pair.right.position,
+                           pair.left.strand, pair.right.strand)
+                          for pair in p.pairs())
+
+        assert len(pairs) == len(self.pairs)
+        assert pair_tuples(pairs) == pair_tuples(self.pairs)
+        assert sorted(edge.ix for edge in pairs.edges(lazy=True)) == list(range(len(pairs)))
+        assert dict(pairs.meta.read_filter_stats) == dict(self.pairs.meta.read_filter_stats)
+        pairs.close()
+
+    def test_add_read_pairs_from_txt(self, tmpdir):
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        valid_pairs_file = os.path.join(str(tmpdir), "test.validPairs")
+        pairs_file = os.path.join(str(tmpdir), "test.pairs")
+        with open(valid_pairs_file, 'w') as valid_pairs, open(pairs_file, 'w') as pairs:
+            pairs.write("## pairs format v1.0\n")
+            pairs.write("#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\n")
+            for i, (read1, read2) in enumerate(SamBamReadPairGenerator(sam1_file, sam2_file)):
+                strand1 = '-' if read1.is_reverse else '+'
+                strand2 = '-' if read2.is_reverse else '+'
+                if i == 10:
+                    valid_pairs.write("# comment\n")
+                valid_pairs.write("\t".join([read1.qname + '#0/1', read1.reference_name, str(read1.pos), strand1,
+                                              read2.reference_name, str(read2.pos), strand2]) + "\n")
+                pairs.write(" ".join([read1.qname, read1.reference_name, str(read1.pos),
+                                      read2.reference_name, str(read2.pos), strand1, strand2]) + "\n")
+
+        def edge_tuples(p):
+            return [(edge.ix, edge.source, edge.sink,
+                     edge.left_read_position, edge.right_read_position,
+                     edge.left_read_strand, edge.right_read_strand)
+                    for edge in p.edges(lazy=True, norm=False)]
+
+        for pair_generator_class, file_name in ((HicProPairGenerator, valid_pairs_file),
+                                                (FourDNucleomePairGenerator, pairs_file)):
+            results = []
+            for columnar in (True, False):
+                pairs = ReadPairs()
+                regions = self.genome.get_regions(1000)
+                pairs.add_regions(regions.regions)
+                regions.close()
+                pair_generator = pair_generator_class(file_name)
+                # plain iterators are loaded row by row
+                pairs.add_read_pairs(pair_generator if columnar else iter(pair_generator))
+                results.append(edge_tuples(pairs))
+                pairs.close()
+
+            assert len(results[0]) == 44
+            assert results[0] == results[1]
+
+            chunks = list(pair_generator_class(file_name).read_pair_chunks(block_size=100))
+            assert sum(len(chunk[1]) for chunk in chunks) == 44
+
+    def test_sam_chunks(self):
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+
+        def pair_tuples(pair_generator):
+            return [(read1.qname, read1.pos, read2.pos) for read1, read2 in pair_generator]
+
+        pair_generator = SamBamReadPairGenerator(sam1_file, sam2_file)
+        pairs = pair_tuples(pair_generator)
+        stats = pair_generator.stats()
+
+        for batch_size in (1, 7, 1000):
+            chunks = list(pair_generator.chunks(batch_size=batch_size))
+            assert len(chunks) > 1 or batch_size >= len(pairs)
+
+            chunk_pairs = []
+            chunk_stats = dict()
+            for chunk in chunks:
+                chunk_generator = SamBamReadPairGenerator(sam1_file, sam2_file, chunk=chunk)
+                chunk_pairs += pair_tuples(chunk_generator)
+                for key, value in chunk_generator.stats().items():
+                    chunk_stats[key] = chunk_stats.get(key, 0) + value
+            assert chunk_pairs == pairs
+            assert chunk_stats == stats
+
     def test_auto_mindist(self):
         ad = self.pairs_class._auto_dist
         np.random.seed(101)
@@ -107,6 +199,19 @@ class TestReadPairs:
         assert ad(x, i, b, 0.05) == 67
         assert ad(x, o, b, 0.05) == 45
 
+    def test_valid_chunk(self):
+        filters = [InwardPairsFilter(minimum_distance=100), OutwardPairsFilter(minimum_distance=100),
+                   ReDistanceFilter(maximum_distance=300), SelfLigationFilter()]
+        for pair_filter in filters:
+            assert pair_filter.has_valid_chunk()
+            pair_filter.set_pairs_object(self.pairs)
+            for _, edge_table in self.pairs._iter_edge_tables():
+                rows = edge_table.read()
+                arrays = {name: rows[name] for name in rows.dtype.names}
+                valid_chunk = pair_filter.valid_chunk(arrays)
+                valid = [pair_filter.valid(row) for row in edge_table._iter_visible_and_masked()]
+                assert list(valid_chunk) == valid
+
     def test_filter_inward(self):
         mask = self.pairs.add_mask_description('inwards', 'Mask read pairs that are inward '
                                                           'facing and closer than 100bp')
@@ -144,6 +249,31 @@ class TestReadPairs:
         self.pairs.filter(self_ligation_filter)
         assert len(self.pairs) == 7
 
+    def test_filter_pcr_duplicates(self):
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        pairs = ReadPairs()
+        regions = self.genome.get_regions(1000)
+        pairs.add_regions(regions.regions)
+        regions.close()
+        # every pair is added twice
+        pairs.add_read_pairs(SamBamReadPairGenerator(sam1_file, sam2_file))
+        pairs.add_read_pairs(SamBamReadPairGenerator(sam1_file, sam2_file))
+        assert len(pairs) == 88
+
+        pcr_filter = PCRDuplicateFilter(pairs=pairs, threshold=3)
+        assert len(pcr_filter.duplicates) == 44
+        assert dict(pcr_filter.duplicate_stats) == {2: 44}
+
+        # external sort in small buckets
+        chunked_pcr_filter = PCRDuplicateFilter(pairs=pairs, threshold=3, chunk_size=10)
+        assert np.array_equal(pcr_filter.duplicates, chunked_pcr_filter.duplicates)
+        assert dict(chunked_pcr_filter.duplicate_stats) == {2: 44}
+
+        pairs.filter_pcr_duplicates(threshold=3)
+        assert len(pairs) == 44
+        pairs.close()
+
     def test_get_ligation_structure_biases(self):
         sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
         sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
@@ -199,6 +329,50 @@ class TestReadPairs:
         assert len(list(self.pairs.pairs(excluded_filters=[in_filter, 3]))) == 28
 
 
+class TestReadFilters:
+    @classmethod
+    def setup_method(self, method):
+        self.dir = os.path.dirname(os.path.realpath(__file__))
+        self.sam1_file = os.path.join(self.dir, "test_pairs", "test_bwa1.sam")
+        self.sam2_file = os.path.join(self.dir, "test_pairs", "test_bwa2.sam")
+        self.contaminant_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_contaminant.sam")
+
+    def _filters(self):
+        return [QualityFilter(3, mask=Mask('quality', 'quality')),
+                UniquenessFilter(strict=True, mask=Mask('unique_strict', 'unique_strict')),
+                UniquenessFilter(strict=False, mask=Mask('unique', 'unique')),
+                BwaMemUniquenessFilter(strict=True, mask=Mask('bwa_unique_strict', 'bwa_unique_strict')),
+                BwaMemUniquenessFilter(strict=False, mask=Mask('bwa_unique', 'bwa_unique')),
+                BwaMemQualityFilter(0.9, mask=Mask('bwa_quality', 'bwa_quality')),
+                ContaminantFilter(self.contaminant_file, mask=Mask('contaminant', 'contaminant')),
+                UnmappedFilter(mask=Mask('unmapped', 'unmapped'))]
+
+    def test_valid_chunk(self):
+        pair_generator = SamBamReadPairGenerator(self.sam1_file, self.sam2_file, check_sorted=False)
+        reads = [read for pair in pair_generator for read in pair]
+        for read_filter in self._filters():
+            assert read_filter.has_valid_chunk()
+            arrays = _read_arrays(reads, read_filter.chunk_fields)
+            valid_chunk = read_filter.valid_chunk(arrays)
+            valid = [read_filter.valid_read(read) for read in reads]
+            assert list(valid_chunk) == valid
+
+    def test_batch_stats(self):
+        stats = []
+        for batch_size in (1, 5, 10000):
+            pair_generator = SamBamReadPairGenerator(self.sam1_file, self.sam2_file, check_sorted=False)
+            pair_generator.batch_size = batch_size
+            for read_filter in self._filters()[:5]:
+                pair_generator.add_filter(read_filter)
+            pairs = [(read1.qname, read1.pos, read2.pos) for read1, read2 in pair_generator]
+            stats.append((pairs, pair_generator.stats()))
+
+        assert stats[0] == stats[1] == stats[2]
+        assert stats[0][1] == {'quality': 2, 'unique_strict': 17, 'unique': 2,
+                               'bwa_unique_strict': 3, 'bwa_unique': 2,
+                               'unmappable': 0, 'valid': 0, 'total': 17}
+
+
 class TestFragmentRead:
     def setup_method(self, method):
         fragment1 = GenomicRegion(start=1, end=1000, chromosome='chr1', strand=1, ix=0)
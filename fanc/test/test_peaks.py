@@ -1,6 +1,7 @@
 from __future__ import division
 import fanc
-from fanc.peaks import RaoPeakCaller, RaoPeakInfo
+from fanc.peaks import RaoPeakCaller, RaoPeakInfo, process_matrix_segment_intra, \
+    process_matrix_segment_intra_vectorised
 from fanc.hic import Hic
 from fanc.matrix import RegionMatrix
 from genomic_regions import GenomicRegion
@@ -8,6 +9,7 @@ from fanc.tools.general import pairwise
 import numpy as np
 import math
 import pickle
+import msgpack
 import os.path
 
 
@@ -111,6 +113,33 @@ class TestRaoPeakCaller:
         assert RaoPeakCaller.find_chunk(30) == 15
         assert RaoPeakCaller.find_chunk(1024) == 31
 
+    def test_segment_backends(self):
+        np.random.seed(0)
+        n = 60
+        c = np.random.uniform(0.5, 2, n)
+        m = np.random.poisson(5, (n, n)).astype(float)
+        m = (np.triu(m) + np.triu(m, 1).T) * c[:, None] * c
+        mappable = np.ones(n, dtype=bool)
+        mappable[[3, 17, 18, 40]] = False
+        e = np.linspace(6, 1, n)
+
+        for segment in RaoPeakCaller.segment_matrix_intra(m, 20, 6):
+            ms, i_range, i_inspect, j_range, j_inspect = segment
+            args = msgpack.dumps([ms, e, 10,
+                                  i_range, i_inspect, mappable[i_range[0]:i_range[1]], c[i_range[0]:i_range[1]],
+                                  j_range, j_inspect, mappable[j_range[0]:j_range[1]], c[j_range[0]:j_range[1]],
+                                  3, 1, 1, 16, 0.5, 6])
+            results_pixel = msgpack.loads(process_matrix_segment_intra(args))
+            results_vectorised = msgpack.loads(process_matrix_segment_intra_vectorised(args))
+
+            assert len(results_pixel) == len(results_vectorised)
+            for result_pixel, result_vectorised in zip(results_pixel, results_vectorised):
+                for value_pixel, value_vectorised in zip(result_pixel, result_vectorised):
+                    if value_pixel is None:
+                        assert value_vectorised is None
+                    else:
+                        assert np.isclose(value_pixel, value_vectorised, equal_nan=True)
+
     def test_call_peaks(self):
         dir = os.path.dirname(os.path.realpath(__file__))
         hic_10kb = fanc.load(dir + "/test_peaks/rao2014.chr11_77400000_78600000.hic", mode='r')
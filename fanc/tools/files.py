@@ -66,6 +66,23 @@ def create_or_open_pytables_file(file_name=None, mode='a'):
         return t.open_file(file_name, mode, chunk_cache_size=270536704, chunk_cache_nelmts=2084)
 
 
+def release_inherited_pytables_file(file_name):
+    """
+    Allow a forked worker process to open its own handle to a PyTables file.
+
+    Worker processes started with :code:`fork` inherit the open file registry
+    of their parent, and PyTables refuses to open a file in read-only mode if
+    the parent holds it open for writing. This removes the inherited handles
+    from the registry without closing them, as closing would write to the
+    file the parent still uses.
+
+    :param file_name: Path to the PyTables file
+    """
+    registry = t.file._open_files
+    for handle in list(registry.get_handlers_by_name(file_name)):
+        registry.remove(handle)
+
+
 def is_sambam_file(file_name):
     file_name = os.path.expanduser(file_name)
     if not os.path.isfile(file_name):
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 from scipy.stats.mstats import gmean
 
 
@@ -31,6 +32,55 @@ def restore_sparse_rows(m, idx_sets, rows=None):
     return a
 
 
+def remove_sparse_rows_sparse(m, cutoff=None):
+    """
+    Sparse counterpart of :func:`~remove_sparse_rows`.
+
+    :param m: square :mod:`scipy.sparse` matrix
+    :param cutoff: rows/columns with a sum smaller or equal to this
+                   are removed. Defaults to the smallest row sum
+    :return: CSR matrix without the removed rows/columns, array of removed indices
+    """
+    s = np.asarray(m.sum(axis=0)).ravel()
+
+    if cutoff is None:
+        cutoff = min(s)
+
+    idxs = np.where(s <= cutoff)[0]
+    keep = np.where(s > cutoff)[0]
+    m_removed = scipy.sparse.csr_matrix(m)[keep][:, keep]
+
+    return m_removed, idxs
+
+
+def restore_sparse_rows_sparse(m, idx_sets):
+    """
+    Sparse counterpart of :func:`~restore_sparse_rows`.
+
+    :param m: square :mod:`scipy.sparse` matrix or 1D numpy array
+    :param idx_sets: list of index arrays, as returned by consecutive
+                     calls to :func:`~remove_sparse_rows_sparse`
+    :return: CSR matrix or numpy array with zeros at the removed indices
+    """
+    # map remaining indices back to the original matrix
+    original_ixs = np.arange(m.shape[0])
+    for idxs in reversed(idx_sets):
+        n = len(original_ixs) + len(idxs)
+        kept = np.ones(n, dtype=bool)
+        kept[idxs] = False
+        original_ixs = np.where(kept)[0][original_ixs]
+    n = m.shape[0] + sum(len(idxs) for idxs in idx_sets)
+
+    if not scipy.sparse.issparse(m):
+        a = np.zeros(n, dtype=m.dtype)
+        a[original_ixs] = m
+        return a
+
+    m = m.tocoo()
+    return scipy.sparse.csr_matrix((m.data, (original_ixs[m.row], original_ixs[m.col])),
+                                   shape=(n, n))
+
+
 def is_symmetric(m, tol=1e-10):
     for i in range(0, m.shape[0]):
         for j in range(i, m.shape[1]):